@@ -10,7 +10,8 @@ EXAMPLE = pkg_resources.resource_filename("parangonar",
 ALIGNMENT_TRANSFORMER_CHECKPOINT = pkg_resources.resource_filename("parangonar", 
                                           "assets/alignment_transformer_checkpoint.pt")
 from .match import AnchorPointNoteMatcher, AutomaticNoteMatcher, DualDTWNoteMatcher
-from .match import OnlineTransformerMatcher, OnlinePureTransformerMatcher
+from .match import (OnlineTransformerMatcher, OnlinePureTransformerMatcher,
+                    OnlineTimeWarpingMatcher)
 from .evaluate import fscore_alignments, plot_alignment, plot_alignment_comparison
 
 __all__ = [
@@ -18,7 +19,8 @@ __all__ = [
     "AutomaticNoteMatcher",
     "DualDTWNoteMatcher",
     "OnlineTransformerMatcher",
-    "OnlinePureTransformerMatcher"
+    "OnlinePureTransformerMatcher",
+    "OnlineTimeWarpingMatcher",
     "fscore_alignments",
     "plot_alignment_comparison",
     "plot_alignment"
@@ -5,17 +5,24 @@ This module contains methods for note and sequence alignment.
 
 """
 
-from .dtw import DTW, DTWSL
-from .nwtw import NW_DTW, NW
+from .dtw import DTW, DTWSL, DTWLM
+from .nwtw import NW_DTW, NW, NW_AG
 from .matchers import (AnchorPointNoteMatcher, 
                        AutomaticNoteMatcher,
                        CleanOrnamentMatcher,
                        DualDTWNoteMatcher,
+                       ScoreOnsetIndex,
                        pitch_and_onset_wise_times,
                        pitch_and_onset_wise_times_ornament,
                        get_score_to_perf_map)
 from .online_matchers import (OnlineTransformerMatcher, 
-                              OnlinePureTransformerMatcher)
+                              OnlinePureTransformerMatcher,
+                              OnlineTimeWarpingMatcher)
 from .utils import (node_array,
-                    save_parangonada_csv)
-from .pretrained_models import (AlignmentTransformer)
\ No newline at end of file
+                    save_parangonada_csv,
+                    TimeMap)
+try:
+    from .pretrained_models import (AlignmentTransformer)
+except ImportError:
+    # torch is only needed for the transformer models
+    pass
\ No newline at end of file
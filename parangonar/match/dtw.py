@@ -5,7 +5,11 @@ This module contains dynamic time warping methods.
 """
 
 import numpy as np
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from scipy.spatial.distance import cdist
+from scipy.sparse import issparse, csr_matrix
+from scipy.ndimage import minimum_filter1d, maximum_filter1d
 
 def element_of_metric(vec1, vec2):
     """
@@ -23,6 +27,84 @@ def element_of_set_metric(element_, set_):
         return 1.0
 
 
+def element_of_set_masks(elements, masks):
+    """
+    vectorized `element_of_set_metric` for integer elements 
+    in [0, 128) and sets encoded as 128 bit masks (see 
+    `pitch_set_masks`), broadcast over the leading dimensions
+    of `elements` and `masks`.
+    """
+    elements = np.asarray(elements, dtype=np.int64)
+    words = np.where(elements >= 64, masks[..., 1], masks[..., 0])
+    bits = (words >> (elements & 63).astype(np.uint64)) & np.uint64(1)
+    return 1.0 - bits
+
+
+def pitch_set_masks(pitch_sets):
+    """
+    encode sets of integers in [0, 128) (e.g. MIDI pitches)
+    as 128 bit masks.
+
+    Parameters
+    ----------
+    pitch_sets : list of sets
+        sets of integers
+
+    Returns
+    -------
+    masks : np.ndarray
+        (len(pitch_sets), 2) uint64 array, bit k of word w is set 
+        if 64 * w + k is in the set.
+    """
+    sizes = [len(pitch_set) for pitch_set in pitch_sets]
+    pitches = np.fromiter((pitch for pitch_set in pitch_sets 
+                           for pitch in pitch_set), 
+                          dtype=np.int64, count=sum(sizes))
+    set_idx = np.repeat(np.arange(len(pitch_sets)), sizes)
+    return indexed_pitch_set_masks(pitches, set_idx, len(pitch_sets))
+
+
+def indexed_pitch_set_masks(pitches, set_idx, n_sets):
+    """
+    128 bit masks (see `pitch_set_masks`) of the sets 
+    {pitches[set_idx == k]} for k in range(n_sets).
+    """
+    pitches = np.asarray(pitches, dtype=np.int64)
+    masks = np.zeros((n_sets, 2), dtype=np.uint64)
+    np.bitwise_or.at(masks, (set_idx, pitches >> 6), 
+                     np.left_shift(np.uint64(1), 
+                                   (pitches & 63).astype(np.uint64)))
+    return masks
+
+
+def _is_pitch_like(values):
+    """
+    check that all values are integers in [0, 128)
+    """
+    try:
+        values = np.asarray(values, dtype=float)
+    except (TypeError, ValueError):
+        return False
+    return values.ndim == 1 and bool(np.all((values >= 0) & 
+                                            (values < 128) & 
+                                            (values == np.round(values))))
+
+
+def _set_masks(elements, sets):
+    """
+    128 bit masks of the sets or None if the 
+    elements or sets are not integers in [0, 128).
+    """
+    if not _is_pitch_like(elements):
+        return None
+    if isinstance(sets, np.ndarray) and sets.dtype == np.uint64:
+        return sets
+    if not all(isinstance(set_, (set, frozenset)) and _is_pitch_like(list(set_)) 
+               for set_ in sets):
+        return None
+    return pitch_set_masks(sets)
+
+
 def l2(vec1, vec2):
     """
     l2 metric between vec1 and vec2
@@ -30,78 +112,653 @@ def l2(vec1, vec2):
     return np.sqrt(np.sum((vec2 - vec1)**2))
 
 
+################################### METRIC REGISTRY ###################################
+
+
+def _pairwise_elements(arr1, arr2):
+    """
+    views of arr1 and arr2 broadcasting to 
+    (len(arr1), len(arr2), element dimensions)
+    """
+    arr1 = np.asarray(arr1)
+    arr2 = np.asarray(arr2)
+    ndim = max(arr1.ndim, arr2.ndim) + 1
+    elements1 = arr1.reshape((len(arr1), 1) + (1, ) * (ndim - arr1.ndim - 1) + 
+                             arr1.shape[1:])
+    elements2 = arr2.reshape((1, len(arr2)) + (1, ) * (ndim - arr2.ndim - 1) + 
+                             arr2.shape[1:])
+    return elements1, elements2
+
+
+def element_of_pairwise(arr1, arr2):
+    """
+    pairwise matrix of `element_of_metric`
+    """
+    elements1, elements2 = _pairwise_elements(arr1, arr2)
+    occurences = (elements2 == elements1).reshape(len(arr1), len(arr2), -1)
+    return 1 - np.sum(occurences, axis=2)
+
+
+def element_of_set_pairwise(elements, sets):
+    """
+    pairwise matrix of `element_of_set_metric`, by bit lookups
+    for integer elements and sets in [0, 128)
+    """
+    masks = _set_masks(elements, sets)
+    if masks is not None:
+        elements = np.asarray(elements, dtype=np.int64)
+        return element_of_set_masks(elements[:, None], masks[None, :])
+    return np.array([[element_of_set_metric(element_, set_) for set_ in sets] 
+                     for element_ in elements], dtype=float)
+
+
+def l2_pairwise(arr1, arr2):
+    """
+    pairwise matrix of `l2`
+    """
+    elements1, elements2 = _pairwise_elements(arr1, arr2)
+    squares = ((elements2 - elements1)**2).reshape(len(arr1), len(arr2), -1)
+    return np.sqrt(np.sum(squares, axis=2))
+
+
+# vectorized pairwise matrix implementations of the scalar metrics
+PAIRWISE_METRICS = {
+    element_of_metric: element_of_pairwise,
+    element_of_set_metric: element_of_set_pairwise,
+    l2: l2_pairwise,
+}
+
+
+def register_metric(metric, pairwise):
+    """
+    register a vectorized implementation of a scalar metric.
+
+    Parameters
+    ----------
+    metric : callable
+        scalar metric, metric(arr1[i], arr2[j])
+    pairwise : callable
+        pairwise(arr1, arr2) returns the (len(arr1), len(arr2))
+        matrix of metric(arr1[i], arr2[j])
+    """
+    PAIRWISE_METRICS[metric] = pairwise
+
+
+def pairwise_metric(metric):
+    """
+    vectorized implementation of a scalar metric 
+    or None if it isn't registered.
+    """
+    try:
+        return PAIRWISE_METRICS.get(metric)
+    except TypeError:
+        # unhashable metric
+        return None
+
+
 class DynamicTimeWarping(object):
     """
     pure python vanilla Dynamic Time Warping
+
+    Parameters
+    ----------
+    metric : str or callable
+        local distance metric (see `scipy.spatial.distance.cdist`)
+    cdist_local : bool
+        compute the pairwise distances with `cdist_local`
+    vectorized : bool
+        accumulate the cost matrix by anti-diagonals
+    multiscale : bool
+        coarse-to-fine alignment: the sequences are downsampled 
+        into a pyramid, aligned at the coarsest level and refined
+        inside a radius around the projected path at each 
+        finer level. The number of evaluated cells is stored in
+        `cells_evaluated` after each call.
+    radius : int
+        multiscale search radius (in frames) around the 
+        projected path
+    levels : int or None
+        maximal number of downsampling levels for the multiscale
+        mode, None: downsample as long as the sequences are longer
+        than the search window.
+    window : DTWBand, callable or None
+        search window, either a `DTWBand` or a callable 
+        returning a `DTWBand` for the shape (M, N) of the 
+        pairwise distance matrix, e.g. 
+        `functools.partial(sakoe_chiba_band, radius=10)`.
+        Cells outside of the window are never computed.
+    subsequence : {None, "X", "Y"}
+        subsequence (open begin and open end) DTW: 
+        "Y": X is aligned to a subsequence of Y, 
+        the path can start and end anywhere in Y,
+        "X": Y is aligned to a subsequence of X.
+        Not supported in the multiscale and windowed modes.
+
+    X and Y can be scipy sparse matrices (e.g. piano rolls), the 
+    "euclidean", "sqeuclidean" and "cosine" distances are then 
+    computed from sparse dot products (see `sparse_cdist`), other
+    configurations densify the inputs.
     """
     
     def __init__(self, 
                  metric= 'euclidean',
-                 cdist_local=False):
+                 cdist_local=False,
+                 vectorized=True,
+                 multiscale=False,
+                 radius=1,
+                 levels=None,
+                 window=None,
+                 subsequence=None):
         self.metric = metric
         self.cdist_local = cdist_local
+        self.vectorized = vectorized
+        self.multiscale = multiscale
+        self.radius = radius
+        self.levels = levels
+        self.window = window
+        self.subsequence = subsequence
+        self.cells_evaluated = None
 
     def __call__(self, X, Y, return_path=True,
-                 return_cost_matrix=False):
+                 return_cost_matrix=False,
+                 window=None,
+                 subsequence=None):
 
-        X = np.asanyarray(X, dtype=float)
-        Y = np.asanyarray(Y, dtype=float)
+        if window is None:
+            window = self.window
+        if not self._sparse_supported(X, Y) or \
+            self.multiscale or window is not None:
+            X = _dense(X)
+            Y = _dense(Y)
+        if subsequence is None:
+            subsequence = self.subsequence
+        if subsequence is not None and (self.multiscale or window is not None):
+            raise ValueError("subsequence DTW is not supported in the "
+                             "multiscale and windowed modes")
+        if self.multiscale:
+            return self._multiscale_call(X, Y, 
+                                         return_path=return_path,
+                                         return_cost_matrix=return_cost_matrix)
+        if window is not None:
+            band = resolve_window(window, len(X), len(Y))
+            pdist = band.pairwise_distances(X, Y, self.metric, 
+                                            local_metric=self.cdist_local)
+            self.cells_evaluated = band.size
+            return banded_dtw_output(band, pdist, 
+                                     return_path=return_path,
+                                     return_cost_matrix=return_cost_matrix)
         # Compute pairwise distance
-        if self.cdist_local:
-            D = cdist_local(X, Y, self.metric)
-        else:
-            D = cdist(X, Y, self.metric)
+        D = self._pairwise(X, Y)
+        self.cells_evaluated = D.size
+        if subsequence is not None:
+            return subsequence_dtw_output(D, subsequence,
+                                          return_path=return_path,
+                                          return_cost_matrix=return_cost_matrix)
         # Compute accumulated cost matrix
-        dtwd_matrix = dtw_dmatrix_from_pairwise_dmatrix(D)
-        dtwd_distance = dtwd_matrix[-1, -1]
+        if self.vectorized:
+            # only the step directions are kept unless 
+            # the cost matrix is requested
+            dtwd_last_row, directions, dtwd_matrix = dtw_directions_wavefront(
+                D, return_cost_matrix=return_cost_matrix)
+            dtwd_distance = dtwd_last_row[-1]
+        else:
+            dtwd_matrix = dtw_dmatrix_from_pairwise_dmatrix(D)
+            dtwd_distance = dtwd_matrix[-1, -1]
+        del D
 
         # Output
         out = (dtwd_distance, )
 
         if return_path:
             # Compute alignment path
-            path = dtw_backtracking(dtwd_matrix)
+            if self.vectorized:
+                path = dtw_backtracking_directions(directions)
+            else:
+                path = dtw_backtracking(dtwd_matrix)
             out += (path,)
         if return_cost_matrix:
             out += (dtwd_matrix, )
         return out
 
+    def _multiscale_call(self, X, Y, 
+                         return_path=True,
+                         return_cost_matrix=False):
+        
+        # build the pyramid, finest level first
+        pyramid = [(X, Y)]
+        min_length = self.radius + 2
+        while (self.levels is None or len(pyramid) <= self.levels) and \
+            min(len(pyramid[-1][0]), len(pyramid[-1][1])) > min_length:
+            pyramid.append((downsample_sequence(pyramid[-1][0]),
+                            downsample_sequence(pyramid[-1][1])))
+
+        # full alignment at the coarsest level
+        X_c, Y_c = pyramid[-1]
+        D = self._pairwise(X_c, Y_c)
+        cells_evaluated = D.size
+        dtwd_last_row, directions, dtwd_matrix = dtw_directions_wavefront(
+            D, return_cost_matrix=return_cost_matrix)
+        dtwd_distance = dtwd_last_row[-1]
+        path = dtw_backtracking_directions(directions)
+        band = None
+
+        # refine inside a window around the projected path
+        for X_l, Y_l in pyramid[-2::-1]:
+            lo, hi = band_from_projected_path(path, 
+                                              len(X_l), 
+                                              len(Y_l), 
+                                              self.radius)
+            band = DTWBand(lo, hi, len(Y_l))
+            pdist = band.pairwise_distances(X_l, Y_l, self.metric, 
+                                            local_metric=self.cdist_local)
+            acc, directions = band.accumulate(pdist, return_directions=True)
+            path = band.backtracking(directions)
+            dtwd_distance = acc[-1]
+            cells_evaluated += band.size
+        
+        self.cells_evaluated = cells_evaluated
+
+        # Output
+        out = (dtwd_distance, )
+
+        if return_path:
+            out += (path,)
+        if return_cost_matrix:
+            if band is None:
+                out += (dtwd_matrix, )
+            else:
+                out += (band.to_dense(acc), )
+        return out
+
+    def batch(self, pairs, return_path=True, n_jobs=1, chunk_size=64):
+        """
+        align many (X, Y) pairs, see `dtw_batch`.
+        """
+        return dtw_batch(self, pairs, return_path=return_path, 
+                         n_jobs=n_jobs, chunk_size=chunk_size)
+
+    def _stackable(self):
+        """
+        pairs of equal shape can be accumulated together
+        """
+        return not self.multiscale and self.window is None and \
+            self.subsequence is None and self.vectorized
+
+    def _sparse_supported(self, X, Y):
+        """
+        X or Y are sparse and the distances can be computed 
+        without densifying them
+        """
+        return (issparse(X) or issparse(Y)) and not self.cdist_local and \
+            isinstance(self.metric, str) and self.metric in SPARSE_METRICS
+
+    def _pairwise(self, X, Y):
+        """
+        pairwise distance matrix of X and Y
+        """
+        if self._sparse_supported(X, Y):
+            return sparse_cdist(X, Y, self.metric)
+        X = _dense(X)
+        Y = _dense(Y)
+        if self.cdist_local:
+            return cdist_local(X, Y, self.metric)
+        return cdist(X, Y, self.metric)
+
+    def distance(self, X, Y, threshold=np.inf, block_rows=32):
+        """
+        DTW distance only, with lower bound pruning (`lb_kim`, 
+        `lb_keogh`) and early abandoning: the accumulated costs are
+        computed by blocks of rows, and the computation stops as soon
+        as a row has no accumulated cost below `threshold`.
+
+        Parameters
+        ----------
+        X, Y : np.ndarray
+            input and reference sequences
+        threshold : float
+            best-so-far distance
+        block_rows : int
+            number of rows computed at once
+
+        Returns
+        -------
+        dtwd_distance : float
+            the DTW distance, or np.inf if it is larger
+            than `threshold`
+        """
+        X = _dense(X)
+        Y = _dense(Y)
+        self.cells_evaluated = 0
+        if self.subsequence is None and \
+            lower_bound(X, Y, self.metric, self.cdist_local) > threshold:
+            return np.inf
+        if self.multiscale or self.window is not None or \
+            self.subsequence is not None:
+            dtwd_distance = self(X, Y, return_path=False)[0]
+            return dtwd_distance if dtwd_distance <= threshold else np.inf
+
+        M = X.shape[0]
+        N = Y.shape[0]
+        row = np.ones(N + 1, dtype=float) * np.inf
+        row[0] = 0
+        for start in range(0, M, block_rows):
+            stop = min(start + block_rows, M)
+            strip = np.ones((stop - start + 1, N + 1), dtype=float) * np.inf
+            strip[0] = row
+            if self.cdist_local:
+                D = cdist_local(X[start:stop], Y, self.metric)
+            else:
+                D = cdist(X[start:stop], Y, self.metric)
+            _wavefront_accumulate(strip, np.ascontiguousarray(D))
+            self.cells_evaluated += D.size
+            row = strip[-1]
+            # every path crosses every row
+            if row[1:].min() > threshold:
+                return np.inf
+        return row[-1] if row[-1] <= threshold else np.inf
+
+    def rank(self, X, candidates, k=1):
+        """
+        rank candidate sequences (e.g. score sections or versions)
+        by their DTW distance to X. Candidates are visited in 
+        order of their lower bounds, the k best distances found so far
+        are used to prune candidates and abandon computations.
+
+        Parameters
+        ----------
+        X : np.ndarray
+            query sequence
+        candidates : list of np.ndarray
+            candidate reference sequences
+        k : int or None
+            number of best candidates to find, None: all 
+            distances are computed
+
+        Returns
+        -------
+        ranking : np.ndarray
+            indices of the (k) best candidates, by increasing 
+            distance (ties: by index)
+        distances : np.ndarray
+            DTW distances of the candidates, np.inf for pruned 
+            or abandoned candidates
+        """
+        X = _dense(X)
+        n_candidates = len(candidates)
+        if k is None:
+            k = n_candidates
+        if self.subsequence is None:
+            bounds = np.array([lower_bound(X, _dense(Y), 
+                                           self.metric, self.cdist_local)
+                               for Y in candidates])
+        else:
+            bounds = np.zeros(n_candidates)
+        distances = np.ones(n_candidates, dtype=float) * np.inf
+        best = []
+        cells_evaluated = 0
+        for idx in np.argsort(bounds, kind="stable"):
+            threshold = best[k - 1] if len(best) >= k else np.inf
+            if bounds[idx] > threshold:
+                break
+            distances[idx] = self.distance(X, candidates[idx], 
+                                           threshold=threshold)
+            cells_evaluated += self.cells_evaluated
+            if np.isfinite(distances[idx]):
+                best = sorted(best + [distances[idx]])[:k]
+        self.cells_evaluated = cells_evaluated
+        ranking = np.lexsort((np.arange(n_candidates), distances))[:k]
+        ranking = ranking[np.isfinite(distances[ranking])]
+        return ranking, distances
+
 # alias
 DTW = DynamicTimeWarping
 
 class DynamicTimeWarpingSingleLoop(object):
     """
     pure python vanilla Dynamic Time Warping
+
+    With the default `element_of_set_metric`, integer elements 
+    in [0, 128) (e.g. MIDI pitches) and sets of such integers 
+    (or their 128 bit masks, see `pitch_set_masks`) the pairwise 
+    costs are computed by vectorized bit lookups. Metrics with 
+    a registered pairwise implementation (see `register_metric`)
+    are computed as a matrix and accumulated by anti-diagonals,
+    other metrics are called in a Python loop.
+
+    Parameters
+    ----------
+    metric : callable
+        local distance metric
+    window : DTWBand, callable or None
+        search window (see `DynamicTimeWarping`)
+    subsequence : {None, "X", "Y"}
+        subsequence DTW (see `DynamicTimeWarping`), 
+        not supported with a window
     """
     
     def __init__(self, 
-                 metric=element_of_set_metric):
+                 metric=element_of_set_metric,
+                 window=None,
+                 subsequence=None):
                 self.metric = metric
+                self.window = window
+                self.subsequence = subsequence
 
     def __call__(self, 
                  X, Y, 
                  return_path=True,
-                 return_cost_matrix=False):
+                 return_cost_matrix=False,
+                 window=None,
+                 subsequence=None):
 
-       # Compute the pw distances and accumulated cost matrix
-        dtwd_matrix = cdist_dtw_single_loop(X, Y, self.metric)
-        
-        # dtwd_matrix = dtw_dmatrix_from_pairwise_dmatrix(D)
-        dtwd_distance = dtwd_matrix[-1, -1]
+        masks = self._set_masks(X, Y)
+        if masks is not None:
+            X = np.asarray(X, dtype=np.int64)
+
+        if window is None:
+            window = self.window
+        if subsequence is None:
+            subsequence = self.subsequence
+        if subsequence is not None:
+            if window is not None:
+                raise ValueError("subsequence DTW is not supported "
+                                 "with a window")
+            D = self._pairwise(X, Y)
+            return subsequence_dtw_output(D, subsequence,
+                                          return_path=return_path,
+                                          return_cost_matrix=return_cost_matrix)
+        if window is not None:
+            band = resolve_window(window, len(X), len(Y))
+            if masks is not None:
+                rows, cols = band.cell_indices()
+                pdist = element_of_set_masks(X[rows], masks[cols])
+            else:
+                pdist = band.pairwise_distances(X, Y, self.metric, 
+                                                local_metric=True)
+            return banded_dtw_output(band, pdist, 
+                                     return_path=return_path,
+                                     return_cost_matrix=return_cost_matrix)
+
+        if masks is not None or pairwise_metric(self.metric) is not None:
+            D = self._pairwise(X, Y)
+            dtwd_last_row, directions, dtwd_matrix = dtw_directions_wavefront(
+                D, return_cost_matrix=return_cost_matrix)
+            dtwd_distance = dtwd_last_row[-1]
+        else:
+           # Compute the pw distances and accumulated cost matrix
+            dtwd_matrix, directions = cdist_dtw_single_loop(
+                X, Y, self.metric, return_directions=True)
+            
+            # dtwd_matrix = dtw_dmatrix_from_pairwise_dmatrix(D)
+            dtwd_distance = dtwd_matrix[-1, -1]
 
         # Output
         out = (dtwd_distance, )
 
         if return_path:
             # Compute alignment path
-            path = dtw_backtracking(dtwd_matrix)
+            path = dtw_backtracking_directions(directions)
             out += (path,)
         if return_cost_matrix:
             out += (dtwd_matrix, )
         return out
+
+    def _set_masks(self, X, Y):
+        """
+        128 bit masks of the sets in Y or None if the 
+        pairwise costs can't be computed by bit lookups.
+        """
+        if self.metric is not element_of_set_metric:
+            return None
+        return _set_masks(X, Y)
+
+    def batch(self, pairs, return_path=True, n_jobs=1, chunk_size=64):
+        """
+        align many (X, Y) pairs, see `dtw_batch`.
+        """
+        return dtw_batch(self, pairs, return_path=return_path, 
+                         n_jobs=n_jobs, chunk_size=chunk_size)
+
+    def _stackable(self):
+        """
+        pairs of equal shape can be accumulated together
+        """
+        return self.window is None and self.subsequence is None
+
+    def _pairwise(self, X, Y):
+        """
+        pairwise distance matrix of X and Y
+        """
+        masks = self._set_masks(X, Y)
+        if masks is not None:
+            X = np.asarray(X, dtype=np.int64)
+            return element_of_set_masks(X[:, None], masks[None, :])
+        pairwise = pairwise_metric(self.metric)
+        if pairwise is not None:
+            return np.asarray(pairwise(X, Y), dtype=float)
+        return np.array([[self.metric(x, y) for y in Y] for x in X], 
+                        dtype=float)
     
 # alias
 DTWSL = DynamicTimeWarpingSingleLoop
+
+
+class DynamicTimeWarpingLinearMemory(object):
+    """
+    Dynamic Time Warping in linear memory
+
+    The path is recovered without keeping the accumulated
+    (or pairwise) cost matrix: rows are recomputed in a 
+    divide and conquer fashion, only a block of 
+    `block_rows` rows and one row per recursion level are
+    kept in memory. Distance and path are identical to 
+    `DynamicTimeWarping`, at the cost of O(log(M)) passes 
+    over the cost matrix.
+
+    Parameters
+    ----------
+    metric : str or callable
+        local distance metric (see `scipy.spatial.distance.cdist`)
+    block_rows : int
+        number of rows computed at once
+    """
+    def __init__(self, 
+                 metric='euclidean',
+                 block_rows=128):
+        self.metric = metric
+        self.block_rows = block_rows
+
+    def __call__(self, X, Y, return_path=True,
+                 return_cost_matrix=False):
+        
+        if return_cost_matrix:
+            raise ValueError("DynamicTimeWarpingLinearMemory does not keep the cost matrix")
+
+        X = np.asanyarray(X, dtype=float)
+        Y = np.asanyarray(Y, dtype=float)
+        self._X = X
+        self._Y = Y
+        M = X.shape[0]
+        N = Y.shape[0]
+        # the padded boundary row above the first row
+        top = np.ones(N + 1, dtype=float) * np.inf
+        top[0] = 0
+        
+        if not return_path:
+            dtwd_distance = self._forward(top, 0, M)[-1]
+            return (dtwd_distance, )
+
+        path = [[M - 1, N - 1]]
+        self._distance = None
+        self._backtrack(top, 0, M - 1, N - 1, path)
+        return (self._distance, np.array(path[::-1], dtype=int))
+
+    def batch(self, pairs, return_path=True, n_jobs=1, chunk_size=64):
+        """
+        align many (X, Y) pairs, see `dtw_batch`.
+        """
+        return dtw_batch(self, pairs, return_path=return_path, 
+                         n_jobs=n_jobs, chunk_size=chunk_size)
+
+    def _strip(self, top, a, b):
+        """
+        padded accumulated cost of the rows a, ..., b 
+        (first row: `top`, padded row of row a - 1)
+        """
+        strip = np.ones((b - a + 2, len(top)), dtype=float) * np.inf
+        strip[0] = top
+        D = np.ascontiguousarray(cdist(self._X[a:b + 1], self._Y, self.metric))
+        _wavefront_accumulate(strip, D)
+        return strip
+
+    def _forward(self, top, a, b):
+        """
+        padded accumulated cost of row b - 1 
+        computed from the padded row of row a - 1
+        """
+        row = top
+        for start in range(a, b, self.block_rows):
+            row = self._strip(row, start, min(start + self.block_rows, b) - 1)[-1]
+        return row
+
+    def _backtrack(self, top, a, b, m, path):
+        """
+        continue the backtracking from cell (b, m) until the
+        path leaves the rows a, ..., b. Returns the column of 
+        the path in row a - 1.
+        """
+        if b - a + 1 > self.block_rows:
+            mid = (a + b) // 2
+            mid_row = self._forward(top, a, mid + 1)
+            m = self._backtrack(mid_row, mid + 1, b, m, path)
+            return self._backtrack(top, a, mid, m, path)
+
+        strip = self._strip(top, a, b)
+        if b == self._X.shape[0] - 1:
+            self._distance = strip[-1, -1]
+        n = b
+        while n >= a and not (n == 0 and m == 0):
+            if n == 0:
+                m = m - 1
+            elif m == 0:
+                n = n - 1
+            else:
+                # rows of the strip are shifted by one and padded
+                candidates = (strip[n - a, m], 
+                              strip[n - a, m + 1], 
+                              strip[n - a + 1, m])
+                p_l_i = np.argmin(candidates)
+                if p_l_i == 0:
+                    n, m = n - 1, m - 1
+                elif p_l_i == 1:
+                    n = n - 1
+                else:
+                    m = m - 1
+            path.append([n, m])
+        return m
+
+# alias
+DTWLM = DynamicTimeWarpingLinearMemory
     
 def dtw_backtracking(dtwd):
     """
@@ -179,6 +836,644 @@ def dtw_backtracking(dtwd):
 
     return np.array(path[::-1], dtype=int)
 
+class DTWBand(object):
+    """
+    A DTW search window given by per-row column bounds:
+    row i of the accumulated cost matrix holds the columns
+    lo[i] <= j < hi[i]. Only the cells inside the band are 
+    stored (row after row in a flat array) and visited.
+
+    Parameters
+    ----------
+    lo : np.ndarray
+        first column in the band for each row
+    hi : np.ndarray
+        one past the last column in the band for each row
+    N : int
+        number of columns of the full matrix
+    """
+    def __init__(self, lo, hi, N):
+        self.lo, self.hi = _regularize_band(lo, hi, N)
+        self.M = len(self.lo)
+        self.N = N
+        self.offsets = np.r_[0, np.cumsum(self.hi - self.lo)]
+
+    @property
+    def size(self):
+        """The number of cells in the band
+        """
+        return self.offsets[-1]
+
+    def cell_indices(self):
+        """
+        row and column indices of all the cells in the band
+        """
+        rows = np.repeat(np.arange(self.M), self.hi - self.lo)
+        cols = np.arange(self.size) - self.offsets[rows] + self.lo[rows]
+        return rows, cols
+
+    def index(self, i, j):
+        """
+        flat index of cell (i, j), an IndexError is raised 
+        if it is outside of the band
+        """
+        if 0 <= i < self.M and self.lo[i] <= j < self.hi[i]:
+            return self.offsets[i] + j - self.lo[i]
+        raise IndexError("cell ({0}, {1}) is outside of the band".format(i, j))
+
+    def pairwise_distances(self, X, Y, metric, local_metric=False):
+        """
+        pairwise distances of the cells in the band
+        (computed row by row, with the scalar or registered pairwise
+        metric if `local_metric`).
+        """
+        pdist = np.empty(self.size, dtype=float)
+        pairwise = pairwise_metric(metric) if local_metric else None
+        for i in range(self.M):
+            row = slice(self.offsets[i], self.offsets[i + 1])
+            if pairwise is not None:
+                pdist[row] = pairwise(X[i:i+1], Y[self.lo[i]:self.hi[i]])[0]
+            elif local_metric:
+                pdist[row] = [metric(X[i], Y[j]) 
+                              for j in range(self.lo[i], self.hi[i])]
+            else:
+                pdist[row] = cdist(X[i:i+1], Y[self.lo[i]:self.hi[i]], metric)[0]
+        return pdist
+
+    def accumulate(self, pdist, return_directions=False):
+        """
+        compute the accumulated cost of the cells in the band
+        by anti-diagonals.
+
+        Parameters
+        ----------
+        pdist : np.ndarray
+            pairwise distances of the cells in the band
+            (computed e.g., with `pairwise_distances`)
+        return_directions : bool
+            also return the step directions of the cells
+            (see `dtw_directions_wavefront`)
+
+        Returns
+        -------
+        acc : np.ndarray
+            accumulated cost of the cells in the band
+        directions : np.ndarray
+            step direction codes of the cells in the band
+        """
+        size = self.size
+        inf_slot = size
+        zero_slot = size + 1
+        rows, cols = self.cell_indices()
+        cells = np.arange(size)
+
+        # neighbor indices, out of band neighbors point at inf_slot
+        prev_lo = np.r_[0, self.lo[:-1]][rows]
+        prev_hi = np.r_[0, self.hi[:-1]][rows]
+        prev_offsets = np.r_[0, self.offsets[:-2]][rows]
+        has_prev = rows > 0
+        up_ok = has_prev & (prev_lo <= cols) & (cols < prev_hi)
+        diag_ok = has_prev & (prev_lo <= cols - 1) & (cols - 1 < prev_hi)
+        left_ok = cols - 1 >= self.lo[rows]
+        insertion = np.where(up_ok, prev_offsets + cols - prev_lo, inf_slot)
+        deletion = np.where(left_ok, cells - 1, inf_slot)
+        match = np.where(diag_ok, prev_offsets + cols - 1 - prev_lo, inf_slot)
+        match[0] = zero_slot
+
+        # group the cells by anti-diagonal
+        order = np.argsort(rows + cols, kind="stable")
+        bounds = np.r_[0, np.cumsum(np.bincount(rows + cols))]
+        insertion = insertion[order]
+        deletion = deletion[order]
+        match = match[order]
+        pdist = pdist[order]
+
+        acc = np.empty(size + 2, dtype=float)
+        acc[inf_slot] = np.inf
+        acc[zero_slot] = 0
+        if return_directions:
+            directions = np.empty(size, dtype=np.int8)
+        for d in range(len(bounds) - 1):
+            diag = slice(bounds[d], bounds[d + 1])
+            insertion_d = acc[insertion[diag]]
+            deletion_d = acc[deletion[diag]]
+            match_d = acc[match[diag]]
+            acc[order[diag]] = pdist[diag] + \
+                np.minimum(np.minimum(insertion_d, deletion_d), match_d)
+            if return_directions:
+                directions[order[diag]] = _step_directions(insertion_d, 
+                                                           deletion_d, 
+                                                           match_d)
+        if return_directions:
+            return acc[:size], directions
+        return acc[:size]
+
+    def backtracking(self, directions):
+        """
+        Decode path from the step directions of the band
+        (computed with `accumulate`), a ValueError is raised
+        if no path of finite cost reaches the last cell.
+        """
+        n = self.M - 1
+        m = self.N - 1
+        path = [[n, m]]
+        while not (n == 0 and m == 0):
+            direction = directions[self.index(n, m)]
+            if direction == 0:
+                n, m = n - 1, m - 1
+            elif direction == 1:
+                n = n - 1
+            elif direction == 2:
+                m = m - 1
+            else:
+                raise ValueError("no path of finite cost in the band reaches "
+                                 "the cell ({0}, {1})".format(*path[0]))
+            path.append([n, m])
+        return np.array(path[::-1], dtype=int)
+    
+    def to_dense(self, values, fill_value=np.inf):
+        """
+        dense (M, N) matrix of band values
+        """
+        dense = np.full((self.M, self.N), fill_value, dtype=float)
+        rows, cols = self.cell_indices()
+        dense[rows, cols] = values
+        return dense
+
+
+def sakoe_chiba_band(M, N, radius):
+    """
+    Sakoe-Chiba band: all cells within `radius` columns
+    of the (scaled) diagonal of a (M, N) matrix.
+
+    Parameters
+    ----------
+    M : int
+        number of rows
+    N : int
+        number of columns
+    radius : int
+        half width of the band
+
+    Returns
+    -------
+    band : DTWBand
+    """
+    center = np.linspace(0, N - 1, M)
+    lo = np.ceil(center - radius)
+    hi = np.floor(center + radius) + 1
+    return DTWBand(lo, hi, N)
+
+
+def itakura_band(M, N, slope=2.0):
+    """
+    Itakura parallelogram: all cells reachable from (0, 0) 
+    and (M-1, N-1) with local slopes between 1/slope and slope
+    (in the coordinates normalized to the unit square).
+
+    Parameters
+    ----------
+    M : int
+        number of rows
+    N : int
+        number of columns
+    slope : float
+        maximal slope of the parallelogram (> 1)
+
+    Returns
+    -------
+    band : DTWBand
+    """
+    x = np.linspace(0, 1, M)
+    lower = np.maximum(x / slope, 1 - slope * (1 - x))
+    upper = np.minimum(x * slope, 1 - (1 - x) / slope)
+    lo = np.ceil(lower * (N - 1) - 1e-9)
+    hi = np.floor(upper * (N - 1) + 1e-9) + 1
+    return DTWBand(lo, hi, N)
+
+
+def band_from_path(path, M, N, radius):
+    """
+    band around a prior path, e.g. an upsampled coarse 
+    path or anchor times converted to frames.
+
+    Parameters
+    ----------
+    path : np.ndarray
+        A 2D array of size (n_steps, 2) of (row, column) 
+        coordinates. Coordinates can be fractional, rows 
+        not covered by the path are linearly interpolated.
+    M : int
+        number of rows
+    N : int
+        number of columns
+    radius : int
+        number of cells added around the path in both 
+        directions
+
+    Returns
+    -------
+    band : DTWBand
+    """
+    path = np.asarray(path, dtype=float)
+    path = path[np.argsort(path[:, 0], kind="stable")]
+    rows = np.arange(M)
+    center = np.interp(rows, path[:, 0], path[:, 1])
+    lo = np.floor(center)
+    hi = np.ceil(center) + 1
+    path_rows = np.round(path[:, 0]).astype(int)
+    in_range = (path_rows >= 0) & (path_rows < M)
+    np.minimum.at(lo, path_rows[in_range], np.floor(path[in_range, 1]))
+    np.maximum.at(hi, path_rows[in_range], np.ceil(path[in_range, 1]) + 1)
+    if radius > 0:
+        size = 2 * radius + 1
+        lo = minimum_filter1d(lo, size, mode="nearest") - radius
+        hi = maximum_filter1d(hi, size, mode="nearest") + radius
+    return DTWBand(lo, hi, N)
+
+
+def resolve_window(window, M, N):
+    """
+    get the `DTWBand` of a window argument for 
+    a (M, N) pairwise distance matrix.
+    """
+    if callable(window):
+        window = window(M, N)
+    if not isinstance(window, DTWBand):
+        raise ValueError("window has to be a DTWBand or a callable returning one")
+    if window.M != M or window.N != N:
+        raise ValueError("window shape {0} does not match the sequence lengths {1}".format(
+            (window.M, window.N), (M, N)))
+    return window
+
+
+SPARSE_METRICS = ("euclidean", "sqeuclidean", "cosine")
+
+
+def sparse_cdist(A, B, metric="euclidean"):
+    """
+    pairwise distances between the rows of (sparse) matrices
+    computed from sparse dot products and norms, without 
+    densifying the inputs.
+
+    Parameters
+    ----------
+    A, B : scipy.sparse matrix or np.ndarray
+        (M, K) and (N, K) feature matrices, e.g. transposed 
+        piano rolls
+    metric : {"euclidean", "sqeuclidean", "cosine"}
+        distance metric (see `scipy.spatial.distance.cdist`)
+
+    Returns
+    -------
+    D : np.ndarray
+        (M, N) pairwise distance matrix
+    """
+    if metric not in SPARSE_METRICS:
+        raise ValueError("sparse_cdist supports the metrics {0}, got {1}".format(
+            SPARSE_METRICS, metric))
+    A = csr_matrix(A, dtype=float)
+    B = csr_matrix(B, dtype=float)
+    dots = (A @ B.T).toarray()
+    squares_A = np.asarray(A.multiply(A).sum(axis=1)).ravel()
+    squares_B = np.asarray(B.multiply(B).sum(axis=1)).ravel()
+    if metric == "cosine":
+        norms = np.sqrt(squares_A)[:, None] * np.sqrt(squares_B)[None, :]
+        # nan for frames without active pitches, like cdist
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return 1 - dots / norms
+    squares = np.maximum(squares_A[:, None] + squares_B[None, :] - 2 * dots, 0)
+    if metric == "sqeuclidean":
+        return squares
+    return np.sqrt(squares)
+
+
+def _dense(X):
+    """
+    dense float array of a (sparse) sequence
+    """
+    if issparse(X):
+        return X.toarray().astype(float)
+    return np.asanyarray(X, dtype=float)
+
+
+def lb_kim(X, Y, metric="euclidean", local_metric=False):
+    """
+    LB_Kim lower bound of the DTW distance: every path 
+    contains the first and the last cell.
+    """
+    pairs = [(X[:1], Y[:1])]
+    if len(X) > 1 or len(Y) > 1:
+        pairs.append((X[-1:], Y[-1:]))
+    if local_metric:
+        return sum(metric(x[0], y[0]) for x, y in pairs)
+    return sum(cdist(x, y, metric)[0, 0] for x, y in pairs)
+
+
+# distance of the frames to the envelope for metrics 
+# that can't be smaller than the distance to the envelope
+_ENVELOPE_DISTANCES = {
+    "euclidean": lambda gap: np.sqrt(np.sum(gap ** 2, axis=1)),
+    "sqeuclidean": lambda gap: np.sum(gap ** 2, axis=1),
+    "cityblock": lambda gap: np.sum(gap, axis=1),
+    "chebyshev": lambda gap: np.max(gap, axis=1),
+}
+
+
+def lb_keogh(X, Y, metric="euclidean"):
+    """
+    LB_Keogh lower bound of the (unconstrained) DTW distance:
+    every frame of X is matched to at least one frame of Y, and 
+    can't be closer to it than to the envelope (the per-dimension
+    minimum and maximum) of Y. Returns 0 for metrics without 
+    an envelope distance.
+    """
+    if not isinstance(metric, str) or metric not in _ENVELOPE_DISTANCES \
+            or X.ndim != 2 or Y.ndim != 2:
+        return 0.0
+    lower = Y.min(axis=0)
+    upper = Y.max(axis=0)
+    gap = np.maximum(np.maximum(lower - X, X - upper), 0)
+    return np.sum(_ENVELOPE_DISTANCES[metric](gap))
+
+
+def lower_bound(X, Y, metric="euclidean", local_metric=False):
+    """
+    best of the `lb_kim` and (symmetric) `lb_keogh` lower bounds
+    of the DTW distance of X and Y, for non-negative metrics.
+    """
+    bound = lb_kim(X, Y, metric, local_metric)
+    if not local_metric:
+        keogh = max(lb_keogh(X, Y, metric), lb_keogh(Y, X, metric))
+        # guard against rounding differences with cdist
+        bound = max(bound, keogh * (1 - 1e-9))
+    return bound
+
+
+def banded_dtw_output(band, pdist, 
+                      return_path=True, 
+                      return_cost_matrix=False):
+    """
+    accumulate the pairwise distances of a band
+    and format the output like the DTW classes.
+    """
+    acc, directions = band.accumulate(pdist, return_directions=True)
+    out = (acc[-1], )
+    if return_path:
+        out += (band.backtracking(directions), )
+    if return_cost_matrix:
+        out += (band.to_dense(acc), )
+    return out
+
+
+def dtw_batch(dtw, pairs, return_path=True, n_jobs=1, chunk_size=64):
+    """
+    align many (X, Y) pairs with a DTW object.
+
+    Pairs with pairwise distance matrices of equal shape are 
+    accumulated together as a stack of matrices (if the DTW 
+    configuration allows it, see `dtw_directions_wavefront`), 
+    the others one by one. Chunks of at most `chunk_size` pairs
+    are distributed to a pool of `n_jobs` processes.
+
+    Parameters
+    ----------
+    dtw : DynamicTimeWarping, DynamicTimeWarpingSingleLoop or 
+        DynamicTimeWarpingLinearMemory
+        the (picklable, if n_jobs != 1) DTW object
+    pairs : list of tuples
+        (X, Y) sequence pairs
+    return_path : bool
+        also return the paths
+    n_jobs : int or None
+        number of processes, None: one per CPU
+    chunk_size : int
+        maximal number of pairs per task
+
+    Returns
+    -------
+    distances : np.ndarray
+        DTW distances of the pairs, in input order
+    paths : list of np.ndarray
+        alignment paths of the pairs, in input order 
+        (if `return_path`)
+    """
+    pairs = list(pairs)
+    stackable = getattr(dtw, "_stackable", lambda: False)()
+    tasks = []
+    if stackable:
+        groups = defaultdict(list)
+        for idx, (X, Y) in enumerate(pairs):
+            groups[X.shape[0] if issparse(X) else len(X), 
+                   Y.shape[0] if issparse(Y) else len(Y)].append(idx)
+        for idxs in groups.values():
+            for start in range(0, len(idxs), chunk_size):
+                tasks.append(idxs[start:start + chunk_size])
+    else:
+        idxs = list(range(len(pairs)))
+        tasks = [idxs[start:start + chunk_size] 
+                 for start in range(0, len(idxs), chunk_size)]
+
+    task_args = [(dtw, [pairs[idx] for idx in idxs], stackable, return_path) 
+                 for idxs in tasks]
+    if n_jobs == 1 or len(tasks) <= 1:
+        task_results = [_dtw_batch_task(*args) for args in task_args]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            task_results = list(executor.map(_dtw_batch_task, 
+                                             *zip(*task_args)))
+
+    distances = np.empty(len(pairs), dtype=float)
+    paths = [None] * len(pairs)
+    for idxs, (task_distances, task_paths) in zip(tasks, task_results):
+        distances[idxs] = task_distances
+        for idx, path in zip(idxs, task_paths):
+            paths[idx] = path
+
+    if return_path:
+        return distances, paths
+    return (distances, )
+
+
+def _dtw_batch_task(dtw, pairs, stackable, return_path):
+    """
+    distances and paths of a chunk of pairs 
+    (of equal shape if `stackable`)
+    """
+    if stackable and len(pairs) > 1:
+        D = np.stack([dtw._pairwise(X, Y) for X, Y in pairs])
+        dtwd_last_rows, directions, _ = dtw_directions_wavefront(D)
+        distances = dtwd_last_rows[:, -1]
+        if return_path:
+            paths = [dtw_backtracking_directions(pair_directions) 
+                     for pair_directions in directions]
+        else:
+            paths = [None] * len(pairs)
+        return distances, paths
+
+    outs = [dtw(X, Y, return_path=return_path) for X, Y in pairs]
+    distances = np.array([out[0] for out in outs], dtype=float)
+    paths = [out[1] if return_path else None for out in outs]
+    return distances, paths
+
+
+def subsequence_dtw_output(D, subsequence, 
+                           return_path=True, 
+                           return_cost_matrix=False):
+    """
+    Subsequence DTW output (distance, path, cost matrix) 
+    from a pairwise distance matrix.
+
+    Parameters
+    ----------
+    D : np.ndarray
+        pairwise distance matrix of X and Y
+    subsequence : {"X", "Y"}
+        the sequence in which the other one is located,
+        the path starts and ends at the cells of minimal 
+        accumulated cost on its first and last frames.
+    """
+    if subsequence not in ("X", "Y"):
+        raise ValueError('subsequence must be None, "X" or "Y", '
+                         'got {0}'.format(subsequence))
+    if subsequence == "X":
+        D = D.T
+    dtwd_last_row, directions, dtwd_matrix = dtw_directions_wavefront(
+        D, return_cost_matrix=return_cost_matrix, subsequence=True)
+    end = int(np.argmin(dtwd_last_row))
+    out = (dtwd_last_row[end], )
+    if return_path:
+        path = dtw_backtracking_directions(directions, end=end, 
+                                           subsequence=True)
+        if subsequence == "X":
+            path = np.ascontiguousarray(path[:, ::-1])
+        out += (path, )
+    if return_cost_matrix:
+        out += (dtwd_matrix.T if subsequence == "X" else dtwd_matrix, )
+    return out
+
+
+def _regularize_band(lo, hi, N):
+    """
+    make row bounds monotonic and connected, such that 
+    the band contains a path from (0, 0) to (M-1, N-1).
+    """
+    lo = np.clip(np.asarray(lo, dtype=int), 0, N - 1)
+    hi = np.clip(np.asarray(hi, dtype=int), 1, N)
+    hi = np.maximum(hi, lo + 1)
+    lo = np.minimum.accumulate(lo[::-1])[::-1]
+    hi = np.maximum.accumulate(hi)
+    lo[0] = 0
+    hi[-1] = N
+    # consecutive rows have to overlap or touch diagonally
+    lo[1:] = np.minimum(lo[1:], hi[:-1])
+    return lo, hi
+
+
+def band_from_projected_path(path, M, N, radius):
+    """
+    row bounds of the cells covered by a path 
+    computed on sequences downsampled by a factor of two,
+    projected to a (M, N) matrix and widened by `radius` cells.
+    """
+    path = np.asarray(path)
+    lo = np.full(M, N, dtype=int)
+    hi = np.zeros(M, dtype=int)
+    for di in (0, 1):
+        rows = np.minimum(2 * path[:, 0] + di, M - 1)
+        np.minimum.at(lo, rows, 2 * path[:, 1])
+        np.maximum.at(hi, rows, np.minimum(2 * path[:, 1] + 2, N))
+    if radius > 0:
+        size = 2 * radius + 1
+        lo = minimum_filter1d(lo, size, mode="nearest") - radius
+        hi = maximum_filter1d(hi, size, mode="nearest") + radius
+    return _regularize_band(lo, hi, N)
+
+
+def downsample_sequence(X):
+    """
+    halve the length of a sequence by averaging 
+    pairs of consecutive elements.
+    """
+    n = len(X) // 2
+    X_down = (X[0:2 * n:2] + X[1:2 * n:2]) / 2
+    if len(X) % 2:
+        X_down = np.concatenate((X_down, X[-1:]))
+    return X_down
+
+
+def dtw_backtracking_directions(directions, end=None, subsequence=False):
+    """
+    Decode path from the step direction matrix.
+
+    Parameters
+    ----------
+    directions : np.ndarray
+        int8 matrix of step directions (computed with 
+        `dtw_directions_wavefront`): 0 for a diagonal step,
+        1 for a step in the input array (row), 2 for a step 
+        in the reference array (column), -1 for a cell that 
+        no path of finite cost reaches.
+    end : int or None
+        column of the last cell of the path, None: last column
+    subsequence : bool
+        the path starts at the first cell of the first row
+        it reaches (instead of cell (0, 0))
+    
+    Returns
+    -------
+    path : np.ndarray
+       A 2D array of size (n_steps, 2), where i-th row has elements 
+       (i_m, i_n) where i_m represents the index in the input array
+       and i_n represents the corresponding index in the reference array.
+
+    Raises
+    ------
+    ValueError
+        if no path of finite cost reaches the last cell (the 
+        path would leave the matrix)
+    """
+    n = directions.shape[0] - 1
+    m = directions.shape[1] - 1 if end is None else end
+    path = [[n, m]]
+    while not (n == 0 and (m == 0 or subsequence)):
+        direction = directions[n, m]
+        if direction == 0:
+            n, m = n - 1, m - 1
+        elif direction == 1:
+            n = n - 1
+        elif direction == 2:
+            m = m - 1
+        else:
+            n = -1
+        if n < 0 or m < 0:
+            raise ValueError("no path of finite cost reaches the cell "
+                             "({0}, {1})".format(*path[0]))
+        path.append([n, m])
+    return np.array(path[::-1], dtype=int)
+
+
+def _step_directions(insertion, deletion, match):
+    """
+    step direction codes with the tie breaking of `dtw_backtracking`:
+    diagonal before row before column step, -1 for the cells 
+    without a predecessor of finite cost.
+    """
+    directions = np.where((match <= insertion) & (match <= deletion), 0,
+                          np.where(insertion <= deletion, 1, 2)).astype(np.int8)
+    directions[np.minimum(np.minimum(insertion, deletion), match) == np.inf] = -1
+    return directions
+
+
+def _check_distances(D):
+    """
+    raise a ValueError for NaN distances: their accumulated
+    costs and step directions are undefined
+    """
+    if np.isnan(D).any():
+        raise ValueError("the pairwise distance matrix contains NaN")
+
+
 def cdist_local(arr1, arr2, metric):
     """
     compute array of pairwise distances between 
@@ -191,7 +1486,9 @@ def cdist_local(arr1, arr2, metric):
     arr2: numpy nd array
     
     metric: callable
-        a metric function
+        a metric function, computed as a matrix if a 
+        pairwise implementation is registered 
+        (see `register_metric`)
     
     Returns
     -------
@@ -199,9 +1496,13 @@ def cdist_local(arr1, arr2, metric):
     pdist_array: numpy 2d array
         array of pairwise distances
     """
-    pdist_array = np.ones((arr1.shape[0],arr2.shape[0]))*np.inf
-    for i in range(arr1.shape[0]):
-        for j in range(arr2.shape[0]):
+    pairwise = pairwise_metric(metric)
+    if pairwise is not None:
+        # registered vectorized implementation
+        return np.asarray(pairwise(arr1, arr2), dtype=float)
+    pdist_array = np.ones((len(arr1),len(arr2)))*np.inf
+    for i in range(len(arr1)):
+        for j in range(len(arr2)):
             pdist_array[i, j] = metric(arr1[i], arr2[j])
     return pdist_array
 
@@ -238,7 +1539,157 @@ def dtw_dmatrix_from_pairwise_dmatrix(D):
 
     return (dtwd[1:, 1:])
 
-def cdist_dtw_single_loop(arr1, arr2, metric):
+def dtw_dmatrix_wavefront(D):
+    """
+    compute dynamic time warping cost matrix 
+    from a pairwise distance matrix by anti-diagonals.
+
+    Every cell of an anti-diagonal only depends on the two
+    previous anti-diagonals, so each anti-diagonal is computed
+    as a single vectorized operation. The result is identical
+    to `dtw_dmatrix_from_pairwise_dmatrix`.
+
+    Parameters
+    ----------
+    D : double array
+        Pairwise distance matrix (computed e.g., with `cdist`).
+
+    Returns
+    -------
+    dtwd : np.ndarray
+        Accumulated cost matrix
+    """
+    D = np.ascontiguousarray(D, dtype=float)
+    _check_distances(D)
+    M = D.shape[0]
+    N = D.shape[1]
+    # the dtwd distance matrix is initialized with INFINITY
+    dtwd = np.ones((M + 1, N + 1), dtype=float) * np.inf
+    dtwd[0, 0] = 0
+    _wavefront_accumulate(dtwd, D)
+    return dtwd[1:, 1:]
+
+
+def _wavefront_accumulate(dtwd, D):
+    """
+    fill the accumulated cost matrix `dtwd` (padded with one 
+    boundary row and column, which have to be initialized)
+    in place from the pairwise distance matrix `D`.
+
+    Anti-diagonals of a C-contiguous matrix are strided slices
+    of its flat buffer, so no index arrays are needed.
+    """
+    M = D.shape[0]
+    N = D.shape[1]
+    cols = N + 1
+    acc = dtwd.reshape(-1)
+    pdist = D.reshape(-1)
+    # step between consecutive cells of an anti-diagonal in D
+    d_step = max(N - 1, 1)
+    for d in range(2, M + N + 1):
+        lo = max(1, d - N)
+        hi = min(M, d - 1)
+        n = hi - lo + 1
+        # flat index of cell (lo, d - lo) in dtwd
+        start = lo * N + d
+        stop = start + (n - 1) * N + 1
+        # flat index of cell (lo - 1, d - lo - 1) in D
+        d_start = (lo - 1) * N + d - lo - 1
+        insertion = acc[start - cols:stop - cols:N]
+        deletion = acc[start - 1:stop - 1:N]
+        match = acc[start - cols - 1:stop - cols - 1:N]
+        acc[start:stop:N] = pdist[d_start:d_start + (n - 1) * d_step + 1:d_step] + \
+            np.minimum(np.minimum(insertion, deletion), match)
+
+
+def dtw_directions_wavefront(D, return_cost_matrix=False, 
+                             subsequence=False):
+    """
+    compute the accumulated costs of the last row and the
+    step direction matrix from a pairwise distance 
+    matrix by anti-diagonals.
+
+    Only the last two anti-diagonals of accumulated 
+    costs are kept, the path is decoded from the int8
+    step direction matrix (`dtw_backtracking_directions`).
+    Cells that no path of finite cost reaches (e.g. next 
+    to infinite distances) get the direction -1, NaN 
+    distances raise a ValueError.
+
+    Parameters
+    ----------
+    D : double array
+        Pairwise distance matrix (computed e.g., with `cdist`),
+        or a stack of pairwise distance matrices of equal shape 
+        (K, M, N), which are accumulated together.
+    return_cost_matrix : bool
+        also return the full accumulated cost matrix
+    subsequence : bool
+        open begin: the path can start at any cell of the 
+        first row (for non-negative distances)
+
+    Returns
+    -------
+    dtwd_last_row : np.ndarray
+        accumulated cost of the cells of the last row, the 
+        DTW distance is `dtwd_last_row[-1]`
+    directions : np.ndarray
+        int8 step direction matrix
+    dtwd : np.ndarray or None
+        Accumulated cost matrix (if `return_cost_matrix`)
+    """
+    D = np.ascontiguousarray(D, dtype=float)
+    _check_distances(D)
+    # leading dimensions of a stack of matrices
+    stack = D.shape[:-2]
+    M = D.shape[-2]
+    N = D.shape[-1]
+    directions = np.empty(D.shape, dtype=np.int8)
+    flat_directions = directions.reshape(stack + (-1, ))
+    pdist = D.reshape(stack + (-1, ))
+    d_step = max(N - 1, 1)
+    if return_cost_matrix:
+        dtwd = np.empty(D.shape, dtype=float)
+        flat_dtwd = dtwd.reshape(stack + (-1, ))
+    else:
+        dtwd = None
+
+    # anti-diagonals of the padded matrix, indexed by row
+    diagonals = [np.ones(stack + (M + 2, ), dtype=float) * np.inf 
+                 for _ in range(3)]
+    diagonals[0][..., 0] = 0
+    # padded row before the first row
+    first_row_border = 0 if subsequence else np.inf
+    diagonals[1][..., 0] = first_row_border
+    dtwd_last_row = np.empty(stack + (N, ), dtype=float)
+    for d in range(2, M + N + 1):
+        current = diagonals[d % 3]
+        previous = diagonals[(d - 1) % 3]
+        before_previous = diagonals[(d - 2) % 3]
+        lo = max(1, d - N)
+        hi = min(M, d - 1)
+        n = hi - lo + 1
+        insertion = previous[..., lo - 1:hi]
+        deletion = previous[..., lo:hi + 1]
+        match = before_previous[..., lo - 1:hi]
+        # flat index of cell (lo - 1, d - lo - 1) in D
+        d_start = (lo - 1) * N + d - lo - 1
+        cells = slice(d_start, d_start + (n - 1) * d_step + 1, d_step)
+        current[..., lo:hi + 1] = pdist[..., cells] + \
+            np.minimum(np.minimum(insertion, deletion), match)
+        # cells next to the anti-diagonal are out of the matrix 
+        current[..., lo - 1] = first_row_border if lo == 1 else np.inf
+        current[..., hi + 1] = np.inf
+        flat_directions[..., cells] = _step_directions(insertion, deletion, match)
+        if return_cost_matrix:
+            flat_dtwd[..., cells] = current[..., lo:hi + 1]
+        if hi == M:
+            dtwd_last_row[..., d - M - 1] = current[..., M]
+
+    return dtwd_last_row, directions, dtwd
+
+
+def cdist_dtw_single_loop(arr1, arr2, metric, return_directions=False):
     """
 
     compute  a pairwise distance matrix
@@ -254,10 +1705,16 @@ def cdist_dtw_single_loop(arr1, arr2, metric):
     metric> callable
         a metric function
 
+    return_directions : bool
+        also return the int8 step direction matrix
+        (see `dtw_directions_wavefront`)
+
     Returns
     -------
     dtwd : np.ndarray
         Accumulated cost matrix
+    directions : np.ndarray
+        step direction matrix (if `return_directions`)
     """
     # Initialize arrays and helper variables
     M = len(arr1) #arr1.shape[0]
@@ -266,6 +1723,7 @@ def cdist_dtw_single_loop(arr1, arr2, metric):
     # pdist_array = np.ones((M,N))*np.inf
     # the dtwd distance matrix is initialized with INFINITY
     dtwd = np.ones((M + 1, N + 1),dtype=float) * np.inf
+    directions = np.empty((M, N), dtype=np.int8)
     
     # Compute the distance iteratively
     dtwd[0, 0] = 0
@@ -278,5 +1736,15 @@ def cdist_dtw_single_loop(arr1, arr2, metric):
             deletion = dtwd[i, j - 1]
             match = dtwd[i - 1, j - 1]
             dtwd[i, j] = c + min((insertion, deletion, match))
+            if min((insertion, deletion, match)) == np.inf:
+                directions[i - 1, j - 1] = -1
+            elif match <= insertion and match <= deletion:
+                directions[i - 1, j - 1] = 0
+            elif insertion <= deletion:
+                directions[i - 1, j - 1] = 1
+            else:
+                directions[i - 1, j - 1] = 2
 
+    if return_directions:
+        return dtwd[1:, 1:], directions
     return dtwd[1:, 1:] #pdist_array
@@ -4,49 +4,94 @@
 This module contains full note matcher classes.
 """
 import numpy as np
-from scipy.interpolate import interp1d
+import warnings
+from scipy.spatial.distance import cdist
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 import time
-from itertools import combinations
-from scipy.special import binom
 
-from .dtw import DTW, DTWSL
+from .dtw import (DTW, DTWSL, indexed_pitch_set_masks, 
+                  dtw_directions_wavefront, dtw_backtracking_directions)
 from .nwtw import NW_DTW, NW
+from .utils import TimeMap
 
 from .preprocessors import (mend_note_alignments,
                             cut_note_arrays,
                             alignment_times_from_dtw,
                             note_per_ons_encoding)
 
-from .pretrained_models import (AlignmentTransformer)
 
 
 ################################### SYMBOLIC MATCHERS ###################################
 
 
+def _warn_cap_combinations(cap_combinations):
+    if cap_combinations is not None:
+        warnings.warn("cap_combinations is deprecated and has no effect, "
+                      "the omitted notes are computed exactly "
+                      "(see optimal_omissions)", 
+                      DeprecationWarning, stacklevel=3)
+
+
+def pitch_index(note_array):
+    """
+    indices of the notes of each pitch (in the order of
+    the note array)
+
+    Parameters
+    ----------
+    note_array : np.ndarray
+        structured array with a `pitch` field
+
+    Returns
+    -------
+    index : dict
+        pitch -> np.ndarray of note indices
+    """
+    pitches = note_array['pitch']
+    order = np.argsort(pitches, kind="stable")
+    unique_pitches, starts = np.unique(pitches[order], return_index=True)
+    return {pitch: indices for pitch, indices in 
+            zip(unique_pitches.tolist(), np.split(order, starts[1:]))}
+
+
 class SimplestGreedyMatcher(object):
     """
     Create alignment in MAPS format (dict) by greedy pitch matching from performance and score note_array
+
+    Each score note is matched to the first not yet aligned 
+    performance note of the same pitch (found with a cursor 
+    per pitch). Identical performance note records count as 
+    one note.
     """
     def __call__(self, score_note_array, performance_note_array):
         alignment = []
-        s_aligned = []
-        p_aligned = []
+        # identical records share the index of the first one
+        first_record = {}
+        record_keys = np.array([first_record.setdefault(p_note.tobytes(), idx) 
+                                for idx, p_note in enumerate(performance_note_array)],
+                               dtype=int)
+        p_aligned = np.zeros(len(performance_note_array), dtype=bool)
+        p_by_pitch = pitch_index(performance_note_array)
+        cursors = defaultdict(int)
+        p_ids = performance_note_array['id']
+
         for s_note in score_note_array:
             sid = s_note['id']
             pid = None
 
-            # filter performance notes with matching pitches
-            matching_pitches = performance_note_array[s_note['pitch'] == performance_note_array['pitch']]
-
-            for p_note in matching_pitches:
-                # take first matching performance note that was not yet aligned
-                if p_note not in p_aligned:
-                    pid = str(p_note['id'])
-                    p_aligned.append(p_note)
-                    s_aligned.append(s_note)
-                    break
+            # take first matching performance note that was not yet aligned
+            pitch = s_note['pitch'].item()
+            candidates = p_by_pitch.get(pitch, ())
+            cursor = cursors[pitch]
+            while cursor < len(candidates) and p_aligned[record_keys[candidates[cursor]]]:
+                cursor += 1
+            cursors[pitch] = cursor
+            if cursor < len(candidates):
+                p_idx = candidates[cursor]
+                pid = str(p_ids[p_idx])
+                p_aligned[record_keys[p_idx]] = True
 
             if pid is not None:
                 alignment.append({'label': 'match', 'score_id': sid, 'performance_id': str(pid)})
@@ -55,16 +100,129 @@ class SimplestGreedyMatcher(object):
                 alignment.append({'label': 'deletion', 'score_id': sid})
 
         # check for unaligned performance notes (ie insertions)
-        for p_note in performance_note_array:
-            if p_note not in p_aligned:
-                alignment.append({'label': 'insertion', 'performance_id': str(p_note['id'])})
+        for p_idx in np.flatnonzero(~p_aligned[record_keys]):
+            alignment.append({'label': 'insertion', 'performance_id': str(p_ids[p_idx])})
 
         return alignment
 
 
+def _omission_costs(longt, shortt, mu=0.0):
+    """
+    suffix costs S[i, k] of matching longt[i:] to shortt[k:] 
+    in order (omitting elements of longt) with the squared 
+    deviations (longt - shortt - mu) ** 2
+    """
+    n, m = len(longt), len(shortt)
+    deviations = (longt[:, None] - shortt[None, :] - mu) ** 2
+    costs = np.ones((n + 1, m + 1)) * np.inf
+    costs[:, m] = 0
+    for i in range(n - 1, -1, -1):
+        costs[i, :m] = np.minimum(costs[i + 1, :m], 
+                                  deviations[i] + costs[i + 1, 1:])
+    return costs, deviations
+
+
+def _omissions_from_costs(costs, deviations):
+    """
+    omitted indices of the optimal ordered matching, preferring
+    to keep elements (i.e. the lexicographically greatest 
+    omission set among the optimal ones)
+    """
+    n, m = deviations.shape
+    omit_idx = []
+    k = 0
+    for i in range(n):
+        if k < m and deviations[i, k] + costs[i + 1, k + 1] == costs[i, k]:
+            k += 1
+        else:
+            omit_idx.append(i)
+    return omit_idx
+
+
+def _omission_deviation(longt, shortt, omit_idx, shift=False):
+    """
+    squared onset deviation of an omission set (around the mean if shift)
+    """
+    shortenedt = np.delete(longt, list(omit_idx))
+    if shift:
+        optimal_shift = np.mean(shortenedt - shortt)
+        return np.sum(np.abs(shortenedt - shortt - optimal_shift) ** 2)
+    return np.sum(np.abs(shortenedt - shortt) ** 2)
+
+
+def optimal_omissions(longt, shortt, shift=False):
+    """
+    indices of the elements to omit from the longer of two sorted 
+    onset sequences such that the remaining elements match 
+    the shorter sequence (in order) with the least squared 
+    onset deviation, computed exactly by dynamic programming.
+
+    Parameters
+    ----------
+    longt : np.ndarray
+        onsets of the longer sequence
+    shortt : np.ndarray
+        onsets of the shorter sequence
+    shift : bool
+        minimize the deviations around their mean (i.e. allow
+        an optimal constant shift mu of the onsets). The optimal
+        omissions are a solution of the DP at their mean shift, 
+        the DP is solved at the breakpoints (in mu) of its cost 
+        and the solution with the least shifted deviation is kept.
+
+    Returns
+    -------
+    omit_idx : list
+        sorted indices of the omitted elements of longt. Ties are
+        resolved by keeping the earliest elements (and with shift,
+        between DP solutions, by the lowest mean shift).
+    """
+    longt = np.asarray(longt, dtype=float)
+    shortt = np.asarray(shortt, dtype=float)
+    n, m = len(longt), len(shortt)
+    if m == 0 or n == m:
+        return list(range(n)) if m == 0 else []
+    if not shift:
+        return _omissions_from_costs(*_omission_costs(longt, shortt))
+
+    # The DP cost at shift mu is the least of the lines Q - 2 mu T
+    # of the omission sets (T, Q: sums of the residuals and of their
+    # squares). The lines of the lower envelope are found by solving
+    # at the intersection of the lines at both ends of an interval 
+    # until no line lies below. Every mean residual lies in [a, b].
+    def solve(mu):
+        omit_idx = _omissions_from_costs(*_omission_costs(longt, shortt, mu))
+        residuals = np.delete(longt, omit_idx) - shortt
+        return omit_idx, residuals.sum(), (residuals ** 2).sum()
+
+    lower = solve(longt.min() - shortt.max())
+    upper = solve(longt.max() - shortt.min())
+    solutions = [lower, upper]
+    stack = [(lower, upper)]
+    while stack:
+        left, right = stack.pop()
+        if right[1] <= left[1]:
+            continue
+        mu = (right[2] - left[2]) / (2 * (right[1] - left[1]))
+        middle = solve(mu)
+        level = left[2] - 2 * mu * left[1]
+        if middle[2] - 2 * mu * middle[1] >= level - 1e-12 * max(abs(level), 1.0):
+            continue
+        solutions.append(middle)
+        stack.extend([(middle, right), (left, middle)])
+    solutions.sort(key=lambda solution: solution[1])
+    deviations = [_omission_deviation(longt, shortt, omit_idx, shift=True) 
+                  for omit_idx, _, _ in solutions]
+    return solutions[int(np.argmin(deviations))][0]
+
+
 class SequenceAugmentedGreedyMatcher(object):
     """
     Create alignment in MAPS format (dict) by sequence augmented pitch matching from performance and score note_array
+
+    For each pitch, the extra notes of the longer sequence are 
+    chosen exactly with `optimal_omissions` (`cap_combinations`
+    is deprecated and has no effect).
     """
     def __init__(self):
         self.overlap = False
@@ -74,21 +232,16 @@ class SequenceAugmentedGreedyMatcher(object):
                  performance_note_array, 
                  alignment_times, 
                  shift=False, 
-                 cap_combinations = 10000):
+                 cap_combinations = None):
+        _warn_cap_combinations(cap_combinations)
         alignment = []
         # s_aligned = []
         p_aligned = []
 
         # DTW gives non-unique times, sometimes...
         # TODO: safety net
-        try:
-            onset_time_conversion = interp1d(alignment_times[:, 0],
-                                             alignment_times[:, 1],
-                                             fill_value="extrapolate")
-        except ValueError:
-            if len(alignment_times) < 2:
-                onset_time_conversion = \
-                    lambda x: np.ones_like(x) * alignment_times[0, 1]  # noqa: E731
+        onset_time_conversion = TimeMap(alignment_times[:, 0],
+                                        alignment_times[:, 1])
 
         score_pitches = np.unique(score_note_array["pitch"])
         # loop over pitches and align full sequences of matching pitches in correct order
@@ -126,46 +279,7 @@ class SequenceAugmentedGreedyMatcher(object):
                 longid = performance_notes_onsets_idx
                 shortid = score_notes_onsets_idx
 
-            diffs = dict()
- 
-            if shift:
-                if cap_combinations is not None:
-                    combination_number = binom(max(score_no, performance_no), extra_no)
-                    if combination_number > cap_combinations:
-                        combs = [np.random.choice(max(score_no, performance_no), extra_no, replace=False) for n in range(cap_combinations)]  
-
-                        print("high number of combinations: ", combination_number, "low number sampled ", len(combs))
-                    else:
-                        combs = combinations(range(max(score_no, performance_no)), extra_no)
-                else:
-                    combs = combinations(range(max(score_no, performance_no)), extra_no)
-                for omit_idx in combinations(range(max(score_no, performance_no)), extra_no):
-                    shortenedt = np.delete(longt,list(omit_idx))
-                    optimal_shift = np.mean(shortenedt-shortt)
-                    shift_diff = np.sum(np.abs(shortenedt-shortt-optimal_shift*np.ones_like(shortenedt))**2)
-                    diffs[shift_diff] = list(omit_idx)
-
-
-            else:
-                
-                if cap_combinations is not None:
-                    combination_number = binom(max(score_no, performance_no), extra_no)
-                    if combination_number > cap_combinations:
-                        combs = [np.random.choice(max(score_no, performance_no), extra_no, replace=False) for n in range(cap_combinations)]  
-
-                        print("high number of combinations: ", combination_number, "low number sampled ", len(combs))
-                    else:
-                        combs = combinations(range(max(score_no, performance_no)), extra_no)
-                else:
-                    combs = combinations(range(max(score_no, performance_no)), extra_no)
-                for omit_idx in combs:
-
-                    shortenedt = np.delete(longt,list(omit_idx))
-                    diff = np.sum(np.abs(shortenedt-shortt)**2)
-                    diffs[diff] = list(omit_idx)
-
-            best_omit_dist = np.min(list(diffs.keys()))
-            best_omit_idx = diffs[best_omit_dist]
+            best_omit_idx = optimal_omissions(longt, shortt, shift=shift)
 
             # get the arrays of actual onset times
             aligns = np.delete(longt, best_omit_idx)
@@ -284,12 +398,99 @@ class OnsetGreedyMatcher(object):
         return alignment
 
 
+def monotone_onset_path(xs, ys, extension=3):
+    """
+    DTW path between two sorted 1D sequences of (onset) times,
+    in a single O(n + m) pass: the DTW recursion (with the step 
+    order and tie breaking of `dtw_directions_wavefront`) is 
+    restricted to the cells pairing each x with the ys between 
+    its neighbors and `extension` more ys on each side. Unsorted 
+    sequences are aligned by the full DTW recursion.
+
+    Parameters
+    ----------
+    xs : np.array
+        Sequence of numbers
+    ys : np.array
+        Sequence of numbers
+    extension : int
+        number of ys beyond the neighbors of an x in its band row
+
+    Returns
+    -------
+    path : np.ndarray
+        (n_steps, 2) array of (x index, y index) tuples
+    """
+    xs = np.asarray(xs, dtype=float).ravel()
+    ys = np.asarray(ys, dtype=float).ravel()
+    n, m = len(xs), len(ys)
+    if n == 0 or m == 0 or np.any(np.diff(xs) < 0) or np.any(np.diff(ys) < 0):
+        D = cdist(xs.reshape((-1, 1)), ys.reshape((-1, 1)))
+        _, directions, _ = dtw_directions_wavefront(D)
+        return dtw_backtracking_directions(directions)
+
+    inf = np.inf
+    xs, ys = xs.tolist(), ys.tolist()
+    # band columns lo[i] <= j <= hi[i] of each row, by two pointers
+    lo, hi = [], []
+    below = not_above = 0
+    for i in range(n):
+        left = xs[i - 1] if i > 0 else -inf
+        right = xs[i + 1] if i + 1 < n else inf
+        while below < m and ys[below] < left:
+            below += 1
+        while not_above < m and ys[not_above] <= right:
+            not_above += 1
+        lo.append(max(below - extension, 0))
+        hi.append(min(not_above - 1 + extension, m - 1))
+
+    # the row before the first row only reaches cell (-1, -1)
+    previous, previous_lo, previous_hi = [0.0], -1, -1
+    directions = []
+    for i, x in enumerate(xs):
+        cost = inf
+        row, row_directions = [], []
+        for j in range(lo[i], hi[i] + 1):
+            up = previous[j - previous_lo] if previous_lo <= j <= previous_hi else inf
+            diagonal = (previous[j - 1 - previous_lo] 
+                        if previous_lo <= j - 1 <= previous_hi else inf)
+            if diagonal <= up and diagonal <= cost:
+                row_directions.append(0)
+            elif up <= cost:
+                row_directions.append(1)
+            else:
+                row_directions.append(2)
+            cost = abs(x - ys[j]) + min(min(up, cost), diagonal)
+            row.append(cost)
+        directions.append(row_directions)
+        previous, previous_lo, previous_hi = row, lo[i], hi[i]
+
+    # decode the path (see `dtw_backtracking_directions`)
+    i, j = n - 1, m - 1
+    path = [(i, j)]
+    while not (i == 0 and j == 0):
+        direction = directions[i][j - lo[i]]
+        if direction == 0:
+            i, j = i - 1, j - 1
+        elif direction == 1:
+            i -= 1
+        else:
+            j -= 1
+        path.append((i, j))
+    return np.array(path[::-1], dtype=int)
+
+
 def unique_alignments(xs, ys, threshold = None):
     """
     From two sequences of numbers, return the unique ID
     tuples of aligned values that minimize the sum of
     tupel distances.
 
+    Sequences of equal length are aligned one to one. Else the
+    entries of the `monotone_onset_path` are grouped once by their 
+    x and y values (a group of path entries sharing a value 
+    contributes the tuple with the smallest distance).
+
     Parameters
     ----------      
     xs : np.array   
@@ -303,74 +504,300 @@ def unique_alignments(xs, ys, threshold = None):
     tuples : list
     
     """
-    matcher = DTW()
-    _, p = matcher(xs.reshape((-1,1)),ys.reshape((-1,1)), return_path=True)
+    if len(xs) == len(ys):
+        return [(i, i) for i, distance in enumerate(np.abs(xs - ys).tolist()) 
+                if threshold is None or distance < threshold]
+
+    p = monotone_onset_path(xs, ys)
+    path_x = xs[p[:, 0]]
+    path_y = ys[p[:, 1]]
+    path_dist = np.abs(path_x - path_y)
+    # path entries (in path order) with the same x and y values
+    entries_by_x = defaultdict(list)
+    entries_by_y = defaultdict(list)
+    for entry, (x, y) in enumerate(zip(path_x.tolist(), path_y.tolist())):
+        entries_by_x[x].append(entry)
+        entries_by_y[y].append(entry)
 
     used_x = set()
     tuples = list()
-    if threshold is not None:
-        for x in xs:
-            if not x in used_x:
-                current_x_mask = (xs[p[:,0]] == x)
-                if current_x_mask.sum() > 1:
-                    current_ids = p[current_x_mask,:]
-                    current_y = ys[current_ids[:,1]]
-                    current_x = xs[current_ids[:,0]]
-                    
-                else:
-                    y = ys[p[current_x_mask,1]]
-                    current_y_mask = (ys[p[:,1]] == y)
-                    # print(current_y_mask, current_x_mask, y, ys, xs, x, p[:,:])
-                    if current_y_mask.sum() > 1:
-                        current_ids = p[current_y_mask,:]
-                        current_y = ys[current_ids[:,1]]
-                        current_x = xs[current_ids[:,0]]
-                
-                    else:
-                        current_ids = p[current_x_mask,:].reshape(1,2)
-                        current_x = x
-                        current_y = y
-
-                candidate_dist = np.min(np.abs(current_x - current_y))
-                candidate_id = np.argmin(np.abs(current_x - current_y))
-                if candidate_dist < threshold:
-                    # chosen_y = current_y[candidate_id]
-                    # tuples.append((x, chosen_y))
-                    tuples.append((current_ids[candidate_id,0], current_ids[candidate_id,1]))
-                used_x.update( set(np.unique(current_x)))
+    for x in xs:
+        if not x in used_x:
+            current_entries = entries_by_x[x]
+            if len(current_entries) == 1:
+                y_entries = entries_by_y[path_y[current_entries[0]]]
+                if len(y_entries) > 1:
+                    current_entries = y_entries
+            
+            candidate_entry = current_entries[np.argmin(path_dist[current_entries])]
+            if threshold is None or path_dist[candidate_entry] < threshold:
+                tuples.append((p[candidate_entry, 0], p[candidate_entry, 1]))
+            used_x.update(path_x[current_entries].tolist())
+    return tuples
+
+
+def pitch_alignments(problems, onset_threshold=None, n_jobs=1, chunk_size=8):
+    """
+    solve independent per-pitch alignment problems: the estimated
+    performance onsets of the score notes of a pitch against the 
+    onsets of the performance notes of that pitch, see 
+    `unique_alignments`. Chunks of at most `chunk_size` problems 
+    are distributed to a pool of `n_jobs` processes.
+
+    Parameters
+    ----------
+    problems : list of tuples
+        (estimated score onsets, performance onsets) arrays
+    onset_threshold : float
+        maximal onset distance of aligned notes
+    n_jobs : int or None
+        number of processes, None: one per CPU
+    chunk_size : int
+        maximal number of problems per task
+
+    Returns
+    -------
+    tuples : list of lists
+        aligned index tuples of the problems, in input order
+    """
+    chunks = [problems[start:start + chunk_size] 
+              for start in range(0, len(problems), chunk_size)]
+    if n_jobs == 1 or len(chunks) <= 1:
+        chunk_results = [_pitch_alignments_task(chunk, onset_threshold) for chunk in chunks]
     else:
-        for x in xs:
-            if not x in used_x:
-                current_x_mask = (xs[p[:,0]] == x)
-                if current_x_mask.sum() > 1:
-                    current_ids = p[current_x_mask,:]
-                    current_y = ys[current_ids[:,1]]
-                    current_x = xs[current_ids[:,0]]
-                    
-                else:
-                    y = ys[p[current_x_mask,1]]
-                    current_y_mask = (ys[p[:,1]] == y)
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            chunk_results = list(executor.map(_pitch_alignments_task, chunks, 
+                                              [onset_threshold] * len(chunks)))
+    return [tuples for chunk_result in chunk_results for tuples in chunk_result]
 
-                    if current_y_mask.sum() > 1:
-                        current_ids = p[current_y_mask,:]
-                        current_y = ys[current_ids[:,1]]
-                        current_x = xs[current_ids[:,0]]
-                
-                    else:
-                        current_ids = p[current_x_mask,:].reshape(1,2)
-                        current_x = x
-                        current_y = y
-
-                candidate_dist = np.min(np.abs(current_x - current_y))
-                candidate_id = np.argmin(np.abs(current_x - current_y))
-                tuples.append((current_ids[candidate_id,0], current_ids[candidate_id,1]))
-                used_x.update( set(np.unique(current_x)))
-    return tuples
+
+def _pitch_alignments_task(problems, onset_threshold):
+    """
+    aligned index tuples of a chunk of per-pitch problems
+    """
+    return [_pitch_alignment(estimated_onsets, performance_onsets, onset_threshold) 
+            for estimated_onsets, performance_onsets in problems]
+
+
+def _pitch_alignment(estimated_onsets, performance_onsets, onset_threshold):
+    """
+    aligned index tuples of the notes of one pitch
+    """
+    if onset_threshold is None:
+        onset_threshold1 = 1000000
+    else:
+        onset_threshold1 = onset_threshold
+
+    if  (len(performance_onsets) > 1 and len(estimated_onsets) > 1) or \
+        (len(performance_onsets) > 1 and len(estimated_onsets) == 1) or \
+        (len(performance_onsets) == 1 and len(estimated_onsets) > 1):
+        return unique_alignments(estimated_onsets, 
+                                 performance_onsets,
+                                 threshold=onset_threshold)
+    elif len(performance_onsets) == 1 and len(estimated_onsets) == 1: 
+        if np.abs(estimated_onsets[0] - performance_onsets[0]) < onset_threshold1:
+            return [(0,0)]
+    return []
+
+
+class ScoreOnsetIndex(object):
+    """
+    Onset/pitch index of a score note array, built once and 
+    shared by the `pitch_and_onset_wise_times*` functions
+    (and the forward and reverse passes of `DualDTWNoteMatcher`).
+
+    The notes of the i-th unique score onset are 
+    `order[offsets[i]:offsets[i + 1]]` (CSR-style), their 
+    pitches are collected in `pitches_by_onset[i]`.
+
+    Parameters
+    ----------
+    score_note_array : np.array
+        Array of score notes
+    """
+    def __init__(self, score_note_array):
+        self.unique_onsets, self.onset_idx = np.unique(score_note_array['onset_beat'],
+                                                       return_inverse=True)
+        self.pitch = score_note_array['pitch']
+        self.order = np.argsort(self.onset_idx, kind="stable")
+        self.offsets = np.r_[0, np.cumsum(np.bincount(self.onset_idx, 
+                                                      minlength=len(self.unique_onsets)))]
+        pitches = self.pitch[self.order]
+        self.pitches_by_onset = [set(pitches[start:stop]) for start, stop 
+                                 in zip(self.offsets[:-1], self.offsets[1:])]
+        self._pitch_set_masks = None
+
+    def __len__(self):
+        return len(self.unique_onsets)
+
+    def notes(self, onset_no):
+        """
+        indices of the notes at the onset_no-th unique onset
+        """
+        return self.order[self.offsets[onset_no]:self.offsets[onset_no + 1]]
+
+    def pitch_set_masks(self):
+        """
+        pitch sets of the onsets as 128 bit masks (see 
+        `dtw.indexed_pitch_set_masks`), computed once
+        """
+        if self._pitch_set_masks is None:
+            self._pitch_set_masks = indexed_pitch_set_masks(self.pitch, 
+                                                            self.onset_idx, 
+                                                            len(self))
+        return self._pitch_set_masks
+
+    def adjacent_blocks(self, backwards=False):
+        """
+        pitches repeated from the previous onset and whether
+        all the pitches of an onset are repeated
+        (by onset number, optionally in reverse order)
+        """
+        pitches_by_onset = self.pitches_by_onset[::-1] if backwards else self.pitches_by_onset
+        blocked = [set()]
+        all_pitch_repeat = [False]
+        for previous, pitches in zip(pitches_by_onset[:-1], pitches_by_onset[1:]):
+            blocked.append(pitches & previous)
+            all_pitch_repeat.append(len(blocked[-1]) == len(pitches))
+        return blocked, all_pitch_repeat
+
+    def stable_blocks(self, backwards=False):
+        """
+        pitches repeated within pitch-stable sequences of onsets, 
+        a sequence starts at an onset with a pitch not 
+        in the pitches of its first onset
+        (by onset number, optionally in reverse order)
+        """
+        pitches_by_onset = self.pitches_by_onset[::-1] if backwards else self.pitches_by_onset
+        blocked = []
+        all_pitch_repeat = []
+        last_new_pitches = set()
+        for pitches in pitches_by_onset:
+            if pitches <= last_new_pitches:
+                blocked.append(pitches)
+                all_pitch_repeat.append(True)
+            else:
+                blocked.append(pitches & last_new_pitches)
+                all_pitch_repeat.append(False)
+                last_new_pitches = pitches
+        return blocked, all_pitch_repeat
+
+
+def _onset_wise_time_tuples(performance_note_array, 
+                            unique_onsets, 
+                            pitches_by_onset,
+                            blocked,
+                            alignment_ids):
+    """
+    walk a performance note to score onset alignment and 
+    collect the performance onsets of the first notes of 
+    each available, not blocked pitch at each score onset.
+    """
+    p_aligned = set()
+    time_tuples_by_onset = defaultdict(list)
+    time_tuples_by_pitch = defaultdict(list)
+    used_pitches_by_onset = defaultdict(set)
+    p_ids = performance_note_array['id']
+    p_pitches = performance_note_array['pitch']
+    p_onsets = performance_note_array['onset_sec']
+    for p_no, s_onset_no in alignment_ids:
+        # p_no is the index of the performance note in the performance note array
+        # s_onset_no is the index of the score onset in the unique_onsets array
+        pid = str(p_ids[p_no])
+        ppitch = p_pitches[p_no]
+        if pid not in p_aligned:
+            used_pitches = used_pitches_by_onset[s_onset_no]
+            s_pitch_used = ppitch in used_pitches
+            s_pitch_available = ppitch in pitches_by_onset[s_onset_no]
+            if s_pitch_available and not s_pitch_used:
+                if ppitch not in blocked[s_onset_no]:
+                    s_onset = unique_onsets[s_onset_no]
+                    used_pitches.add(ppitch)
+                    time_tuples_by_pitch[ppitch].append((s_onset, p_onsets[p_no]))
+                    time_tuples_by_onset[s_onset].append(p_onsets[p_no])
+                    p_aligned.add(pid)
+    return time_tuples_by_onset, time_tuples_by_pitch
+
+
+def _remove_outlier_times(time_tuples_by_onset):
+    """
+    keep the performance onsets within 0.1 of the median at each score onset
+    """
+    for s_onset in time_tuples_by_onset.keys():
+        sorted_times = np.sort(np.array(time_tuples_by_onset[s_onset]))
+        mask = np.abs(sorted_times - np.median(sorted_times)) < 0.1
+
+        if mask.sum() >= 1:
+            time_tuples_by_onset[s_onset] = list(sorted_times[mask])
+        else:
+            time_tuples_by_onset[s_onset] = list(sorted_times)
+
+
+def _unique_time_tuples(time_tuples_by_onset):
+    """
+    (earliest) performance onset by score onset and as sorted array
+    """
+    unique_time_tuples_by_onset = {s_onset : np.min(time_tuples_by_onset[s_onset]) for s_onset in time_tuples_by_onset.keys()}
+    unique_time_tuples = np.array([(tup, unique_time_tuples_by_onset[tup]) for tup in unique_time_tuples_by_onset.keys()])  
+    unique_time_tuples = unique_time_tuples[unique_time_tuples[:,0].argsort()]
+    return unique_time_tuples_by_onset, unique_time_tuples
+
+
+def _interval_time_tuples(score_note_array, 
+                          performance_note_array, 
+                          anchor_times_by_onset):
+    """
+    time tuples filling the gaps between consecutive anchored score 
+    onsets that span more than one score onset: the score and 
+    performance notes of the lowest pitch occurring equally often in 
+    the score interval and the anchored performance interval, paired 
+    in order. score_note_array has to be sorted by onset.
+    """
+    additional_time_tuples_by_onset = defaultdict(list)
+    anchors = np.sort(list(anchor_times_by_onset.keys()))
+    if len(anchors) < 2:
+        return additional_time_tuples_by_onset
+    p_anchors = np.array([anchor_times_by_onset[s_onset] for s_onset in anchors])
+
+    s_onsets = score_note_array['onset_beat']
+    s_pitch = score_note_array['pitch']
+    p_order = np.argsort(performance_note_array['onset_sec'], kind="stable")
+    p_onsets = performance_note_array['onset_sec'][p_order]
+    p_pitch = performance_note_array['pitch'][p_order]
+
+    # half-open intervals [anchor, next anchor) on both time axes
+    onsets_in_range = np.diff(np.searchsorted(np.unique(s_onsets), anchors))
+    s_bounds = np.searchsorted(s_onsets, anchors)
+    p_starts = np.searchsorted(p_onsets, p_anchors[:-1])
+    p_stops = np.maximum(np.searchsorted(p_onsets, p_anchors[1:]), p_starts)
+
+    for i in np.flatnonzero(onsets_in_range > 1):
+        s_range = slice(s_bounds[i], s_bounds[i + 1])
+        p_range = slice(p_starts[i], p_stops[i])
+        pitches, s_counts = np.unique(s_pitch[s_range], return_counts=True)
+        p_pitches, p_counts = np.unique(p_pitch[p_range], return_counts=True)
+        if len(p_pitches) == 0:
+            continue
+        p_idx = np.searchsorted(p_pitches, pitches).clip(0, len(p_pitches) - 1)
+        p_counts = np.where(p_pitches[p_idx] == pitches, p_counts[p_idx], 0)
+        equal_counts = np.flatnonzero(p_counts == s_counts)
+        if len(equal_counts) == 0:
+            continue
+        pitch = pitches[equal_counts[0]]
+        s_onsets_pitch = s_onsets[s_range][s_pitch[s_range] == pitch]
+        # performance notes are paired in the order of the input array
+        p_positions = p_starts[i] + np.flatnonzero(p_pitch[p_range] == pitch)
+        p_onsets_pitch = performance_note_array['onset_sec'][np.sort(p_order[p_positions])]
+        for s_onset, p_onset in zip(s_onsets_pitch, p_onsets_pitch):
+            additional_time_tuples_by_onset[s_onset].append(p_onset)
+
+    return additional_time_tuples_by_onset
 
 
 def pitch_and_onset_wise_times(performance_note_array, 
                                score_note_array, 
-                               alignment_ids
+                               alignment_ids,
+                               score_index=None
                                # return_ids=False
                                ):
     """
@@ -389,6 +816,8 @@ def pitch_and_onset_wise_times(performance_note_array,
         Array of score notes
     alignment_ids : list
         List of tuples of (score_onset_id, performance_note_id)
+    score_index : ScoreOnsetIndex or None
+        precomputed onset/pitch index of the score note array
 
 
     Returns
@@ -403,62 +832,31 @@ def pitch_and_onset_wise_times(performance_note_array,
         Array of (score_onset, (earliest) performance_onset) tuples
 
     """
-    p_aligned = set()
-    time_tuples_by_onset = defaultdict(list)
-    time_tuples_by_pitch = defaultdict(list)
-    block_by_pitch_by_onset = defaultdict(dict)
-    all_pitch_repeat_by_onset = defaultdict(lambda : False)
-
-    # time_tuples_by_onset_id = defaultdict(list)
-    # time_tuples_by_pitch_id = defaultdict(list)
-
-    unique_onsets = np.unique(score_note_array['onset_beat'])
-    pitches_by_onset = {s_onset: set(score_note_array[score_note_array['onset_beat'] == s_onset]["pitch"]) for s_onset in unique_onsets}
+    if score_index is None:
+        score_index = ScoreOnsetIndex(score_note_array)
+    unique_onsets = score_index.unique_onsets
+    pitches_by_onset = score_index.pitches_by_onset
     # keep track of pitches repeated in adjacent score onsets
-    for s_o in np.arange(1, len(unique_onsets)):
-        complete_block = []
-        for p in pitches_by_onset[unique_onsets[s_o]]:
-            block_by_pitch_by_onset[unique_onsets[s_o]][p] = p in pitches_by_onset[unique_onsets[s_o-1]]
-            complete_block.append(block_by_pitch_by_onset[unique_onsets[s_o]][p])
-        # keep track of completely repeated score onsets
-        all_pitch_repeat_by_onset[unique_onsets[s_o]] = all(complete_block)
-    for p in pitches_by_onset[unique_onsets[0]]:
-        block_by_pitch_by_onset[unique_onsets[0]][p] = False
+    # and of completely repeated score onsets
+    blocked, all_pitch_repeat = score_index.adjacent_blocks()
     
-    used_pitches_by_onset = defaultdict(set)
-    for p_no, s_onset_no in alignment_ids:
-        # p_no is the index of the performance note in the performance note array
-        # s_onset_no is the index of the score onset in the unique_onsets array
-        p_note = performance_note_array[p_no]
-        pid = str(p_note['id'])
-        ppitch = p_note['pitch']
-        if pid not in p_aligned:
-            s_onset = unique_onsets[s_onset_no]
-            used_pitches = used_pitches_by_onset[s_onset]
-            available_pitches = pitches_by_onset[s_onset] 
-            s_pitch_used = ppitch in used_pitches
-            s_pitch_available = ppitch in available_pitches
-            if s_pitch_available and not s_pitch_used:
-                if not block_by_pitch_by_onset[s_onset][ppitch]:
-                    used_pitches_by_onset[s_onset].add(ppitch)
-                    time_tuples_by_pitch[ppitch].append((s_onset, p_note['onset_sec']))
-                    time_tuples_by_onset[s_onset].append(p_note['onset_sec'])
-                    # time_tuples_by_pitch_id[ppitch].append((s_onset_no, p_no))
-                    # time_tuples_by_onset_id[s_onset_no].append(p_no)
-                    p_aligned.add(pid)
-
+    time_tuples_by_onset, time_tuples_by_pitch = _onset_wise_time_tuples(performance_note_array,
+                                                                         unique_onsets,
+                                                                         pitches_by_onset,
+                                                                         blocked,
+                                                                         alignment_ids)
 
     # make clean sequences
-    onsets_with_performance_times = np.array(list(time_tuples_by_onset.keys()))
+    onsets_with_performance_times = np.sort(list(time_tuples_by_onset.keys()))
+    performance_index = NoteIndex(performance_note_array, field="onset_sec")
     current_s_onset_no = 0
     for s_onset_no in range(len(unique_onsets)):
         if s_onset_no > current_s_onset_no:
-            s_onset = unique_onsets[s_onset_no]
-            if all_pitch_repeat_by_onset[s_onset]:
+            if all_pitch_repeat[s_onset_no]:
                 local_s_onset_no = s_onset_no
                 s_onset_range = [unique_onsets[s_onset_no - 1]]
                 not_last = True
-                while(all_pitch_repeat_by_onset[unique_onsets[local_s_onset_no]]):
+                while(all_pitch_repeat[local_s_onset_no]):
                     s_onset_range.append(unique_onsets[local_s_onset_no])
                     local_s_onset_no += 1
                     if local_s_onset_no >= len(unique_onsets)-1:
@@ -469,45 +867,37 @@ def pitch_and_onset_wise_times(performance_note_array,
                     s_onset_range = np.array(s_onset_range)
                     first_s_onset_in_range = s_onset_range[0]
                     first_s_onset_out_of_range = unique_onsets[local_s_onset_no]
-                    first_s_onset_in_range_aligned = np.max(onsets_with_performance_times[onsets_with_performance_times<=first_s_onset_in_range])
-                    first_s_onset_out_of_range_aligned = np.min(onsets_with_performance_times[onsets_with_performance_times>=first_s_onset_out_of_range])
+                    in_range_no = np.searchsorted(onsets_with_performance_times, first_s_onset_in_range, side="right") - 1
+                    out_of_range_no = np.searchsorted(onsets_with_performance_times, first_s_onset_out_of_range, side="left")
+                    if in_range_no < 0 or out_of_range_no >= len(onsets_with_performance_times):
+                        # no aligned onset before or after the range
+                        continue
+                    first_s_onset_in_range_aligned = onsets_with_performance_times[in_range_no]
+                    first_s_onset_out_of_range_aligned = onsets_with_performance_times[out_of_range_no]
                     first_p_onset_in_range = np.min(time_tuples_by_onset[first_s_onset_in_range_aligned])   
                     first_p_onset_out_of_range = np.min(time_tuples_by_onset[first_s_onset_out_of_range_aligned])   
-                    for pitch in pitches_by_onset[s_onset_range[1]]:  
-                        pitch_mask = performance_note_array['pitch'] == pitch
-                        higher_mask = performance_note_array['onset_sec'] >= first_p_onset_in_range
-                        lower_mask = performance_note_array['onset_sec'] < first_p_onset_out_of_range
-                        available_pp_notes = performance_note_array[np.all((pitch_mask, higher_mask, lower_mask), axis=0)]
+                    for pitch in pitches_by_onset[s_onset_no]:  
+                        # notes of the pitch in [first_p_onset_in_range, first_p_onset_out_of_range)
+                        positions = performance_index.positions(pitch, lower_bound=first_p_onset_in_range)
+                        positions = positions[:np.searchsorted(performance_index.times[positions], 
+                                                               first_p_onset_out_of_range, side="left")]
+                        available_pp_notes = performance_note_array[np.sort(performance_index.order[positions])]
                         if len(available_pp_notes) == len(s_onset_range):
                             for s_onset_local, p_onset_local in zip(s_onset_range, available_pp_notes):
                                 time_tuples_by_pitch[pitch].append((s_onset_local, p_onset_local['onset_sec']))
                                 time_tuples_by_onset[s_onset_local].append(p_onset_local['onset_sec'])
                         
     # remove outliers
-    for s_onset in time_tuples_by_onset.keys():
-        sorted_times = np.sort(np.array(time_tuples_by_onset[s_onset]))
-        mask = np.abs(sorted_times - np.median(sorted_times)) < 0.1
+    _remove_outlier_times(time_tuples_by_onset)
 
-        if mask.sum() >= 1:
-            time_tuples_by_onset[s_onset] = list(sorted_times[mask])
-        else:
-            time_tuples_by_onset[s_onset] = list(sorted_times)
-
-    unique_time_tuples_by_onset = {s_onset : np.min(time_tuples_by_onset[s_onset]) for s_onset in time_tuples_by_onset.keys()}
-    unique_time_tuples = np.array([(tup, unique_time_tuples_by_onset[tup]) for tup in unique_time_tuples_by_onset.keys()])  
-    unique_time_tuples = unique_time_tuples[unique_time_tuples[:,0].argsort()]
-
-    # unique_time_tuples_by_onset_id = {s_onset_no : np.min(time_tuples_by_onset_id[s_onset_no]) for s_onset_no in time_tuples_by_onset_id.keys()}
-    # unique_time_tuples_id = np.array([(tup, unique_time_tuples_by_onset_id[tup]) for tup in unique_time_tuples_by_onset_id.keys()]) 
-    # if not return_ids:
+    unique_time_tuples_by_onset, unique_time_tuples = _unique_time_tuples(time_tuples_by_onset)
     return time_tuples_by_onset, unique_time_tuples_by_onset, time_tuples_by_pitch, unique_time_tuples
-    # else:
-    #     return time_tuples_by_onset_id, unique_time_tuples_by_onset_id, time_tuples_by_pitch_id, unique_time_tuples_id
 
 
 def pitch_and_onset_wise_times_ornament(performance_note_array, 
                                score_note_array, 
-                               alignment_ids
+                               alignment_ids,
+                               score_index=None
                                 ):
     """
     from a performed MIDI note to score onset alignment
@@ -525,6 +915,8 @@ def pitch_and_onset_wise_times_ornament(performance_note_array,
         Array of score notes
     alignment_ids : list
         List of tuples of (score_onset_id, performance_note_id)
+    score_index : ScoreOnsetIndex or None
+        precomputed onset/pitch index of the score note array
 
 
     Returns
@@ -539,133 +931,29 @@ def pitch_and_onset_wise_times_ornament(performance_note_array,
         Array of (score_onset, (earliest) performance_onset) tuples
 
     """
-    p_aligned = set()
-    time_tuples_by_onset = defaultdict(list)
-    time_tuples_by_pitch = defaultdict(list)
-    block_by_pitch_by_onset = defaultdict(dict)
-    all_pitch_repeat_by_onset = defaultdict(lambda : False)
-
-    unique_onsets = np.unique(score_note_array['onset_beat'])
-    pitches_by_onset = {s_onset: set(score_note_array[score_note_array['onset_beat'] == s_onset]["pitch"]) for s_onset in unique_onsets}
-    
-    # # keep track of pitches repeated in adjacent score onsets
-    # for s_o in np.arange(1, len(unique_onsets)):
-    #     complete_block = []
-    #     for p in pitches_by_onset[unique_onsets[s_o]]:
-    #         block_by_pitch_by_onset[unique_onsets[s_o]][p] = p in pitches_by_onset[unique_onsets[s_o-1]]
-    #         complete_block.append(block_by_pitch_by_onset[unique_onsets[s_o]][p])
-    #     # keep track of completely repeated score onsets
-    #     all_pitch_repeat_by_onset[unique_onsets[s_o]] = all(complete_block)
-    # for p in pitches_by_onset[unique_onsets[0]]:
-    #     block_by_pitch_by_onset[unique_onsets[0]][p] = False
-
-    # keep track of pitches repeated in adjacent score onsets
-    last_new_pitches = set()
-    for s_o in np.arange(0, len(unique_onsets)):
-        complete_block = []
-        any_out = False
-        for p in pitches_by_onset[unique_onsets[s_o]]:
-            if p not in last_new_pitches:
-                any_out = True
-                block_by_pitch_by_onset[unique_onsets[s_o]][p] = False
-            else:
-                block_by_pitch_by_onset[unique_onsets[s_o]][p] = True
-                
-        if any_out:
-            last_new_pitches = pitches_by_onset[unique_onsets[s_o]]
-            all_pitch_repeat_by_onset[unique_onsets[s_o]] = False
-        else:
-            all_pitch_repeat_by_onset[unique_onsets[s_o]] = True
-
-
+    if score_index is None:
+        score_index = ScoreOnsetIndex(score_note_array)
+    # keep track of pitches repeated in pitch-stable sequences of score onsets
+    blocked, _ = score_index.stable_blocks()
 
     # get first onsets of each pitch in each pitch-stable sequence 
     # (dtw alignment messes up the order)
-    used_pitches_by_onset = defaultdict(set)
-    for p_no, s_onset_no in alignment_ids:
-        # p_no is the index of the performance note in the performance note array
-        # s_onset_no is the index of the score onset in the unique_onsets array
-        p_note = performance_note_array[p_no]
-        pid = str(p_note['id'])
-        ppitch = p_note['pitch']
-        if pid not in p_aligned:
-            s_onset = unique_onsets[s_onset_no]
-            used_pitches = used_pitches_by_onset[s_onset]
-            available_pitches = pitches_by_onset[s_onset]
-            s_pitch_used = ppitch in used_pitches
-            s_pitch_available = ppitch in available_pitches
-            if s_pitch_available and not s_pitch_used:
-                if not block_by_pitch_by_onset[s_onset][ppitch]:
-                    used_pitches_by_onset[s_onset].add(ppitch)
-                    time_tuples_by_pitch[ppitch].append((s_onset, p_note['onset_sec']))
-                    time_tuples_by_onset[s_onset].append(p_note['onset_sec'])
-                    p_aligned.add(pid)
+    time_tuples_by_onset, time_tuples_by_pitch = _onset_wise_time_tuples(performance_note_array,
+                                                                         score_index.unique_onsets,
+                                                                         score_index.pitches_by_onset,
+                                                                         blocked,
+                                                                         alignment_ids)
     # remove outliers
-    for s_onset in time_tuples_by_onset.keys():
-        sorted_times = np.sort(np.array(time_tuples_by_onset[s_onset]))
-        mask = np.abs(sorted_times - np.median(sorted_times)) < 0.1
-
-        if mask.sum() >= 1:
-            time_tuples_by_onset[s_onset] = list(sorted_times[mask])
-        else:
-            time_tuples_by_onset[s_onset] = list(sorted_times)
-
-    # # make clean sequences
-    # onsets_with_performance_times = np.array(list(time_tuples_by_onset.keys()))
-    # current_s_onset_no = 0
-    # for s_onset_no in range(len(unique_onsets)):
-    #     if s_onset_no > current_s_onset_no:
-    #         s_onset = unique_onsets[s_onset_no]
-    #         if all_pitch_repeat_by_onset[s_onset]:
-    #             local_s_onset_no = s_onset_no
-    #             s_onset_range = [unique_onsets[s_onset_no - 1]]
-    #             not_last = True
-    #             while(all_pitch_repeat_by_onset[unique_onsets[local_s_onset_no]]):
-    #                 s_onset_range.append(unique_onsets[local_s_onset_no])
-    #                 local_s_onset_no += 1
-    #                 if local_s_onset_no >= len(unique_onsets)-1:
-    #                     not_last = False
-    #                     break
-    #             if not_last:
-    #                 current_s_onset_no = local_s_onset_no - 1
-    #                 s_onset_range = np.array(s_onset_range)
-    #                 first_s_onset_in_range = s_onset_range[0]
-    #                 first_s_onset_out_of_range = unique_onsets[local_s_onset_no]
-    #                 first_s_onset_in_range_aligned = np.max(onsets_with_performance_times[onsets_with_performance_times<=first_s_onset_in_range])
-    #                 first_s_onset_out_of_range_aligned = np.min(onsets_with_performance_times[onsets_with_performance_times>=first_s_onset_out_of_range])
-    #                 first_p_onset_in_range = np.min(time_tuples_by_onset[first_s_onset_in_range_aligned])   
-    #                 first_p_onset_out_of_range = np.min(time_tuples_by_onset[first_s_onset_out_of_range_aligned])   
-    #                 for pitch in pitches_by_onset[s_onset_range[1]]:  
-    #                     pitch_mask = performance_note_array['pitch'] == pitch
-    #                     higher_mask = performance_note_array['onset_sec'] >= first_p_onset_in_range
-    #                     lower_mask = performance_note_array['onset_sec'] < first_p_onset_out_of_range
-    #                     available_pp_notes = performance_note_array[np.all((pitch_mask, higher_mask, lower_mask), axis=0)]
-    #                     if len(available_pp_notes) == len(s_onset_range):
-    #                         for s_onset_local, p_onset_local in zip(s_onset_range, available_pp_notes):
-    #                             time_tuples_by_pitch[pitch].append((s_onset_local, p_onset_local['onset_sec']))
-    #                             time_tuples_by_onset[s_onset_local].append(p_onset_local['onset_sec'])
-
-
-    # # remove outliers
-    # for s_onset in time_tuples_by_onset.keys():
-    #     sorted_times = np.sort(np.array(time_tuples_by_onset[s_onset]))
-    #     mask = np.abs(sorted_times - np.median(sorted_times)) < 0.1
-
-    #     if mask.sum() >= 1:
-    #         time_tuples_by_onset[s_onset] = list(sorted_times[mask])
-    #     else:
-    #         time_tuples_by_onset[s_onset] = list(sorted_times)
-
-    unique_time_tuples_by_onset = {s_onset : np.min(time_tuples_by_onset[s_onset]) for s_onset in time_tuples_by_onset.keys()}
-    unique_time_tuples = np.array([(tup, unique_time_tuples_by_onset[tup]) for tup in unique_time_tuples_by_onset.keys()])  
-    unique_time_tuples = unique_time_tuples[unique_time_tuples[:,0].argsort()]
+    _remove_outlier_times(time_tuples_by_onset)
 
+    unique_time_tuples_by_onset, unique_time_tuples = _unique_time_tuples(time_tuples_by_onset)
     return time_tuples_by_onset, unique_time_tuples_by_onset, time_tuples_by_pitch, unique_time_tuples
 
 
 def pitch_and_onset_wise_times_simple(performance_note_array, 
                                score_note_array, 
-                               alignment_ids
+                               alignment_ids,
+                               score_index=None
                                ):
     """
     from a performed MIDI note to score onset alignment
@@ -683,6 +971,8 @@ def pitch_and_onset_wise_times_simple(performance_note_array,
         Array of score notes
     alignment_ids : list
         List of tuples of (score_onset_id, performance_note_id)
+    score_index : ScoreOnsetIndex or None
+        precomputed onset/pitch index of the score note array
 
 
     Returns
@@ -697,52 +987,20 @@ def pitch_and_onset_wise_times_simple(performance_note_array,
         Array of (score_onset, (earliest) performance_onset) tuples
 
     """
-    p_aligned = set()
-    time_tuples_by_onset = defaultdict(list)
-    time_tuples_by_pitch = defaultdict(list)
-    block_by_pitch_by_onset = defaultdict(dict)
-    all_pitch_repeat_by_onset = defaultdict(lambda : False)
-
-    unique_onsets = np.unique(score_note_array['onset_beat'])
-    pitches_by_onset = {s_onset: set(score_note_array[score_note_array['onset_beat'] == s_onset]["pitch"]) for s_onset in unique_onsets}
-    
+    if score_index is None:
+        score_index = ScoreOnsetIndex(score_note_array)
     # keep track of pitches repeated in adjacent score onsets
-    for s_o in np.arange(1, len(unique_onsets)):
-        complete_block = []
-        for p in pitches_by_onset[unique_onsets[s_o]]:
-            block_by_pitch_by_onset[unique_onsets[s_o]][p] = p in pitches_by_onset[unique_onsets[s_o-1]]
-            complete_block.append(block_by_pitch_by_onset[unique_onsets[s_o]][p])
-        # keep track of completely repeated score onsets
-        all_pitch_repeat_by_onset[unique_onsets[s_o]] = all(complete_block)
-    for p in pitches_by_onset[unique_onsets[0]]:
-        block_by_pitch_by_onset[unique_onsets[0]][p] = False
+    blocked, _ = score_index.adjacent_blocks()
 
     # get first onsets of each pitch in each pitch-stable sequence 
     # (dtw alignment messes up the order)
-    used_pitches_by_onset = defaultdict(set)
-    for p_no, s_onset_no in alignment_ids:
-        # p_no is the index of the performance note in the performance note array
-        # s_onset_no is the index of the score onset in the unique_onsets array
-        p_note = performance_note_array[p_no]
-        pid = str(p_note['id'])
-        ppitch = p_note['pitch']
-        if pid not in p_aligned:
-            s_onset = unique_onsets[s_onset_no]
-            used_pitches = used_pitches_by_onset[s_onset]
-            available_pitches = pitches_by_onset[s_onset]
-            s_pitch_used = ppitch in used_pitches
-            s_pitch_available = ppitch in available_pitches
-            if s_pitch_available and not s_pitch_used:
-                if not block_by_pitch_by_onset[s_onset][ppitch]:
-                    used_pitches_by_onset[s_onset].add(ppitch)
-                    time_tuples_by_pitch[ppitch].append((s_onset, p_note['onset_sec']))
-                    time_tuples_by_onset[s_onset].append(p_note['onset_sec'])
-                    p_aligned.add(pid)
-
-    unique_time_tuples_by_onset = {s_onset : np.min(time_tuples_by_onset[s_onset]) for s_onset in time_tuples_by_onset.keys()}
-    unique_time_tuples = np.array([(tup, unique_time_tuples_by_onset[tup]) for tup in unique_time_tuples_by_onset.keys()])  
-    unique_time_tuples = unique_time_tuples[unique_time_tuples[:,0].argsort()]
+    time_tuples_by_onset, time_tuples_by_pitch = _onset_wise_time_tuples(performance_note_array,
+                                                                         score_index.unique_onsets,
+                                                                         score_index.pitches_by_onset,
+                                                                         blocked,
+                                                                         alignment_ids)
 
+    unique_time_tuples_by_onset, unique_time_tuples = _unique_time_tuples(time_tuples_by_onset)
     return time_tuples_by_onset, unique_time_tuples_by_onset, time_tuples_by_pitch, unique_time_tuples
 
 
@@ -750,6 +1008,7 @@ def pitch_and_onset_wise_times_rev(performance_note_array,
                                score_note_array, 
                                alignment_ids,
                                backwards = True,
+                               score_index=None
                                ):
     """
     from a performed MIDI note to score onset alignment
@@ -767,6 +1026,8 @@ def pitch_and_onset_wise_times_rev(performance_note_array,
         Array of score notes
     alignment_ids : list
         List of tuples of (score_onset_id, performance_note_id)
+    score_index : ScoreOnsetIndex or None
+        precomputed onset/pitch index of the score note array
 
 
     Returns
@@ -781,153 +1042,56 @@ def pitch_and_onset_wise_times_rev(performance_note_array,
         Array of (score_onset, (earliest) performance_onset) tuples
 
     """
-    p_aligned = set()
-    time_tuples_by_onset = defaultdict(list)
-    time_tuples_by_pitch = defaultdict(list)
-    block_by_pitch_by_onset = defaultdict(dict)
-    all_pitch_repeat_by_onset = defaultdict(lambda : False)
-
+    if score_index is None:
+        score_index = ScoreOnsetIndex(score_note_array)
     # --------reverse specials
-    unique_onsets = np.unique(score_note_array['onset_beat'])
+    unique_onsets = score_index.unique_onsets
+    pitches_by_onset = score_index.pitches_by_onset
     if backwards:
         unique_onsets = np.flipud(unique_onsets)
-    pitches_by_onset = {s_onset: set(score_note_array[score_note_array['onset_beat'] == s_onset]["pitch"]) for s_onset in unique_onsets}
+        pitches_by_onset = pitches_by_onset[::-1]
     # --------reverse specials
 
-    # # keep track of pitches repeated in adjacent score onsets
-    # for s_o in np.arange(1, len(unique_onsets)):
-    #     complete_block = []
-    #     for p in pitches_by_onset[unique_onsets[s_o]]:
-    #         block_by_pitch_by_onset[unique_onsets[s_o]][p] = p in pitches_by_onset[unique_onsets[s_o-1]]
-    #         complete_block.append(block_by_pitch_by_onset[unique_onsets[s_o]][p])
-    #     # keep track of completely repeated score onsets
-    #     all_pitch_repeat_by_onset[unique_onsets[s_o]] = all(complete_block)
-    # for p in pitches_by_onset[unique_onsets[0]]:
-    #     block_by_pitch_by_onset[unique_onsets[0]][p] = False
-
-
-    last_new_pitches = set()
-    for s_o in np.arange(0, len(unique_onsets)):
-        complete_block = []
-        any_out = False
-        for p in pitches_by_onset[unique_onsets[s_o]]:
-            if p not in last_new_pitches:
-                any_out = True
-                block_by_pitch_by_onset[unique_onsets[s_o]][p] = False
-            else:
-                block_by_pitch_by_onset[unique_onsets[s_o]][p] = True
-                
-        if any_out:
-            last_new_pitches = pitches_by_onset[unique_onsets[s_o]]
-            all_pitch_repeat_by_onset[unique_onsets[s_o]] = False
-        else:
-            all_pitch_repeat_by_onset[unique_onsets[s_o]] = True
-
+    # keep track of pitches repeated in pitch-stable sequences of score onsets
+    blocked, _ = score_index.stable_blocks(backwards=backwards)
 
     # get first onsets of each pitch in each pitch-stable sequence 
     # (dtw alignment messes up the order)
-    used_pitches_by_onset = defaultdict(set)
-    for p_no, s_onset_no in alignment_ids:
-        # p_no is the index of the performance note in the performance note array
-        # s_onset_no is the index of the score onset in the unique_onsets array
-        p_note = performance_note_array[p_no]
-        pid = str(p_note['id'])
-        ppitch = p_note['pitch']
-        if pid not in p_aligned:
-            s_onset = unique_onsets[s_onset_no]
-            used_pitches = used_pitches_by_onset[s_onset]
-            available_pitches = pitches_by_onset[s_onset]
-            s_pitch_used = ppitch in used_pitches
-            s_pitch_available = ppitch in available_pitches
-            if s_pitch_available and not s_pitch_used:
-                if not block_by_pitch_by_onset[s_onset][ppitch]:
-                    used_pitches_by_onset[s_onset].add(ppitch)
-                    time_tuples_by_pitch[ppitch].append((s_onset, p_note['onset_sec']))
-                    time_tuples_by_onset[s_onset].append(p_note['onset_sec'])
-                    p_aligned.add(pid)
-
+    time_tuples_by_onset, time_tuples_by_pitch = _onset_wise_time_tuples(performance_note_array,
+                                                                         unique_onsets,
+                                                                         pitches_by_onset,
+                                                                         blocked,
+                                                                         alignment_ids)
 
     # remove outliers
-    for s_onset in time_tuples_by_onset.keys():
-        sorted_times = np.sort(np.array(time_tuples_by_onset[s_onset]))
-        mask = np.abs(sorted_times - np.median(sorted_times)) < 0.1
-
-        if mask.sum() >= 1:
-            time_tuples_by_onset[s_onset] = list(sorted_times[mask])
-        else:
-            time_tuples_by_onset[s_onset] = list(sorted_times)
-
-    # # make clean sequences
-    # onsets_with_performance_times = np.array(list(time_tuples_by_onset.keys()))
-    # current_s_onset_no = 0
-    # for s_onset_no in range(len(unique_onsets)):
-    #     if s_onset_no > current_s_onset_no:
-    #         s_onset = unique_onsets[s_onset_no]
-    #         if all_pitch_repeat_by_onset[s_onset]:
-    #             local_s_onset_no = s_onset_no
-    #             s_onset_range = [unique_onsets[s_onset_no - 1]]
-    #             not_last = True
-    #             while(all_pitch_repeat_by_onset[unique_onsets[local_s_onset_no]]):
-    #                 s_onset_range.append(unique_onsets[local_s_onset_no])
-    #                 local_s_onset_no += 1
-    #                 if local_s_onset_no >= len(unique_onsets)-1:
-    #                     not_last = False
-    #                     break
-    #             if not_last:
-    #                 current_s_onset_no = local_s_onset_no - 1
-    #                 s_onset_range = np.array(s_onset_range)
-    #                 first_s_onset_in_range = s_onset_range[0]
-    #                 first_s_onset_out_of_range = unique_onsets[local_s_onset_no]
-    #                 # --------reverse specials
-
-    #                 first_s_onset_in_range_aligned = np.min(onsets_with_performance_times[onsets_with_performance_times<=first_s_onset_in_range])
-    #                 first_s_onset_out_of_range_aligned = np.max(onsets_with_performance_times[onsets_with_performance_times>=first_s_onset_out_of_range])
-    #                 first_p_onset_in_range = np.min(time_tuples_by_onset[first_s_onset_in_range_aligned])   
-    #                 first_p_onset_out_of_range = np.min(time_tuples_by_onset[first_s_onset_out_of_range_aligned])   
-    #                 for pitch in pitches_by_onset[s_onset_range[1]]:  
-    #                     pitch_mask = performance_note_array['pitch'] == pitch
-    #                     higher_mask = performance_note_array['onset_sec'] <= first_p_onset_in_range
-    #                     lower_mask = performance_note_array['onset_sec'] > first_p_onset_out_of_range
-    #                     available_pp_notes = performance_note_array[np.all((pitch_mask, higher_mask, lower_mask), axis=0)]
-    #                     if len(available_pp_notes) == len(s_onset_range):
-    #                         for s_onset_local, p_onset_local in zip(s_onset_range, available_pp_notes):
-    #                             time_tuples_by_pitch[pitch].append((s_onset_local, p_onset_local['onset_sec']))
-    #                             time_tuples_by_onset[s_onset_local].append(p_onset_local['onset_sec'])
-
-
-    # # remove outliers
-    # for s_onset in time_tuples_by_onset.keys():
-    #     sorted_times = np.sort(np.array(time_tuples_by_onset[s_onset]))
-    #     mask = np.abs(sorted_times - np.median(sorted_times)) < 0.1
-
-    #     if mask.sum() >= 1:
-    #         time_tuples_by_onset[s_onset] = list(sorted_times[mask])
-    #     else:
-    #         time_tuples_by_onset[s_onset] = list(sorted_times)
-
-    unique_time_tuples_by_onset = {s_onset : np.min(time_tuples_by_onset[s_onset]) for s_onset in time_tuples_by_onset.keys()}
-    unique_time_tuples = np.array([(tup, unique_time_tuples_by_onset[tup]) for tup in unique_time_tuples_by_onset.keys()])  
-    unique_time_tuples = unique_time_tuples[unique_time_tuples[:,0].argsort()]
+    _remove_outlier_times(time_tuples_by_onset)
 
+    unique_time_tuples_by_onset, unique_time_tuples = _unique_time_tuples(time_tuples_by_onset)
     return time_tuples_by_onset, unique_time_tuples_by_onset, time_tuples_by_pitch, unique_time_tuples
 
 
 def get_score_to_perf_map(score_note_array, 
                        performance_note_array, 
                        onset_alignment,
-                       onset_alignment_reverse):
+                       onset_alignment_reverse,
+                       score_index=None):
     
         score_note_array = score_note_array[np.argsort(score_note_array["onset_beat"])]
+        # the onset/pitch index is shared by the forward and reverse pass
+        if score_index is None:
+            score_index = ScoreOnsetIndex(score_note_array)
         # Get time alignments from first unaligned notes
         time_tuples_by_onset_forward, _, _, unique_time_tuples_forward = pitch_and_onset_wise_times_ornament(performance_note_array, 
                                                                 score_note_array, 
-                                                                onset_alignment)
+                                                                onset_alignment,
+                                                                score_index=score_index)
         # unique_time_tuples = unique_time_tuples_forward
         performance_note_array_rev = np.flipud(performance_note_array)
         score_note_array_no_grace_rev = np.flipud(score_note_array)
         time_tuples_by_onset_reverse,_,_,unique_time_tuples_reverse = pitch_and_onset_wise_times_rev(performance_note_array_rev, 
                                                                 score_note_array_no_grace_rev, 
-                                                                onset_alignment_reverse)
+                                                                onset_alignment_reverse,
+                                                                score_index=score_index)
 
         # DUAL MATCHER  -----------------------------------------------------------------------------------
 
@@ -950,42 +1114,9 @@ def get_score_to_perf_map(score_note_array,
                     unique_time_tuples_by_onset[s_onset] = np.min(p_onsets_rev)
 
         # make clean sequences
-        unique_onsets = np.unique(score_note_array['onset_beat'])
-        additional_time_tuples_by_onset = defaultdict(list)
-        onsets_with_performance_times = np.sort(list(unique_time_tuples_by_onset.keys()))
-        for id, score_onset in enumerate(onsets_with_performance_times[:-1]):
-            # print(id, score_onset, onsets_with_performance_times[id+1])
-            first_s_onset_in_range = score_onset
-            first_s_onset_out_of_range = onsets_with_performance_times[id+1]
-            onset_mask = np.all((unique_onsets >= first_s_onset_in_range, unique_onsets < first_s_onset_out_of_range), axis=0)   
-            if onset_mask.sum() > 1:  
-
-                # use time tuples from forward pass and minimum to make sure the boundaries are correct
-                first_p_onset_in_range = np.min(unique_time_tuples_by_onset[first_s_onset_in_range])   
-                first_p_onset_out_of_range = np.min(unique_time_tuples_by_onset[first_s_onset_out_of_range]) 
-
-                score_mask = np.all((score_note_array['onset_beat'] >= first_s_onset_in_range,
-                                    score_note_array['onset_beat'] < first_s_onset_out_of_range), axis=0 )
-                pitches = np.unique( score_note_array[score_mask ]["pitch"])
-                perf_mask = np.all((performance_note_array['onset_sec'] >= first_p_onset_in_range,
-                                    performance_note_array['onset_sec'] < first_p_onset_out_of_range),axis=0)
-
-                for pitch in pitches:  
-                    done = False
-                    pitch_mask = performance_note_array['pitch'] == pitch
-                    s_pitch_mask = score_note_array['pitch'] == pitch
-                    
-                    available_pp_notes = performance_note_array[np.all((pitch_mask, perf_mask), axis=0)]
-                    available_ss_notes = score_note_array[np.all((score_mask, s_pitch_mask), axis=0)]
-
-                    if len(available_pp_notes) == len(available_ss_notes):
-                        # import pdb; pdb.set_trace()
-                        for s_onset_local, p_onset_local in zip(available_ss_notes, available_pp_notes):
-                            additional_time_tuples_by_onset[s_onset_local['onset_beat']].append(p_onset_local['onset_sec'])
-                        done = True
-
-                    if done:
-                        break
+        additional_time_tuples_by_onset = _interval_time_tuples(score_note_array, 
+                                                                performance_note_array,
+                                                                unique_time_tuples_by_onset)
 
         for s_onset in additional_time_tuples_by_onset.keys():
             if unique_time_tuples_by_onset[s_onset] == 0:
@@ -1008,9 +1139,9 @@ def get_score_to_perf_map(score_note_array,
         # plt.show()
 
 
-        score_to_perf_map = interp1d(unique_time_tuples[:,0],# score onsets
-                                     unique_time_tuples[:,1],# perf onsets
-                                     fill_value="extrapolate")
+        score_to_perf_map = TimeMap(unique_time_tuples[:,0],# score onsets
+                                    unique_time_tuples[:,1],# perf onsets
+                                    assume_sorted=True)
         
         # score_to_perf_map1 = interp1d(unique_time_tuples_forward[:,0],# score onsets
         #                              unique_time_tuples_forward[:,1],# perf onsets
@@ -1066,7 +1197,78 @@ def na_within(note_array,
         if ordered_by_field:
             return masked_note_array[masked_note_array[field].argsort()]
         else:
-            return masked_note_array 
+            return masked_note_array
+
+
+class NoteIndex(object):
+    """
+    Note array sorted by (pitch, field) answering the pitch
+    and time range queries of `na_within` by binary search,
+    with used notes flagged in a boolean array.
+
+    Positions refer to the sorted `note_array`, `order` maps
+    them back to the input array.
+
+    Parameters
+    ----------
+    note_array : np.array
+        Array of notes
+    field : str
+        time field of the range queries
+    """
+    def __init__(self, note_array, field="onset_beat"):
+        self.field = field
+        self.order = np.lexsort((note_array[field], note_array["pitch"]))
+        self.note_array = note_array[self.order]
+        self.times = self.note_array[field]
+        self.used = np.zeros(len(note_array), dtype=bool)
+        pitches, starts = np.unique(self.note_array["pitch"], return_index=True)
+        stops = np.r_[starts[1:], len(note_array)]
+        self.pitch_bounds = dict(zip(pitches, zip(starts, stops)))
+
+    def __len__(self):
+        return len(self.note_array)
+
+    def positions(self,
+                  pitch,
+                  lower_bound=None,
+                  upper_bound=None,
+                  unused=False):
+        """
+        positions of the notes of a pitch with times in the
+        closed interval [lower_bound, upper_bound], ordered by time
+        """
+        start, stop = self.pitch_bounds.get(pitch, (0, 0))
+        if lower_bound is not None:
+            start += np.searchsorted(self.times[start:stop], lower_bound, side="left")
+        if upper_bound is not None:
+            stop = start + np.searchsorted(self.times[start:stop], upper_bound, side="right")
+        positions = np.arange(start, stop)
+        if unused:
+            positions = positions[~self.used[start:stop]]
+        return positions
+
+    def within(self,
+               pitch,
+               lower_bound=None,
+               upper_bound=None,
+               unused=False):
+        """
+        notes of a pitch with times in the closed interval
+        [lower_bound, upper_bound], ordered by time
+        """
+        return self.note_array[self.positions(pitch, lower_bound, upper_bound, unused)]
+
+    def mark_used(self, positions):
+        self.used[positions] = True
+
+    def used_mask(self):
+        """
+        used flags in the order of the input array
+        """
+        mask = np.zeros(len(self), dtype=bool)
+        mask[self.order] = self.used
+        return mask
 
 
 class CleanOrnamentMatcher(object):
@@ -1085,8 +1287,18 @@ class CleanOrnamentMatcher(object):
     - grace notes are then mixed in with the score notes 
     for symbolic alignment
 
-
+    Parameters
+    ----------
+    n_jobs : int or None
+        number of processes solving the per-pitch 
+        alignments, None: one per CPU
+    chunk_size : int
+        maximal number of pitches per process task
     """
+    def __init__(self, n_jobs=1, chunk_size=8):
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+
     def __call__(self, 
                  score_note_array_full, # score notes including grace notes
                  score_note_array_no_grace, # score notes excluding grace notes 
@@ -1096,17 +1308,14 @@ class CleanOrnamentMatcher(object):
                  onset_alignment,
                  onset_alignment_reverse,
                  onset_threshold=None,
-                 process_ornaments=False):
-
-        if onset_threshold is None:
-            onset_threshold1 = 1000000
-        else:
-            onset_threshold1 = onset_threshold
+                 process_ornaments=False,
+                 score_index=None):
 
         score_to_perf_map = get_score_to_perf_map(score_note_array_no_grace,
                                                     performance_note_array,
                                                     onset_alignment,
-                                                    onset_alignment_reverse)
+                                                    onset_alignment_reverse,
+                                                    score_index=score_index)
         
         # Mix the grace notes into the score note array
         grace_onsets = np.unique(score_note_array_grace["onset_beat"])
@@ -1122,102 +1331,90 @@ class CleanOrnamentMatcher(object):
 
         # Get symbolic note_alignments
         note_alignments = list()
-        used_score_note_ids = set()
-        used_performance_note_ids = set()
-        perf_id_from_score_id = defaultdict(list)
-        for pitch in np.unique(alignment_score_note_array['pitch']):
-            score_note_array_pitch =  na_within(alignment_score_note_array, 
-                                                field="onset_beat",
-                                                pitch = pitch,
-                                                ordered_by_field = True)
-            performance_note_array_pitch =  na_within(performance_note_array, 
-                                                field="onset_sec",
-                                                pitch = pitch,
-                                                ordered_by_field = True)
-            
-            estimated_performance_note_onsets = score_to_perf_map(score_note_array_pitch['onset_beat'])
-
-            if  (performance_note_array_pitch.shape[0] > 1 and score_note_array_pitch.shape[0] > 1) or \
-                (performance_note_array_pitch.shape[0] > 1 and score_note_array_pitch.shape[0] == 1) or \
-                (performance_note_array_pitch.shape[0] == 1 and score_note_array_pitch.shape[0] > 1):
-                s_p_ID_tuples = unique_alignments(estimated_performance_note_onsets, 
-                                                  performance_note_array_pitch["onset_sec"],
-                                                  threshold=onset_threshold)
-            
-            elif performance_note_array_pitch.shape[0] == 1 and score_note_array_pitch.shape[0] == 1: 
-                if np.abs(estimated_performance_note_onsets[0] - performance_note_array_pitch["onset_sec"][0]) < onset_threshold1:
-                    s_p_ID_tuples = [(0,0)]
-                else:
-                    s_p_ID_tuples = []
-            else:
-                s_p_ID_tuples = []       
-            
+        score_notes = NoteIndex(alignment_score_note_array, field="onset_beat")
+        performance_notes = NoteIndex(performance_note_array, field="onset_sec")
+        # row in note_alignments and performance note position of the matches
+        match_by_score_id = dict()
+        # the notes are partitioned by pitch once, the time map is 
+        # evaluated for all score notes at once and the per-pitch 
+        # problems are solved in a batch (merged in pitch order)
+        estimated_performance_note_onsets = score_to_perf_map(score_notes.note_array['onset_beat'])
+        pitches = np.unique(alignment_score_note_array['pitch'])
+        score_positions = [score_notes.positions(pitch) for pitch in pitches]
+        performance_positions = [performance_notes.positions(pitch) for pitch in pitches]
+        problems = [(estimated_performance_note_onsets[s_positions], performance_notes.times[p_positions])
+                    for s_positions, p_positions in zip(score_positions, performance_positions)]
+        s_p_ID_tuples_by_pitch = pitch_alignments(problems, 
+                                                  onset_threshold=onset_threshold,
+                                                  n_jobs=self.n_jobs,
+                                                  chunk_size=self.chunk_size)
+
+        for s_positions, p_positions, s_p_ID_tuples in zip(score_positions, 
+                                                           performance_positions,
+                                                           s_p_ID_tuples_by_pitch):
             for s_ID, p_ID in s_p_ID_tuples:
+                score_id = score_notes.note_array["id"][s_positions[s_ID]]
+                performance_id = performance_notes.note_array["id"][p_positions[p_ID]]
                 note_alignments.append({'label': 'match', 
-                                        "score_id": score_note_array_pitch["id"][s_ID], 
-                                        "performance_id": performance_note_array_pitch["id"][p_ID]})
-                used_score_note_ids.add(score_note_array_pitch["id"][s_ID])
-                used_performance_note_ids.add(performance_note_array_pitch["id"][p_ID])
-                perf_id_from_score_id[score_note_array_pitch["id"][s_ID]].append( performance_note_array_pitch["id"][p_ID])
+                                        "score_id": score_id, 
+                                        "performance_id": performance_id})
+                score_notes.mark_used(s_positions[s_ID])
+                performance_notes.mark_used(p_positions[p_ID])
+                match_by_score_id[score_id] = (len(note_alignments) - 1, p_positions[p_ID])
 
         
         # add unmatched notes
-        used_score_mask = list()
-        for score_note in score_note_array_full:
-            if score_note["id"] not in used_score_note_ids:
-                note_alignments.append({'label': 'deletion', 'score_id': score_note["id"]})
-                used_score_mask.append(True)
-            else:
-                used_score_mask.append(False)
+        used_score_note_ids = score_notes.note_array["id"][score_notes.used]
+        unused_score_mask = ~np.isin(score_note_array_full["id"], used_score_note_ids)
+        for score_id in score_note_array_full["id"][unused_score_mask]:
+            note_alignments.append({'label': 'deletion', 'score_id': score_id})
         
-        used_pid_mask = list()
-        for performance_note in performance_note_array:
-            if performance_note["id"] not in used_performance_note_ids:
-                note_alignments.append({'label': 'insertion', 'performance_id': performance_note["id"]})
-                used_pid_mask.append(True)
-            else:
-                used_pid_mask.append(False)
+        unused_pid_mask = ~performance_notes.used_mask()
+        for performance_id in performance_note_array["id"][unused_pid_mask]:
+            note_alignments.append({'label': 'insertion', 'performance_id': performance_id})
                 
         if process_ornaments:
             # add ornaments
-            insertions = performance_note_array[np.array(used_pid_mask)]
-            deletions = score_note_array_full[np.array(used_score_mask)]
-
-            for ornament in score_note_array_ornaments:
-                if len(deletions[deletions["id"] == ornament["id"]]) == 0:
-                    possible_ornament_notes = list()
-                    if len(perf_id_from_score_id[ornament["id"]]) > 0:
-                        p_id = perf_id_from_score_id[ornament["id"]][0]
-                        note_alignments.remove({'label': 'match', 
-                                                    "score_id": ornament["id"], 
-                                                    "performance_id":  p_id})
-                        note_alignments.append({'label': 'insertion', 'performance_id': p_id})
-                        possible_ornament_notes = [performance_note_array[performance_note_array["id"] == p_id]]
-                            
-                    ornament_start = score_to_perf_map(ornament["onset_beat"] )
-                    ornament_end = score_to_perf_map(ornament["onset_beat"] + ornament["duration_beat"])
-                    ornament_pitch = ornament["pitch"]
-                    # find sequence of notes that could belong to the ornament
-                    
-                    for p in np.arange(ornament_pitch-2, ornament_pitch+3, 1):
-                        possible_ornament_notes.append(na_within(insertions, 
-                                field="onset_sec", 
-                                pitch=p, 
-                                lower_bound=ornament_start-0.25,
-                                upper_bound=ornament_end,
-                                ordered_by_field=True))
+            deleted = np.isin(score_note_array_ornaments["id"], 
+                              score_note_array_full["id"][unused_score_mask])
+            ornament_starts = score_to_perf_map(score_note_array_ornaments["onset_beat"])
+            ornament_ends = score_to_perf_map(score_note_array_ornaments["onset_beat"] + 
+                                              score_note_array_ornaments["duration_beat"])
+
+            for ornament, ornament_start, ornament_end in zip(score_note_array_ornaments[~deleted],
+                                                              ornament_starts[~deleted],
+                                                              ornament_ends[~deleted]):
+                possible_ornament_notes = list()
+                if ornament["id"] in match_by_score_id:
+                    # the match becomes an insertion, its row is dropped below
+                    row, p_position = match_by_score_id.pop(ornament["id"])
+                    p_id = note_alignments[row]["performance_id"]
+                    note_alignments[row] = None
+                    note_alignments.append({'label': 'insertion', 'performance_id': p_id})
+                    possible_ornament_notes = [performance_notes.note_array[[p_position]]]
                         
-                    possible_ornament_notes = np.concatenate(possible_ornament_notes)   
-                    possible_ornament_notes = possible_ornament_notes[possible_ornament_notes["onset_sec"].argsort()]
-                    possible_ornament_notes_pitch = possible_ornament_notes[possible_ornament_notes["pitch"] == pitch]
-                    if len(possible_ornament_notes_pitch) == 0 and len(possible_ornament_notes) > 0:
-                        note_alignments.append({'label': 'match', 
-                                                "score_id": ornament["id"], 
-                                                "performance_id":  possible_ornament_notes[0]["id"]})
-                    elif len(possible_ornament_notes_pitch) > 0:
-                        note_alignments.append({'label': 'match', 
-                                                "score_id": ornament["id"], 
-                                                "performance_id":  possible_ornament_notes_pitch[0]["id"]})
+                ornament_pitch = ornament["pitch"]
+                # find sequence of notes that could belong to the ornament
+                
+                for p in np.arange(ornament_pitch-2, ornament_pitch+3, 1):
+                    possible_ornament_notes.append(performance_notes.within(p, 
+                            lower_bound=ornament_start-0.25,
+                            upper_bound=ornament_end,
+                            unused=True))
+                    
+                possible_ornament_notes = np.concatenate(possible_ornament_notes)   
+                possible_ornament_notes = possible_ornament_notes[possible_ornament_notes["onset_sec"].argsort()]
+                possible_ornament_notes_pitch = possible_ornament_notes[possible_ornament_notes["pitch"] == ornament_pitch]
+                if len(possible_ornament_notes_pitch) == 0 and len(possible_ornament_notes) > 0:
+                    note_alignments.append({'label': 'match', 
+                                            "score_id": ornament["id"], 
+                                            "performance_id":  possible_ornament_notes[0]["id"]})
+                elif len(possible_ornament_notes_pitch) > 0:
+                    note_alignments.append({'label': 'match', 
+                                            "score_id": ornament["id"], 
+                                            "performance_id":  possible_ornament_notes_pitch[0]["id"]})
+            note_alignments = [note_alignment for note_alignment in note_alignments 
+                               if note_alignment is not None]
         return note_alignments
 
 
@@ -1227,31 +1424,51 @@ class CleanOrnamentMatcher(object):
 class OnsetMatcherDTW(object):
     """
     Create an onset matching using pitch-based DTW from note_arrays
+
+    Parameters
+    ----------
+    dtw : callable
+        DTW taking performance pitches and score pitch sets
+    subsequence : bool
+        the performance covers only a part of the score:
+        the path can start and end at any score onset
+        (subsequence DTW, requires a `DTW` or `DTWSL`)
     """
     def __init__(self, 
-                 dtw = DTWSL()):
+                 dtw = DTWSL(),
+                 subsequence = False):
         self.dtw = dtw
+        self.subsequence = subsequence
 
     def __call__(self,
                  score_note_array_no_grace, 
                  performance_note_array, 
-                 flip = False):
-
-        
-        unique_onsets = np.unique(score_note_array_no_grace["onset_beat"])
-        score_pitch_at_onsets = list()
-        for onset in unique_onsets:
-            score_pitch_at_onsets.append(set(score_note_array_no_grace[score_note_array_no_grace["onset_beat"] == onset]["pitch"]))
+                 flip = False,
+                 score_index = None):
+
+        if score_index is None:
+            score_index = ScoreOnsetIndex(score_note_array_no_grace)
+        unique_onsets = score_index.unique_onsets
+        score_pitch = score_index.pitch
+        if isinstance(self.dtw, DTWSL) and \
+            np.all((score_pitch >= 0) & (score_pitch < 128)):
+            # pitch sets as 128 bit masks
+            score_pitch_at_onsets = score_index.pitch_set_masks()
+        else:
+            score_pitch_at_onsets = [set(pitches) for pitches in score_index.pitches_by_onset]
 
+        dtw_kwargs = dict(subsequence="Y") if self.subsequence else dict()
         if flip:
-            score_pitch_at_onsets.reverse()
+            score_pitch_at_onsets = score_pitch_at_onsets[::-1]
             _, onset_alignment_path = self.dtw(np.flipud(performance_note_array["pitch"]), 
                                     score_pitch_at_onsets,  
-                                    return_path=True)
+                                    return_path=True,
+                                    **dtw_kwargs)
         else:
             _, onset_alignment_path = self.dtw(performance_note_array["pitch"], 
                                     score_pitch_at_onsets,  
-                                    return_path=True)
+                                    return_path=True,
+                                    **dtw_kwargs)
         
         return onset_alignment_path, unique_onsets
 
@@ -1297,7 +1514,7 @@ class PianoRollSequentialMatcher(object):
         self.window_size = window_size
         self.pfuzziness_relative_to_tempo = pfuzziness_relative_to_tempo
         self.shift_onsets = shift_onsets
-        self.cap_combinations = cap_combinations
+        _warn_cap_combinations(cap_combinations)
 
     def __call__(self, score_note_array,
                  performance_note_array, 
@@ -1351,8 +1568,7 @@ class PianoRollSequentialMatcher(object):
                     score_note_arrays[window_id],
                     performance_note_arrays[window_id],
                     dtw_alignment_times,
-                    shift=self.shift_onsets,
-                    cap_combinations=self.cap_combinations)
+                    shift=self.shift_onsets)
 
                 note_alignments.append(fine_local_alignment)
 
@@ -1387,7 +1603,7 @@ class PianoRollNoNodeMatcher(object):
                  window_size=1,
                  pfuzziness_relative_to_tempo=True,
                  shift_onsets=False,
-                 cap_combinations=100):
+                 cap_combinations=None):
 
         self.note_matcher = note_matcher(**matcher_kwargs)
         self.symbolic_note_matcher = symbolic_note_matcher
@@ -1403,7 +1619,7 @@ class PianoRollNoNodeMatcher(object):
         self.window_size = window_size
         self.pfuzziness_relative_to_tempo = pfuzziness_relative_to_tempo
         self.shift_onsets = shift_onsets
-        self.cap_combinations = cap_combinations
+        _warn_cap_combinations(cap_combinations)
 
     def __call__(self, score_note_array,
                  performance_note_array,
@@ -1474,8 +1690,7 @@ class PianoRollNoNodeMatcher(object):
                     score_note_arrays[window_id],
                     performance_note_arrays[window_id],
                     dtw_alignment_times,
-                    shift=self.shift_onsets,
-                    cap_combinations=self.cap_combinations)
+                    shift=self.shift_onsets)
 
                 note_alignments.append(fine_local_alignment)
         t41 = time.time()
@@ -1548,16 +1763,21 @@ class DualDTWNoteMatcher(object):
         score_note_array_no_grace = score_note_array[score_note_array["is_grace"] == False]    
         score_note_array_grace = score_note_array[score_note_array["is_grace"] == True]
 
+        # the onset/pitch index is shared by the forward and reverse passes
+        score_index = ScoreOnsetIndex(score_note_array_no_grace)
+        onset_kwargs = dict(score_index=score_index) \
+            if isinstance(self.onset_matcher, OnsetMatcherDTW) else dict()
+        note_kwargs = dict(score_index=score_index) \
+            if isinstance(self.note_matcher, CleanOrnamentMatcher) else dict()
+
         onset_alignment_path, _ = self.onset_matcher(score_note_array_no_grace, 
-                                                     performance_note_array)
+                                                     performance_note_array,
+                                                     **onset_kwargs)
 
         onset_alignment_path_reverse, _ = self.onset_matcher(score_note_array_no_grace, 
                                                              performance_note_array,
-                                                             flip = True)
-        
-
-        
-            
+                                                             flip = True,
+                                                             **onset_kwargs)
 
         global_alignment = self.note_matcher(score_note_array, # score notes including grace notes
                                             score_note_array_no_grace, # score notes excluding grace notes 
@@ -1567,7 +1787,8 @@ class DualDTWNoteMatcher(object):
                                             onset_alignment_path,
                                             onset_alignment_path_reverse,
                                             onset_threshold=1.5,
-                                            process_ornaments=process_ornaments) # TODO: document
+                                            process_ornaments=process_ornaments, # TODO: document
+                                            **note_kwargs)
         
         return global_alignment
 
@@ -5,7 +5,21 @@ Implementation of Needleman Wunsch and derived algorithms
 """
 import numpy as np
 from collections import defaultdict
-from scipy.spatial.distance import euclidean
+from scipy.spatial.distance import (cdist, euclidean, sqeuclidean, 
+                                    cityblock, chebyshev, cosine)
+
+from .dtw import (DTWBand, pairwise_metric, resolve_window, 
+                  sakoe_chiba_band, band_from_path)
+
+
+# backpointer codes: (row step, column step, message type)
+# 3 and 4 are the double moves of NW_DTW
+NW_STEPS = np.array([(-1, -1, 0), 
+                     (0, -1, 1), 
+                     (-1, 0, 2), 
+                     (0, -1, 0), 
+                     (-1, 0, 0)], dtype=int)
+_NW_STEP_CODES = {tuple(step): code for code, step in enumerate(NW_STEPS)}
 
 
 class NWDistanceMatrix(object):
@@ -13,17 +27,69 @@ class NWDistanceMatrix(object):
     An object to hold the accumulated cost matrix for the
     Needleman Wunsch algorithm
 
+    The costs are stored in a contiguous array (including 
+    the gap initialized first row and column), the backpointers 
+    as integer codes (see `NW_STEPS`, -1 for cells which were
+    not computed). If `shape` is unknown, the arrays grow with
+    the assigned indices.
+
     Parameters
     ----------
     gamma : float
         Gap parameter (for initializing the matrix)
+    shape : tuple or None
+        lengths (len_X, len_Y) of the aligned sequences
+    band : tuple or None
+        (lo, hi) arrays of the columns lo[i] <= j < hi[i] of the
+        cells (i, j) of the sequences which are stored (e.g., the 
+        rows of a window), requires `shape`. Only these cells are 
+        kept in memory, row 0 and column 0 are computed on the fly.
     """
-    def __init__(self, gamma = 0.1):
+    def __init__(self, gamma = 0.1, shape = None, band = None):
         self.gamma = float(gamma)
-        self.val_dict = defaultdict(lambda: np.inf)
-        self.indices_dict = dict()
         self.xdim = 0
         self.ydim = 0
+        self.band = None
+        if band is not None:
+            lo, hi = band
+            self.band = (np.asarray(lo, dtype=int), 
+                         np.asarray(hi, dtype=int))
+            self.offsets = np.r_[0, np.cumsum(self.band[1] - self.band[0])]
+            self.values = np.ones(self.offsets[-1]) * np.inf
+            self.codes = np.ones(self.offsets[-1], dtype=np.int8) * -1
+        else:
+            if shape is None:
+                shape = (0, 0)
+            self._allocate(shape[0] + 1, shape[1] + 1)
+
+    def _allocate(self, rows, cols):
+        """
+        (re)allocate the dense arrays, keeping the computed cells
+        """
+        values = np.ones((rows, cols)) * np.inf
+        values[0] = self.gamma * np.arange(cols)
+        values[:, 0] = self.gamma * np.arange(rows)
+        codes = np.ones((rows, cols), dtype=np.int8) * -1
+        if hasattr(self, "values"):
+            old_rows, old_cols = self.values.shape
+            values[1:old_rows, 1:old_cols] = self.values[1:, 1:]
+            codes[:old_rows, :old_cols] = self.codes
+        self.values = values
+        self.codes = codes
+
+    def _index(self, i, j):
+        """
+        index of cell (i, j) in the backing store or 
+        None if it is not stored
+        """
+        if self.band is None:
+            if 0 <= i < self.values.shape[0] and 0 <= j < self.values.shape[1]:
+                return (i, j)
+            return None
+        lo, hi = self.band
+        if 1 <= i <= len(lo) and lo[i - 1] < j <= hi[i - 1]:
+            return self.offsets[i - 1] + j - 1 - lo[i - 1]
+        return None
 
     @property
     def nw_distance(self):
@@ -40,15 +106,27 @@ class NWDistanceMatrix(object):
         elif i == j == 0:
             return 0
         else:
-            return self.val_dict[i, j]
+            index = self._index(i, j)
+            if index is None:
+                return np.inf
+            return self.values[index]
 
     def __setitem__(self, indices, values):
-        if indices[0] > self.xdim:
-            self.xdim = indices[0]
-        if indices[1] > self.ydim:
-            self.ydim = indices[1]
-        self.val_dict[indices] = values[0]
-        self.indices_dict[indices] = (values[1], values[2])
+        i, j = indices
+        if i > self.xdim:
+            self.xdim = i
+        if j > self.ydim:
+            self.ydim = j
+        index = self._index(i, j)
+        if index is None:
+            if self.band is not None:
+                raise IndexError("cell {0} is outside of the band".format(indices))
+            rows, cols = self.values.shape
+            self._allocate(max(rows, 2 * i + 1), max(cols, 2 * j + 1))
+            index = (i, j)
+        (i_prev, j_prev), align = values[1], values[2]
+        self.values[index] = values[0]
+        self.codes[index] = _NW_STEP_CODES[i_prev - i, j_prev - j, align]
 
     def path_step(self, i, j):
         """
@@ -61,29 +139,301 @@ class NWDistanceMatrix(object):
         elif j == 0 and i > 0:
             return (i - 1, 0), 2
         else:
-            return self.indices_dict[i, j]
+            index = self._index(i, j)
+            if index is None or self.codes[index] < 0:
+                raise KeyError((i, j))
+            di, dj, align = NW_STEPS[self.codes[index]]
+            return (i + di, j + dj), align
 
     @property
     def cost_matrix(self):
         """
-        The alignment cost matrix
+        The alignment cost matrix (a view of the backing 
+        store if it is not banded)
         """
+        if self.band is None:
+            return self.values[:self.xdim + 1, :self.ydim + 1]
         cost_matrix = np.ones((self.xdim + 1, self.ydim + 1)) * np.inf
-        for i in range(self.xdim + 1):
-            for j in range(self.ydim + 1):
-                cost_matrix[i, j] = self[i, j]
+        cost_matrix[0] = self.gamma * np.arange(self.ydim + 1)
+        cost_matrix[:, 0] = self.gamma * np.arange(self.xdim + 1)
+        lo, hi = self.band
+        for i in range(1, min(self.xdim, len(lo)) + 1):
+            cols = slice(lo[i - 1] + 1, min(hi[i - 1], self.ydim) + 1)
+            row = self.values[self.offsets[i - 1]:self.offsets[i]]
+            cost_matrix[i, cols] = row[:max(cols.stop - cols.start, 0)]
         return cost_matrix
 
 
+def nw_band_from_window(window, len_X):
+    """
+    row bounds (lo, hi) of the cells of a window 
+    (list of (i, j) tuples)
+    """
+    window = np.asarray(window, dtype=int).reshape(-1, 2)
+    lo = np.zeros(len_X, dtype=int)
+    hi = np.zeros(len_X, dtype=int)
+    if len(window) > 0:
+        rows = window[:, 0]
+        lo_rows = np.ones(len_X, dtype=int) * np.iinfo(int).max
+        np.minimum.at(lo_rows, rows, window[:, 1])
+        np.maximum.at(hi, rows, window[:, 1] + 1)
+        lo = np.where(hi > 0, lo_rows, 0)
+    return lo, hi
+
+
+# scipy metrics computed with cdist
+_CDIST_METRICS = {
+    euclidean: "euclidean",
+    sqeuclidean: "sqeuclidean",
+    cityblock: "cityblock",
+    chebyshev: "chebyshev",
+    cosine: "cosine",
+}
+
+
+def _cdist_metric(metric):
+    """
+    `cdist` name of a metric given by name or as a scipy
+    metric function, or None.
+    """
+    if isinstance(metric, str):
+        return metric
+    try:
+        return _CDIST_METRICS.get(metric)
+    except TypeError:
+        # unhashable metric
+        return None
+
+
+def _is_row_bounds(window, len_X):
+    """
+    True if the window is a pair (lo, hi) of row bounds rather 
+    than (i, j) cells: two 1D sequences of equal length other than
+    2 (the length of a cell), or a tuple of two arrays. Two sequences
+    of length 2 for 2 rows are ambiguous and raise a ValueError.
+    """
+    if not (isinstance(window, (tuple, list, np.ndarray)) and len(window) == 2 and 
+            all(np.ndim(w) == 1 for w in window) and len(window[0]) == len(window[1])):
+        return False
+    if len(window[0]) != 2 or (isinstance(window, tuple) and 
+                               all(isinstance(w, np.ndarray) for w in window)):
+        return True
+    if len_X == 2:
+        raise ValueError("ambiguous window for 2 rows: give the row bounds as a "
+                         "tuple of arrays (lo, hi) or more than two (i, j) cells")
+    return False
+
+
+def nw_window_bounds(window, len_X, len_Y):
+    """
+    row bounds of a window for aligning sequences 
+    of lengths len_X and len_Y.
+
+    Parameters
+    ----------
+    window : None, int, DTWBand, callable, tuple or iterable
+        None for all cells, an int for a band of this half 
+        width around the diagonal, a `DTWBand` (or a callable 
+        returning one, see `dtw.resolve_window`), a pair 
+        (lo, hi) of sequences of the columns lo[i] <= j < hi[i] 
+        of each row, a tuple (path, radius) for a band around 
+        a prior path (see `dtw.band_from_path`), or an iterable
+        of (i, j) cells.
+
+    Returns
+    -------
+    lo, hi : np.ndarray
+        column bounds of each row
+    cells : list or None
+        the (i, j) cells of the window if it was given 
+        as cells, None otherwise
+    """
+    cells = None
+    if window is None:
+        lo = np.zeros(len_X, dtype=int)
+        hi = np.ones(len_X, dtype=int) * len_Y
+    elif isinstance(window, (int, np.integer)):
+        band = sakoe_chiba_band(len_X, len_Y, window)
+        lo, hi = band.lo, band.hi
+    elif isinstance(window, DTWBand) or callable(window):
+        band = resolve_window(window, len_X, len_Y)
+        lo, hi = band.lo, band.hi
+    elif isinstance(window, tuple) and len(window) == 2 and np.ndim(window[1]) == 0:
+        band = band_from_path(window[0], len_X, len_Y, window[1])
+        lo, hi = band.lo, band.hi
+    elif _is_row_bounds(window, len_X):
+        lo, hi = window
+        if len(lo) != len_X or len(hi) != len_X:
+            raise ValueError("window bounds have to be given for the {0} rows".format(len_X))
+        lo = np.clip(np.asarray(lo, dtype=int), 0, len_Y)
+        hi = np.clip(np.asarray(hi, dtype=int), lo, len_Y)
+    else:
+        cells = list(window)
+        lo, hi = nw_band_from_window(cells, len_X)
+    return lo, hi, cells
+
+
+def nw_wavefront(pdist, lo, hi, gamma, double_moves=False, inside=None,
+                 block_size=2**16):
+    """
+    fill the Needleman-Wunsch (or NW-DTW) recursion 
+    by anti-diagonals, for the cells in a band.
+
+    Parameters
+    ----------
+    pdist : np.ndarray
+        pairwise distances of the cells (i, j), lo[i] <= j < hi[i]
+        of the band (row after row)
+    lo, hi : np.ndarray
+        column bounds of each row of the band
+    gamma : float
+        gap parameter
+    double_moves : bool
+        also consider the two-cell moves of NW-DTW
+    inside : np.ndarray or None
+        boolean mask of the band cells in the window,
+        other cells are not computed (inf cost)
+    block_size : int
+        approximate number of cells of the blocks of 
+        anti-diagonals whose indices are generated together
+
+    Returns
+    -------
+    values : np.ndarray
+        accumulated costs of the band cells
+    codes : np.ndarray
+        int8 backpointer codes (see `NW_STEPS`) of the
+        band cells, -1 outside of the window
+    """
+    M = len(lo)
+    N = int(hi.max()) if M > 0 else 0
+    offsets = np.r_[0, np.cumsum(hi - lo)]
+    size = offsets[-1]
+
+    # accumulated costs of the band, row 0 and column 0,
+    # out of band cells and the cells (-1, 0) and (0, -1)
+    top_slot = size
+    left_slot = top_slot + N + 1
+    inf_slot = left_slot + M + 1
+    gap_slot = inf_slot + 1
+    acc = np.empty(gap_slot + 1)
+    acc[top_slot:left_slot] = gamma * np.arange(N + 1)
+    acc[left_slot:inf_slot] = gamma * np.arange(M + 1)
+    acc[inf_slot] = np.inf
+    acc[gap_slot] = -gamma
+    # pairwise distances of the band and the cell (0, 0)
+    pd = np.r_[pdist if inside is None else np.where(inside, pdist, np.inf), 
+               np.inf, 0]
+    pd_inf_slot, pd_zero_slot = size, size + 1
+
+    def in_band(r, c):
+        r_clip = np.clip(r, 0, max(M - 1, 0))
+        ok = (r >= 0) & (r < M) & (lo[r_clip] <= c) & (c < hi[r_clip])
+        return ok, offsets[r_clip] + c - lo[r_clip]
+
+    def acc_index(r, c):
+        # (r, c) are sequence indices, i.e. cell (r + 1, c + 1)
+        ok, index = in_band(r, c)
+        index = np.where(ok, index, inf_slot)
+        index = np.where((r == -1) & (c >= -1), top_slot + c + 1, index)
+        index = np.where((c == -1) & (r >= 0), left_slot + r + 1, index)
+        return np.where(((r == -2) & (c == -1)) | ((r == -1) & (c == -2)), 
+                        gap_slot, index)
+
+    def pd_index(r, c):
+        ok, index = in_band(r, c)
+        index = np.where(ok, index, pd_inf_slot)
+        return np.where((r == -1) & (c == -1), pd_zero_slot, index)
+
+    # the indices are generated in blocks of anti-diagonals r + c = d,
+    # for bands with non-decreasing bounds the rows of an anti-diagonal 
+    # are the range of rows r with r + lo[r] <= d < r + hi[r], otherwise 
+    # the rows of the band cells are grouped by anti-diagonal
+    n_diagonals = max(M + N - 1, 1)
+    if np.all(np.diff(lo) >= 0) and np.all(np.diff(hi) >= 0):
+        rows = None
+        first_row = np.searchsorted(np.arange(M) + hi, np.arange(n_diagonals), side="right")
+        counts = np.searchsorted(np.arange(M) + lo, np.arange(n_diagonals), side="right") - first_row
+        counts = np.maximum(counts, 0)
+    else:
+        rows = np.repeat(np.arange(M), hi - lo)
+        diagonals = np.arange(size) - offsets[rows] + lo[rows] + rows
+        rows = rows[np.argsort(diagonals, kind="stable")]
+        counts = np.bincount(diagonals, minlength=n_diagonals)
+    bounds = np.r_[0, np.cumsum(counts)]
+    block_bounds = np.unique(np.r_[np.searchsorted(bounds, np.arange(0, size, block_size), side="right") - 1, 
+                                   n_diagonals])
+
+    # candidates in the order of the tie breaking: 
+    # gap in Y, gap in X, match, double moves
+    candidate_codes = np.array([2, 1, 0, 3, 4], dtype=np.int8)
+    codes = np.empty(size, dtype=np.int8)
+    for d_start, d_stop in zip(block_bounds[:-1], block_bounds[1:]):
+        d = np.repeat(np.arange(d_start, d_stop), counts[d_start:d_stop])
+        if rows is None:
+            r = first_row[d] + np.arange(len(d)) - (bounds[d] - bounds[d_start])
+        else:
+            r = rows[bounds[d_start]:bounds[d_stop]]
+        c = d - r
+        index = offsets[r] + c - lo[r]
+        pd_block = pd[index]
+        neighbors = [(acc_index(r - 1, c), None),
+                     (acc_index(r, c - 1), None),
+                     (acc_index(r - 1, c - 1), None)]
+        if double_moves:
+            neighbors += [(acc_index(r - 1, c - 2), pd[pd_index(r, c - 1)]),
+                          (acc_index(r - 2, c - 1), pd[pd_index(r - 1, c)])]
+        for diagonal in range(d_start, d_stop):
+            diag = slice(bounds[diagonal] - bounds[d_start], 
+                         bounds[diagonal + 1] - bounds[d_start])
+            candidates = []
+            for k, (neighbor, steps) in enumerate(neighbors):
+                if k < 2:
+                    candidates.append(acc[neighbor[diag]] + gamma)
+                elif k == 2:
+                    candidates.append(acc[neighbor[diag]] + pd_block[diag])
+                else:
+                    candidates.append(acc[neighbor[diag]] + steps[diag] + pd_block[diag])
+            candidates = np.array(candidates)
+            choice = np.argmin(candidates, axis=0)
+            values = candidates[choice, np.arange(candidates.shape[1])]
+            diagonal_codes = candidate_codes[choice]
+            if inside is not None:
+                outside = ~inside[index[diag]]
+                values[outside] = np.inf
+                diagonal_codes[outside] = -1
+            acc[index[diag]] = values
+            codes[index[diag]] = diagonal_codes
+    return acc[:size], codes
+
+
 class NeedlemanWunsch(object):
     """
     Needleman-Wunsch algorithm for aligning sequences.
+
+    Parameters
+    ----------
+    metric : callable or str
+        local distance metric, scipy metrics, strings and 
+        registered metrics (see `dtw.register_metric`) are 
+        computed as a pairwise matrix
+    gamma : float
+        gap parameter
+    vectorized : bool
+        fill the recursion by anti-diagonals (the window is 
+        used as a mask of cells), instead of a loop over the 
+        window cells in the given order
     """
+    # NW has no two-cell moves
+    double_moves = False
+
     def __init__(self, 
                  metric = euclidean, 
-                 gamma = 0.1):
+                 gamma = 0.1,
+                 vectorized = True):
         self.metric = metric
         self.gamma = gamma
+        self.vectorized = vectorized
 
     def __call__(self, X, Y, return_path=True,
                  window=None,
@@ -91,21 +441,10 @@ class NeedlemanWunsch(object):
         X = X.astype(float)
         Y = Y.astype(float)
         len_X, len_Y = len(X), len(Y)
-        if window is None:
-            window = [(i, j) for i in range(len_X) for j in range(len_Y)]
-        window = ((i + 1, j + 1) for i, j in window)
-
-        nw_matrix = NWDistanceMatrix(self.gamma)
-
-        for i, j in window:
-            dt = self.metric(X[i-1], Y[j-1])
-
-            nw_matrix[i, j] = min(
-                (nw_matrix[i-1, j] + self.gamma, (i-1, j), 2),
-                (nw_matrix[i, j-1] + self.gamma, (i, j-1), 1),
-                (nw_matrix[i-1, j-1] + dt, (i-1, j-1), 0),
-                key=lambda a: a[0]
-            )
+        if self.vectorized:
+            nw_matrix = self.wavefront_matrix(X, Y, window)
+        else:
+            nw_matrix = self.loop_matrix(X, Y, window)
 
         nw_distance = nw_matrix[len_X, len_Y]
 
@@ -120,6 +459,98 @@ class NeedlemanWunsch(object):
 
         return out
 
+    def pairwise_distances(self, X, Y):
+        """
+        pairwise distance matrix of X and Y
+        """
+        cdist_metric = _cdist_metric(self.metric)
+        if cdist_metric is not None:
+            return cdist(X, Y, cdist_metric)
+        pairwise = pairwise_metric(self.metric)
+        if pairwise is not None:
+            return np.asarray(pairwise(X, Y), dtype=float)
+        return np.array([[self.metric(x, y) for y in Y] for x in X], 
+                        dtype=float)
+
+    def band_pairwise_distances(self, X, Y, lo, hi):
+        """
+        pairwise distances of the cells (i, j), lo[i] <= j < hi[i] 
+        of a band (row after row)
+        """
+        if np.all(lo == 0) and np.all(hi == len(Y)):
+            return self.pairwise_distances(X, Y).ravel()
+        return np.concatenate([self.pairwise_distances(X[i:i+1], Y[lo[i]:hi[i]])[0]
+                               for i in range(len(X))] + [np.zeros(0)])
+
+    def wavefront_matrix(self, X, Y, window=None):
+        """
+        accumulated cost matrix computed with `nw_wavefront`
+        (only the cells of the window are stored)
+        """
+        len_X, len_Y = len(X), len(Y)
+        lo, hi, cells = nw_window_bounds(window, len_X, len_Y)
+        if window is None:
+            nw_matrix = NWDistanceMatrix(self.gamma, shape=(len_X, len_Y))
+        else:
+            nw_matrix = NWDistanceMatrix(self.gamma, shape=(len_X, len_Y),
+                                         band=(lo, hi))
+        if len_X == 0 or len_Y == 0:
+            return nw_matrix
+        inside = None
+        if cells is not None:
+            cells = np.asarray(cells, dtype=int).reshape(-1, 2)
+            inside = np.zeros(nw_matrix.offsets[-1], dtype=bool)
+            inside[nw_matrix.offsets[cells[:, 0]] + cells[:, 1] - lo[cells[:, 0]]] = True
+        values, codes = nw_wavefront(self.band_pairwise_distances(X, Y, lo, hi), 
+                                     lo, hi, self.gamma, 
+                                     double_moves=self.double_moves,
+                                     inside=inside)
+        if window is None:
+            nw_matrix.values[1:, 1:] = values.reshape(len_X, len_Y)
+            nw_matrix.codes[1:, 1:] = codes.reshape(len_X, len_Y)
+        else:
+            nw_matrix.values[:] = values
+            nw_matrix.codes[:] = codes
+        if cells is None:
+            nw_matrix.xdim, nw_matrix.ydim = len_X, len_Y
+        elif len(cells) > 0:
+            nw_matrix.xdim, nw_matrix.ydim = cells.max(axis=0) + 1
+        return nw_matrix
+
+    def loop_window(self, window, len_X, len_Y):
+        """
+        the accumulated cost matrix and the (lazy) sequence 
+        of cells computed by `loop_matrix`
+        """
+        lo, hi, cells = nw_window_bounds(window, len_X, len_Y)
+        if window is None:
+            nw_matrix = NWDistanceMatrix(self.gamma, shape=(len_X, len_Y))
+        else:
+            nw_matrix = NWDistanceMatrix(self.gamma, shape=(len_X, len_Y),
+                                         band=(lo, hi))
+        if cells is None:
+            cells = ((i, j) for i in range(len_X) for j in range(lo[i], hi[i]))
+        return nw_matrix, ((i + 1, j + 1) for i, j in cells)
+
+    def loop_matrix(self, X, Y, window=None):
+        """
+        accumulated cost matrix computed cell by cell 
+        in the order of the window
+        """
+        nw_matrix, window = self.loop_window(window, len(X), len(Y))
+
+        for i, j in window:
+            dt = self.metric(X[i-1], Y[j-1])
+
+            nw_matrix[i, j] = min(
+                (nw_matrix[i-1, j] + self.gamma, (i-1, j), 2),
+                (nw_matrix[i, j-1] + self.gamma, (i, j-1), 1),
+                (nw_matrix[i-1, j-1] + dt, (i-1, j-1), 0),
+                key=lambda a: a[0]
+            )
+
+        return nw_matrix
+
     def backtracking(self, nw_matrix):
         path = []
         i, j = nw_matrix.xdim, nw_matrix.ydim
@@ -147,24 +578,24 @@ class NeedlemanWunschDynamicTimeWarping(NeedlemanWunsch):
     """
     Needleman-Wunsch Dynamic Time Warping
     """
+    # two-cell moves: one element of X matched 
+    # to two elements of Y and vice versa
+    double_moves = True
+
     def __init__(self, 
                  metric = euclidean, 
-                 gamma = 0.1):
+                 gamma = 0.1,
+                 vectorized = True):
         super().__init__(metric=metric,
-                         gamma=gamma)
+                         gamma=gamma,
+                         vectorized=vectorized)
 
-    def __call__(self, X, Y, return_path=True,
-                 window=None,
-                 return_cost_matrix=False):
-
-        X = X.astype(float)
-        Y = Y.astype(float)
-        len_X, len_Y = len(X), len(Y)
-        if window is None:
-            window = [(i, j) for i in range(len_X) for j in range(len_Y)]
-        window = ((i + 1, j + 1) for i, j in window)
-
-        nw_matrix = NWDistanceMatrix(self.gamma)
+    def loop_matrix(self, X, Y, window=None):
+        """
+        accumulated cost matrix computed cell by cell 
+        in the order of the window
+        """
+        nw_matrix, window = self.loop_window(window, len(X), len(Y))
 
         pairwise_distance = defaultdict(lambda: float('inf'))
 
@@ -184,18 +615,7 @@ class NeedlemanWunschDynamicTimeWarping(NeedlemanWunsch):
                 key=lambda a: a[0]
             )
 
-        nw_distance = nw_matrix[len_X, len_Y]
-
-        out = (nw_distance, )
-
-        if return_path:
-            path = self.backtracking(nw_matrix)
-            out += (path, )
-
-        if return_cost_matrix:
-            out += (nw_matrix, )
-
-        return out
+        return nw_matrix
 
     def backtracking(self, nw_matrix):
         path = []
@@ -217,3 +637,222 @@ class NeedlemanWunschDynamicTimeWarping(NeedlemanWunsch):
 
 # alias
 NW_DTW = NeedlemanWunschDynamicTimeWarping
+
+
+class NeedlemanWunschAffineGap(NeedlemanWunsch):
+    """
+    Needleman-Wunsch with affine gap costs (Gotoh): a run 
+    of k gaps costs gap_open + (k - 1) * gap_extend, 
+    so runs of inserted notes (e.g., ornaments) are
+    penalized less than single gaps.
+
+    The recursion is computed by anti-diagonals on strips 
+    of rows. With `linear_memory`, the path is recovered 
+    without keeping the full matrices: strips are recomputed 
+    in a divide and conquer fashion (see `dtw.DTWLM`), only 
+    a strip of `block_rows` rows and a few rows per recursion
+    level are kept in memory.
+
+    Parameters
+    ----------
+    metric : callable or str
+        local distance metric (see `NeedlemanWunsch`)
+    gap_open : float
+        cost of the first gap of a run
+    gap_extend : float
+        cost of each further gap of a run
+    double_moves : bool
+        also consider the two-cell moves of NW-DTW
+    linear_memory : bool
+        recompute strips for the backtracking
+    block_rows : int
+        number of rows of a strip in linear memory
+    """
+    def __init__(self, 
+                 metric = euclidean, 
+                 gap_open = 0.1,
+                 gap_extend = 0.01,
+                 double_moves = False,
+                 linear_memory = False,
+                 block_rows = 128):
+        super().__init__(metric=metric,
+                         gamma=gap_open)
+        self.gap_open = gap_open
+        self.gap_extend = gap_extend
+        self.double_moves = double_moves
+        self.linear_memory = linear_memory
+        self.block_rows = block_rows
+
+    def __call__(self, X, Y, return_path=True,
+                 window=None,
+                 return_cost_matrix=False):
+        if window is not None:
+            raise ValueError("NeedlemanWunschAffineGap does not support windows")
+        if return_cost_matrix and self.linear_memory:
+            raise ValueError("NeedlemanWunschAffineGap does not keep the "
+                             "cost matrix in linear memory")
+        self._X = X.astype(float)
+        self._Y = Y.astype(float)
+        len_X, len_Y = len(X), len(Y)
+        state = self._initial_state()
+        block_rows = self.block_rows if self.linear_memory else max(len_X, 1)
+
+        if return_cost_matrix:
+            strip = self._strip(state, 1, len_X)
+            out = (strip[0][-1, -1], )
+            if return_path:
+                path = []
+                cell = self._backtrack_strip(strip, 1, (len_X, len_Y, 0), path)
+                out += (self._finish_path(cell, path), )
+            return out + (strip[0][1:], )
+
+        if not return_path:
+            return (self._forward(state, 1, len_X, block_rows)[1][-1], )
+
+        path = []
+        self._distance = state[1][-1]
+        cell = self._backtrack(state, 1, len_X, (len_X, len_Y, 0), 
+                               path, block_rows)
+        return (self._distance, self._finish_path(cell, path))
+
+    def _initial_state(self):
+        """
+        rows -1 and 0 of the accumulated cost, row 0 of the 
+        vertical gap cost and of the pairwise distances
+        """
+        len_Y = len(self._Y)
+        best = np.ones(len_Y + 1) * np.inf
+        best[0] = 0
+        best[1:] = self.gap_open + self.gap_extend * np.arange(len_Y)
+        pd = np.ones(len_Y + 1) * np.inf
+        pd[0] = 0
+        return (np.ones(len_Y + 1) * np.inf, best, 
+                np.ones(len_Y + 1) * np.inf, pd)
+
+    def _strip(self, state, a, b):
+        """
+        accumulated costs and backpointers of the rows a, ..., b
+        (NW coordinates, row 0 is the gap row) computed from 
+        the state of the rows a - 2 and a - 1
+        """
+        N = len(self._Y)
+        h = b - a + 1
+        best = np.ones((h + 2, N + 1)) * np.inf
+        best[0], best[1] = state[0], state[1]
+        gap_rows = np.ones((h + 1, N + 1)) * np.inf
+        gap_rows[0] = state[2]
+        gap_cols = np.ones((h, N + 1)) * np.inf
+        pd = np.ones((h + 1, N + 1)) * np.inf
+        pd[0] = state[3]
+        if h > 0:
+            pd[1:, 1:] = self.pairwise_distances(self._X[a - 1:b], self._Y)
+        # column 0 is a run of gaps
+        column = self.gap_open + self.gap_extend * np.arange(a - 1, b)
+        best[2:, 0] = gap_rows[1:, 0] = column
+        moves = np.ones((h, N + 1), dtype=np.int8) * -1
+        rows_extend = np.zeros((h, N + 1), dtype=bool)
+        cols_extend = np.zeros((h, N + 1), dtype=bool)
+        # candidates in the order of the tie breaking (see `nw_wavefront`)
+        candidate_codes = np.array([2, 1, 0, 3, 4], dtype=np.int8)
+        for d in range(1, h + N):
+            r = np.arange(max(0, d - N), min(h - 1, d - 1) + 1)
+            j = d - r
+            open_rows = best[r + 1, j] + self.gap_open
+            extend_rows = gap_rows[r, j] + self.gap_extend
+            gap_rows[r + 1, j] = np.minimum(open_rows, extend_rows)
+            rows_extend[r, j] = extend_rows < open_rows
+            open_cols = best[r + 2, j - 1] + self.gap_open
+            extend_cols = gap_cols[r, j - 1] + self.gap_extend
+            gap_cols[r, j] = np.minimum(open_cols, extend_cols)
+            cols_extend[r, j] = extend_cols < open_cols
+            candidates = [gap_rows[r + 1, j], 
+                          gap_cols[r, j], 
+                          best[r + 1, j - 1] + pd[r + 1, j]]
+            if self.double_moves:
+                left = np.where(j >= 2, 
+                                best[r + 1, np.maximum(j - 2, 0)] + pd[r + 1, j - 1],
+                                np.inf)
+                candidates += [left + pd[r + 1, j],
+                               best[r, j - 1] + pd[r, j] + pd[r + 1, j]]
+            candidates = np.array(candidates)
+            choice = np.argmin(candidates, axis=0)
+            best[r + 2, j] = candidates[choice, np.arange(len(r))]
+            moves[r, j] = candidate_codes[choice]
+        return best, gap_rows, pd, moves, rows_extend, cols_extend
+
+    def _forward(self, state, a, b, block_rows):
+        """
+        state of the rows b - 1 and b computed from 
+        the state of the rows a - 2 and a - 1
+        """
+        for start in range(a, b + 1, block_rows):
+            end = min(start + block_rows, b + 1) - 1
+            best, gap_rows, pd = self._strip(state, start, end)[:3]
+            state = (best[-2], best[-1], gap_rows[-1], pd[-1])
+        return state
+
+    def _backtrack(self, state, a, b, cell, path, block_rows):
+        """
+        continue the backtracking from `cell` (row, column, 
+        matrix: 0 accumulated, 1 vertical gap, 2 horizontal gap)
+        until the path leaves the rows a, ..., b. Returns 
+        the cell where the path left.
+        """
+        if b - a + 1 > block_rows:
+            mid = (a + b) // 2
+            mid_state = self._forward(state, a, mid, block_rows)
+            cell = self._backtrack(mid_state, mid + 1, b, cell, path, block_rows)
+            return self._backtrack(state, a, mid, cell, path, block_rows)
+        strip = self._strip(state, a, b)
+        if b == len(self._X):
+            self._distance = strip[0][-1, -1]
+        return self._backtrack_strip(strip, a, cell, path)
+
+    def _backtrack_strip(self, strip, a, cell, path):
+        """
+        backtracking within a strip computed with `_strip`
+        """
+        moves, rows_extend, cols_extend = strip[3:]
+        i, j, matrix = cell
+        while i >= a:
+            if j == 0:
+                path.append((i - 1, -1))
+                i -= 1
+            elif matrix == 1:
+                path.append((i - 1, -1))
+                matrix = 1 if rows_extend[i - a, j] else 0
+                i -= 1
+            elif matrix == 2:
+                path.append((-1, j - 1))
+                matrix = 2 if cols_extend[i - a, j] else 0
+                j -= 1
+            else:
+                move = moves[i - a, j]
+                if move == 2:
+                    matrix = 1
+                elif move == 1:
+                    matrix = 2
+                elif move == 0:
+                    path.append((i - 1, j - 1))
+                    i, j = i - 1, j - 1
+                elif move == 3:
+                    path.extend([(i - 1, j - 1), (i - 1, j - 2)])
+                    i, j = i - 1, j - 2
+                else:
+                    path.extend([(i - 1, j - 1), (i - 2, j - 1)])
+                    i, j = i - 2, j - 1
+        return i, j, matrix
+
+    def _finish_path(self, cell, path):
+        """
+        gaps along row 0 and the path in forward order
+        """
+        _, j, _ = cell
+        while j > 0:
+            path.append((-1, j - 1))
+            j -= 1
+        path.reverse()
+        return np.array(path, dtype=int).reshape(-1, 2)
+
+# alias
+NW_AG = NeedlemanWunschAffineGap
@@ -1,10 +1,15 @@
 from .. import ALIGNMENT_TRANSFORMER_CHECKPOINT
 import numpy as np
 from collections import defaultdict
-from .pretrained_models import AlignmentTransformer
-import torch
-from .matchers import na_within
-from scipy.interpolate import interp1d
+try:
+    import torch
+    from .pretrained_models import AlignmentTransformer
+except ImportError:
+    # the transformer matchers need torch, 
+    # the OnlineTimeWarpingMatcher doesn't
+    torch = None
+from .matchers import NoteIndex
+from .utils import TimeMap
 
 ################################### TEMPO MODELS ###################################
 
@@ -72,9 +77,8 @@ class TempoModel(object):
             self.prev_score_onsets.append(score_onset)
             self.prev_perf_onsets.append(performed_onset)
             
-        self.score_perf_map = interp1d(self.prev_score_onsets[-100:], 
-                                       self.prev_perf_onsets[-100:], 
-                                       fill_value="extrapolate")
+        self.score_perf_map = TimeMap(self.prev_score_onsets[-100:], 
+                                      self.prev_perf_onsets[-100:])
         self.beat_period = np.clip((self.score_perf_map(score_onset) - \
             self.score_perf_map(score_onset - self.lookback))/self.lookback, 0.1, 10.0)
         self.counter += 1
@@ -145,7 +149,6 @@ class OnlineTransformerMatcher(object):
         
         self._prev_performance_notes = list()
         self._prev_score_onset = None
-        self._snote_aligned = set()
         self._pnote_aligned = set()
         self._pnote_aligned_pitch = list()
         self.alignment = []
@@ -157,10 +160,7 @@ class OnlineTransformerMatcher(object):
     def prepare_score(self):
 
         self.score_note_array_no_grace = self.score_note_array_full[self.score_note_array_full["is_grace"] == False]
-        self.score_by_pitch = defaultdict(list)
-        unique_pitches = np.unique(self.score_note_array_full["pitch"])
-        for pitch in unique_pitches:
-            self.score_by_pitch[pitch] = self.score_note_array_full[self.score_note_array_full["pitch"] == pitch]
+        self.score_notes = NoteIndex(self.score_note_array_full, field="onset_beat")
 
         self._prev_score_onset = self.score_note_array_full["onset_beat"][0]
         self._unique_score_onsets = np.unique(self.score_note_array_full["onset_beat"])
@@ -194,6 +194,8 @@ class OnlineTransformerMatcher(object):
                                     lookback = 1)
         
     def prepare_model(self):
+        if torch is None:
+            raise ImportError("{0} requires torch".format(type(self).__name__))
         self.model = AlignmentTransformer(
             token_number = 91,
             dim_model = 64,
@@ -220,9 +222,9 @@ class OnlineTransformerMatcher(object):
                                         "score_id": s_ID, 
                                         "performance_id": p_ID})
         # add unmatched notes
-        for score_note in self.score_note_array_full:
-            if score_note["id"] not in self._snote_aligned:
-                self.note_alignments.append({'label': 'deletion', 'score_id': score_note["id"]})
+        unaligned_score_mask = ~self.score_notes.used_mask()
+        for score_id in self.score_note_array_full["id"][unaligned_score_mask]:
+            self.note_alignments.append({'label': 'deletion', 'score_id': score_id})
         
         for performance_note in performance_note_array:
             if performance_note["id"] not in self._pnote_aligned:
@@ -237,15 +239,14 @@ class OnlineTransformerMatcher(object):
         p_pitch = performance_note["pitch"]
         self._prev_performance_notes.append(p_pitch)
 
-        possible_score_notes = self.score_by_pitch[p_pitch]
-
         # align greedily if open note at current onset
         if p_pitch in self.pitches_at_onset_by_id[self.id_by_onset[self._prev_score_onset]]:
-            best_notes = na_within(possible_score_notes, "onset_beat", 
+            best_positions = self.score_notes.positions(p_pitch, 
                                     self._prev_score_onset, self._prev_score_onset,
-                                    exclusion_ids=self._snote_aligned)
-            if len(best_notes) > 0:
-                best_note = best_notes[0]
+                                    unused=True)
+            if len(best_positions) > 0:
+                best_note = self.score_notes.note_array[best_positions[0]]
+                self.score_notes.mark_used(best_positions[0])
                 self.add_note_alignment(p_id, best_note["id"], p_onset, best_note["onset_beat"])
                 return
         
@@ -264,19 +265,21 @@ class OnlineTransformerMatcher(object):
             new_pred_id = pred_id - len(perf_seq) - 1 - (current_id - np.max((current_id-7, 0)))
 
             pred_score_onset = self._unique_score_onsets[current_id + new_pred_id]
-            possible_score_notes = self.score_by_pitch[p_pitch]
-            possible_score_notes =  na_within(possible_score_notes, "onset_beat", 
+            possible_positions = self.score_notes.positions(p_pitch, 
                                           pred_score_onset, pred_score_onset,
-                                          exclusion_ids=self._snote_aligned)
+                                          unused=True)
 
-            if len(possible_score_notes) > 0:
-                dist = np.abs(self.tempo_model.predict(possible_score_notes[0]["onset_beat"]) - p_onset)
-                top_three_notes[dist] = possible_score_notes[0]
+            if len(possible_positions) > 0:
+                possible_score_note = self.score_notes.note_array[possible_positions[0]]
+                dist = np.abs(self.tempo_model.predict(possible_score_note["onset_beat"]) - p_onset)
+                top_three_notes[dist] = possible_positions[0]
                 
         dists = list(top_three_notes.keys())
         if len(dists) >= 1:
 
-            best_note = top_three_notes[np.min(dists)]
+            best_position = top_three_notes[np.min(dists)]
+            best_note = self.score_notes.note_array[best_position]
+            self.score_notes.mark_used(best_position)
             if best_note["is_grace"]:
                 self.add_note_alignment(p_id, best_note["id"])
             else:
@@ -287,7 +290,6 @@ class OnlineTransformerMatcher(object):
                            perf_onset = None, score_onset = None
                            ):
         self.alignment.append((score_id, perf_id))
-        self._snote_aligned.add(score_id)
         self._pnote_aligned.add(perf_id)
         if perf_onset is not None and score_onset is not None:
             self.aligned_notes_at_onset[score_onset].append(perf_onset)
@@ -345,7 +347,6 @@ class OnlinePureTransformerMatcher(object):
         
         self._prev_performance_notes = list()
         self._prev_score_onset = None
-        self._snote_aligned = set()
         self._pnote_aligned = set()
         self._pnote_aligned_pitch = list()
         self.alignment = []
@@ -357,10 +358,7 @@ class OnlinePureTransformerMatcher(object):
     def prepare_score(self):
 
         self.score_note_array_no_grace = self.score_note_array_full[self.score_note_array_full["is_grace"] == False]
-        self.score_by_pitch = defaultdict(list)
-        unique_pitches = np.unique(self.score_note_array_full["pitch"])
-        for pitch in unique_pitches:
-            self.score_by_pitch[pitch] = self.score_note_array_full[self.score_note_array_full["pitch"] == pitch]
+        self.score_notes = NoteIndex(self.score_note_array_full, field="onset_beat")
 
         self._prev_score_onset = self.score_note_array_full["onset_beat"][0]
         self._unique_score_onsets = np.unique(self.score_note_array_full["onset_beat"])
@@ -401,6 +399,8 @@ class OnlinePureTransformerMatcher(object):
                                     func = func)
 
     def prepare_model(self):
+        if torch is None:
+            raise ImportError("{0} requires torch".format(type(self).__name__))
         self.model = AlignmentTransformer(
             token_number = 91,# 21 - 108 + 2 for padding (start_score, end) + 1 for non_pitch
             dim_model = 64,
@@ -427,9 +427,9 @@ class OnlinePureTransformerMatcher(object):
                                         "score_id": s_ID, 
                                         "performance_id": p_ID})
         # add unmatched notes
-        for score_note in self.score_note_array_full:
-            if score_note["id"] not in self._snote_aligned:
-                self.note_alignments.append({'label': 'deletion', 'score_id': score_note["id"]})
+        unaligned_score_mask = ~self.score_notes.used_mask()
+        for score_id in self.score_note_array_full["id"][unaligned_score_mask]:
+            self.note_alignments.append({'label': 'deletion', 'score_id': score_id})
         
         for performance_note in performance_note_array:
             if performance_note["id"] not in self._pnote_aligned:
@@ -459,13 +459,13 @@ class OnlinePureTransformerMatcher(object):
 
         
         pred_score_onset = self._unique_score_onsets[current_id + new_pred_id]
-        possible_score_notes = self.score_by_pitch[p_pitch]
-        possible_score_notes =  na_within(possible_score_notes, "onset_beat", 
+        possible_positions = self.score_notes.positions(p_pitch, 
                                         pred_score_onset, pred_score_onset,
-                                        exclusion_ids=self._snote_aligned)
+                                        unused=True)
 
-        if len(possible_score_notes) > 0:
-            best_note = possible_score_notes[0]
+        if len(possible_positions) > 0:
+            best_note = self.score_notes.note_array[possible_positions[0]]
+            self.score_notes.mark_used(possible_positions[0])
             if best_note["is_grace"]:
                 self.add_note_alignment(p_id, best_note["id"])
             else:
@@ -477,7 +477,6 @@ class OnlinePureTransformerMatcher(object):
                            score_onset = None
                            ):
         self.alignment.append((score_id, perf_id))
-        self._snote_aligned.add(score_id)
         self._pnote_aligned.add(perf_id)
         if perf_onset is not None and score_onset is not None:
             self.aligned_notes_at_onset[score_onset].append(perf_onset)
@@ -488,3 +487,158 @@ class OnlinePureTransformerMatcher(object):
     def __call__(self):
 
         return None
+
+
+class OnlineTimeWarpingMatcher(object):
+    """
+    Online time warping (OLTW) score follower.
+
+    Each incoming performance note is a new row of a DTW 
+    between the performance pitches and the pitch sets of the
+    score onsets (cost 0 if the pitch is in the set, 1 otherwise). 
+    Only a window of `window_size` score onsets starting `lookback` 
+    onsets before the current score position is computed, from the 
+    accumulated costs of the previous row, so the work and memory 
+    per note are constant. The note is aligned to an unaligned 
+    score note of the same pitch at the onset of minimal accumulated 
+    cost in the window, notes without such a score note within
+    `tolerance` of the minimal accumulated cost are insertions.
+
+    Parameters
+    ----------
+    score_note_array_full : np.ndarray
+        score note array (including grace notes)
+    window_size : int
+        number of score onsets evaluated per performance note
+    lookback : int
+        number of score onsets before the current 
+        score position in the window
+    tolerance : float
+        maximal difference to the minimal accumulated cost 
+        of the onsets the notes are aligned to
+    """
+    def __init__(self,
+                 score_note_array_full,
+                 window_size = 16,
+                 lookback = 4,
+                 tolerance = 1.0
+                 ):
+        self.score_note_array_full = np.sort(score_note_array_full, order="onset_beat")
+        self.window_size = window_size
+        self.lookback = lookback
+        self.tolerance = tolerance
+        self.prepare_score()
+        self.prepare_performance()
+
+    def prepare_score(self):
+        self._unique_score_onsets, onset_idx = np.unique(
+            self.score_note_array_full["onset_beat"], return_inverse=True)
+        self._onset_idx = onset_idx
+        n_onsets = len(self._unique_score_onsets)
+        is_grace = self.score_note_array_full["is_grace"]
+
+        # membership cost of each pitch at each onset (grace notes excluded),
+        # pitches not in the score share one array of ones
+        self._no_costs = np.ones(n_onsets)
+        self.costs_by_pitch = dict()
+        # score notes by pitch and onset
+        self.notes_by_pitch_and_onset = defaultdict(list)
+        for note_idx, (pitch, onset, grace) in enumerate(
+                zip(self.score_note_array_full["pitch"], onset_idx, is_grace)):
+            if not grace:
+                self.costs_by_pitch.setdefault(pitch, np.ones(n_onsets))[onset] = 0.0
+            self.notes_by_pitch_and_onset[pitch, onset].append(note_idx)
+        self._onsets_by_pitch = defaultdict(list)
+        for pitch, onset in sorted(self.notes_by_pitch_and_onset.keys()):
+            self._onsets_by_pitch[pitch].append(onset)
+        self._onsets_by_pitch = {pitch: np.array(onsets) 
+                                 for pitch, onsets in self._onsets_by_pitch.items()}
+
+    def prepare_performance(self):
+        # accumulated costs of the last row, starting at
+        # the virtual cell before the first score onset
+        self._acc = np.zeros(1)
+        self._acc_start = -1
+        self.current_onset_id = 0
+        # alignments of the performance
+        self._score_aligned = np.zeros(len(self.score_note_array_full), dtype=bool)
+        self._pnote_aligned = set()
+        self.alignment = []
+        self.note_alignments = []
+
+    def offline(self, performance_note_array):
+        self.prepare_performance()
+
+        for p_note in performance_note_array[:]:
+            self.online(p_note)
+
+        for s_ID, p_ID in self.alignment:
+                self.note_alignments.append({'label': 'match', 
+                                        "score_id": s_ID, 
+                                        "performance_id": p_ID})
+        # add unmatched notes
+        for score_id in self.score_note_array_full["id"][~self._score_aligned]:
+            self.note_alignments.append({'label': 'deletion', 'score_id': score_id})
+        
+        for performance_note in performance_note_array:
+            if performance_note["id"] not in self._pnote_aligned:
+                self.note_alignments.append({'label': 'insertion', 'performance_id': performance_note["id"]})
+
+        return self.note_alignments
+
+    def online(self, performance_note):
+        p_id = performance_note["id"]
+        p_pitch = performance_note["pitch"]
+
+        # new row of the accumulated cost in the window
+        start = max(self.current_onset_id - self.lookback, 0)
+        stop = min(start + self.window_size, len(self._unique_score_onsets))
+        costs = self.costs_by_pitch.get(p_pitch, self._no_costs)[start:stop]
+        previous = np.ones(stop - start + 1) * np.inf
+        lo = max(start - 1, self._acc_start)
+        hi = min(stop, self._acc_start + len(self._acc))
+        if lo < hi:
+            previous[lo - start + 1:hi - start + 1] = \
+                self._acc[lo - self._acc_start:hi - self._acc_start]
+        acc = costs + np.minimum(previous[1:], previous[:-1])
+        for k in range(1, len(acc)):
+            acc[k] = min(acc[k], costs[k] + acc[k - 1])
+        self._acc = acc
+        self._acc_start = start
+
+        # best unaligned score note of the same pitch in the window
+        best_note_idx = None
+        if p_pitch in self._onsets_by_pitch:
+            onsets = self._onsets_by_pitch[p_pitch]
+            first, last = np.searchsorted(onsets, [start, stop])
+            onsets = onsets[first:last]
+            onsets = onsets[acc[onsets - start] <= acc.min() + self.tolerance]
+            for onset in onsets[np.argsort(acc[onsets - start], kind="stable")]:
+                for note_idx in self.notes_by_pitch_and_onset[p_pitch, onset]:
+                    if not self._score_aligned[note_idx]:
+                        best_note_idx = note_idx
+                        break
+                if best_note_idx is not None:
+                    break
+
+        if best_note_idx is not None:
+            best_note = self.score_note_array_full[best_note_idx]
+            self._score_aligned[best_note_idx] = True
+            self.add_note_alignment(p_id, best_note["id"])
+            if not best_note["is_grace"]:
+                position = self._onset_idx[best_note_idx]
+            else:
+                position = self.current_onset_id
+        else:
+            position = start + int(np.argmin(acc))
+        self.current_onset_id = max(self.current_onset_id, position)
+
+    def add_note_alignment(self,
+                           perf_id, score_id
+                           ):
+        self.alignment.append((score_id, perf_id))
+        self._pnote_aligned.add(perf_id)
+
+    def __call__(self):
+
+        return None
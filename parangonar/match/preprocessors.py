@@ -5,22 +5,44 @@ This module contains preprocessing methods
 """
 
 import numpy as np
-from scipy.interpolate import interp1d
 
 from partitura.utils.music import (compute_pianoroll)
 
 from .dtw import DTW
 from .nwtw import NW_DTW, NW
+from .utils import TimeMap
 
 
 ################################### HELPERS ###################################
 
 
+def note_density_tempo(score_note_array, performance_note_array):
+    """
+    Rough tempo (in beats per second) of a performance of a score, 
+    or of a part of it: the ratio of the number of notes per 
+    second in the performance and per beat in the score.
+
+    Args:
+        score_note_array (np.ndarray): score note array
+        performance_note_array (np.ndarray): performance note array
+
+    Returns:
+        float: beats per second
+    """
+    score_span = np.ptp(score_note_array["onset_beat"])
+    performance_span = np.ptp(performance_note_array["onset_sec"])
+    if score_span <= 0 or performance_span <= 0:
+        return 1.0
+    return ((len(performance_note_array) / performance_span) / 
+            (len(score_note_array) / score_span))
+
+
 def alignment_times_from_dtw(score_note_array, 
                              performance_note_array,
                              matcher=DTW(),
                              SCORE_FINE_NODE_LENGTH=1.0,
-                             s_time_div=16, p_time_div=16):
+                             s_time_div=16, p_time_div=None,
+                             subsequence=False):
     """
     
     Coarse time warping to generate anchor points
@@ -34,24 +56,47 @@ def alignment_times_from_dtw(score_note_array,
         matcher (_type_, optional): _description_. Defaults to DTW().
         SCORE_FINE_NODE_LENGTH (float, optional): _description_. Defaults to 1.0.
         s_time_div (int, optional): _description_. Defaults to 16.
-        p_time_div (int, optional): _description_. Defaults to 16.
+        p_time_div (int, optional): time resolution of the performance
+            piano roll (frames per second). Defaults to None: 16, or 
+            with subsequence, derived from s_time_div and the tempo.
+        subsequence (bool, optional): the performance covers only a 
+            part of the score, align it with subsequence DTW 
+            (requires a `DTW` or `DTWSL` matcher). The returned times
+            span the matched part of the score. Subsequence DTW favors
+            short matches unless a frame of the score and of the 
+            performance cover about the same music: without p_time_div,
+            it is set to s_time_div times the tempo (see 
+            `note_density_tempo`). Defaults to False.
 
     Returns:
         _type_: _description_
     """
     # _____________ fine alignment ____________
+    if p_time_div is None and subsequence:
+        # frames of the performance covering about the same 
+        # music as the frames of the score
+        p_time_div = s_time_div * note_density_tempo(score_note_array,
+                                                     performance_note_array)
+    elif p_time_div is None:
+        p_time_div = 16
     # compute proper piano rolls
     s_pianoroll = compute_pianoroll(score_note_array,
                                     time_div=s_time_div,
-                                    remove_drums=False).toarray()
+                                    remove_drums=False).T.tocsr()
     p_pianoroll = compute_pianoroll(performance_note_array,
                                     time_div=p_time_div,
-                                    remove_drums=False).toarray()
+                                    remove_drums=False).T.tocsr()
     # make piano rolls binary
-    p_pianoroll_ones = np.zeros_like(p_pianoroll)
-    p_pianoroll_ones[p_pianoroll > 0.0] = 1.0
+    p_pianoroll_ones = (p_pianoroll > 0.0).astype(float)
+    if not isinstance(matcher, DTW):
+        # only DTW computes distances of sparse piano rolls
+        s_pianoroll = s_pianoroll.toarray()
+        p_pianoroll_ones = p_pianoroll_ones.toarray()
     # align the piano rolls
-    _, path = matcher(s_pianoroll.T, p_pianoroll_ones.T)
+    if subsequence:
+        _, path = matcher(s_pianoroll, p_pianoroll_ones, subsequence="X")
+    else:
+        _, path = matcher(s_pianoroll, p_pianoroll_ones)
     # compute an alignment of times using the DTW path
     path_array = np.array(path)
 
@@ -78,25 +123,21 @@ def alignment_times_from_dtw(score_note_array,
         [np.min(times_performance[ui])
          for ui in u_times_score_idxs])
 
-    try:
-        # Use a mapping to deal with missing values (due to
-        # insertions and deletions in NW-related methods)
-        # It should not affect the behavior of DTW methods
-        # CC: I will check this just in case ;)
-        stime_to_ptime_map = interp1d(x=u_times_score,
-                                      y=u_times_performance,
-                                      kind='linear',
-                                      bounds_error=False,
-                                      fill_value='extrapolate')
-    except ValueError:
-        # if there is only one element in u_times_score
-        stime_to_ptime_map = \
-            lambda x: np.ones_like(x) * u_times_performance[0]  # noqa: E731
+    # Use a mapping to deal with missing values (due to
+    # insertions and deletions in NW-related methods)
+    # It should not affect the behavior of DTW methods
+    # CC: I will check this just in case ;)
+    stime_to_ptime_map = TimeMap(u_times_score, u_times_performance,
+                                 assume_sorted=True)
 
     min_score = times_score.min()
-    max_score = max(score_note_array["onset_beat"].max() -
-                    score_note_array["onset_beat"].min(),
-                    SCORE_FINE_NODE_LENGTH)
+    if subsequence:
+        max_score = max(times_score.max(), 
+                        min_score + SCORE_FINE_NODE_LENGTH)
+    else:
+        max_score = max(score_note_array["onset_beat"].max() -
+                        score_note_array["onset_beat"].min(),
+                        SCORE_FINE_NODE_LENGTH)
     max_performance = max(performance_note_array["onset_sec"].max() -
                           performance_note_array["onset_sec"].min(),
                           SCORE_FINE_NODE_LENGTH)
@@ -186,9 +227,8 @@ def cut_note_arrays(performance_note_array,
     if not pfuzziness_relative_to_tempo:
         local_pfuzzines = np.ones_like(alignment[:,1])*pfuzziness
     else:
-        approximate_tempo = interp1d(alignment[:-1,0],
-                                     np.diff(alignment[:,1])/np.diff(alignment[:,0]),
-                                     fill_value="extrapolate")
+        approximate_tempo = TimeMap(alignment[:-1,0],
+                                    np.diff(alignment[:,1])/np.diff(alignment[:,0]))
         local_pfuzzines = approximate_tempo(alignment[:,0])*pfuzziness
 
     for i in range(len(alignment)-window_size):
@@ -8,7 +8,84 @@ from partitura.musicanalysis.performance_codec import (
 
 import numpy as np
 import os
-from scipy.interpolate import interp1d
+
+################################### TIME MAPS ###################################
+
+
+class TimeMap(object):
+    """
+    Piecewise-linear map between two time axes, e.g. score onsets
+    in beats to performance onsets in seconds.
+
+    Evaluates like interp1d(x, y, fill_value="extrapolate"): the
+    first and last segments are extended linearly and a map
+    with a single point is constant.
+
+    Parameters
+    ----------
+    x : array_like
+        Knot positions on the input axis.
+    y : array_like
+        Knot values on the output axis.
+    assume_sorted : bool
+        If False, the knots are sorted by x (stable).
+    """
+    def __init__(self, x, y, assume_sorted=False):
+        x = np.asarray(x, dtype=float).ravel()
+        y = np.asarray(y, dtype=float).ravel()
+        if len(x) == 0 or len(x) != len(y):
+            raise ValueError("x and y must be non-empty and of equal length")
+        if not assume_sorted:
+            order = np.argsort(x, kind="mergesort")
+            x = x[order]
+            y = y[order]
+        self.x = x
+        self.y = y
+        # repeated knots give empty segments, which only matter
+        # if they end up being extrapolated
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.slopes = np.diff(y) / np.diff(x)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __call__(self, x_new):
+        x_new = np.asarray(x_new, dtype=float)
+        if len(self.x) == 1:
+            return np.full(x_new.shape, self.y[0])
+        hi = np.clip(np.searchsorted(self.x, x_new), 1, len(self.x) - 1)
+        lo = hi - 1
+        return np.asarray(self.slopes[lo] * (x_new - self.x[lo]) + self.y[lo])
+
+    def inverse(self):
+        """
+        The map from y back to x, assuming y is monotonic.
+        """
+        return TimeMap(self.y, self.x)
+
+    def compose(self, other):
+        """
+        The map t -> self(other(t)), exact for an increasing other.
+        """
+        if len(other) == 1:
+            return TimeMap(other.x, self(other.y))
+        knots = np.union1d(other.x, other.inverse()(self.x))
+        return TimeMap(knots, self(other(knots)), assume_sorted=True)
+
+    def save(self, filename):
+        """
+        Store the knots in a .npz file.
+        """
+        np.savez(filename, x=self.x, y=self.y)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a map stored by save.
+        """
+        with np.load(filename) as knots:
+            return cls(knots["x"], knots["y"], assume_sorted=True)
+
 
 ################################### PARANGONADA EXPORT ###################################
 
@@ -277,7 +354,7 @@ def beat_times_from_matched_score(x, y,
                                   node_interval=1.0,
                                   start_beat=None):
 
-    beat_times_func = interp1d(x, y, kind="linear", fill_value="extrapolate")
+    beat_times_func = TimeMap(x, y)
 
     min_beat = np.ceil(x.min())  # -node_interval
     min_beat_original = min_beat
@@ -304,7 +381,7 @@ def measure_times_from_matched_score(x, y, part,
                                   measure_interval=1,
                                   start_measure=None):
 
-    beat_times_func = interp1d(x, y, kind="linear", fill_value="extrapolate")
+    beat_times_func = TimeMap(x, y)
 
     measure_times_in_part = [part.beat_map(measure.start.t) for measure in part.iter_all(partitura.score.Measure)]
     if start_measure is None:
@@ -5,12 +5,34 @@ This module includes tests for alignment utilities.
 """
 import unittest
 import numpy as np
-from parangonar.match.dtw import DTW
-from parangonar.match.nwtw import NW_DTW, NW
+from functools import partial
+from scipy.spatial.distance import cdist
+from scipy.sparse import csr_matrix
+from parangonar.match.dtw import (DTW,
+                                  DTWSL,
+                                  DTWLM,
+                                  sakoe_chiba_band,
+                                  itakura_band,
+                                  dtw_dmatrix_wavefront,
+                                  dtw_dmatrix_from_pairwise_dmatrix,
+                                  dtw_directions_wavefront,
+                                  dtw_backtracking_directions,
+                                  dtw_backtracking,
+                                  element_of_set_metric,
+                                  pitch_set_masks,
+                                  l2,
+                                  cdist_local,
+                                  register_metric,
+                                  PAIRWISE_METRICS)
+from parangonar.match.nwtw import NW_DTW, NW, NW_AG
 
 
 RNG = np.random.RandomState(1984)
 
+
+def l1(vec1, vec2):
+    return np.sum(np.abs(vec2 - vec1))
+
 array1 = np.array([[0,1,2,3,6]]).T
 array2 = np.array([[0,1,2,3,4,5,6]]).T
 
@@ -37,6 +59,153 @@ class TestAlignment(unittest.TestCase):
         _, path = vanillaDTW(array1, array2)
         self.assertTrue(np.all(result_dtw == path))
         
+    def test_DTW_wavefront(self, **kwargs):
+
+        for M, N in [(1, 1), (1, 6), (6, 1), (7, 12), (15, 9)]:
+            D = RNG.rand(M, N)
+            self.assertTrue(np.array_equal(dtw_dmatrix_wavefront(D),
+                                           dtw_dmatrix_from_pairwise_dmatrix(D)))
+
+    def test_DTW_directions(self, **kwargs):
+
+        for M, N in [(1, 6), (6, 1), (7, 12), (15, 9)]:
+            D = RNG.randint(0, 3, size=(M, N)).astype(float)
+            dtwd = dtw_dmatrix_from_pairwise_dmatrix(D)
+            _, directions, _ = dtw_directions_wavefront(D)
+            self.assertTrue(np.array_equal(dtw_backtracking_directions(directions),
+                                           dtw_backtracking(dtwd)))
+
+    def test_DTW_infinite_distances(self, **kwargs):
+
+        # infinite distances out of a band: the cells no finite
+        # path reaches get no step direction (-1)
+        D = RNG.rand(8, 10)
+        rows, cols = np.indices(D.shape)
+        D[np.abs(rows - cols) > 2] = np.inf
+        _, directions, dtwd = dtw_directions_wavefront(D, return_cost_matrix=True)
+        self.assertTrue(np.array_equal(dtwd, dtw_dmatrix_from_pairwise_dmatrix(D)))
+        self.assertTrue(np.all(directions[np.abs(rows - cols) > 3] == -1))
+        path = dtw_backtracking_directions(directions)
+        self.assertTrue(np.array_equal(path, dtw_backtracking(dtwd)))
+        self.assertTrue(np.all(np.abs(path[:, 0] - path[:, 1]) <= 2))
+        # no finite path: the backtracking does not wrap around
+        D[:, 5] = np.inf
+        _, directions, _ = dtw_directions_wavefront(D)
+        with self.assertRaises(ValueError):
+            dtw_backtracking_directions(directions)
+        D[0, 0] = np.nan
+        with self.assertRaises(ValueError):
+            dtw_directions_wavefront(D)
+
+    def test_DTW_subsequence(self, **kwargs):
+
+        query = array2[2:5]
+        d, path = DTW(subsequence="Y")(query, array2)
+        self.assertTrue(d == 0 and np.all(path == [[0, 2], [1, 3], [2, 4]]))
+        d, path = DTW(subsequence="X")(array2, query)
+        self.assertTrue(d == 0 and np.all(path == [[2, 0], [3, 1], [4, 2]]))
+        pitch_sets = [{60}, {62, 67}, {64}, {65}, {67}]
+        d, path = DTWSL(subsequence="Y")(np.array([64, 65, 67]), pitch_sets)
+        self.assertTrue(d == 0 and np.all(path[:, 1] == [2, 3, 4]))
+
+    def test_DTW_distance_rank(self, **kwargs):
+
+        dtw = DTW()
+        d = dtw(array1, array2, return_path=False)[0]
+        self.assertTrue(dtw.distance(array1, array2) == d)
+        self.assertTrue(dtw.distance(array1, array2, threshold=d / 2) == np.inf)
+        candidates = [array2 + shift for shift in [3, 0.5, 0, 2]]
+        ranking, distances = dtw.rank(array1, candidates, k=2)
+        self.assertTrue(np.all(ranking == [2, 1]))
+        self.assertTrue(distances[2] == d and np.isinf(distances[0]))
+
+    def test_DTW_batch(self, **kwargs):
+
+        pairs = [(RNG.rand(M, 3), RNG.rand(N, 3)) 
+                 for M, N in [(5, 7), (9, 4), (5, 7), (5, 7), (2, 8)]]
+        distances, paths = DTW().batch(pairs, chunk_size=2)
+        for (X, Y), distance, path in zip(pairs, distances, paths):
+            d, p = DTW()(X, Y)
+            self.assertTrue(d == distance and np.all(p == path))
+
+    def test_metric_registry(self, **kwargs):
+
+        X = RNG.rand(6, 3)
+        Y = RNG.rand(8, 3)
+        d, path = DTW(metric=l2, cdist_local=True)(X, Y)
+        d_loop, path_loop = DTW(metric=lambda a, b: l2(a, b), cdist_local=True)(X, Y)
+        self.assertTrue(d == d_loop and np.all(path == path_loop))
+        register_metric(l1, lambda arr1, arr2: cdist(arr1, arr2, "cityblock"))
+        self.assertTrue(np.allclose(cdist_local(X, Y, l1), 
+                                    [[l1(x, y) for y in Y] for x in X]))
+        del PAIRWISE_METRICS[l1]
+
+    def test_DTW_sparse(self, **kwargs):
+
+        X = (RNG.rand(12, 128) > 0.95).astype(float)
+        Y = (RNG.rand(15, 128) > 0.95).astype(float)
+        d, path = DTW()(csr_matrix(X), csr_matrix(Y))
+        d_dense, path_dense = DTW()(X, Y)
+        self.assertTrue(d == d_dense and np.all(path == path_dense))
+
+    def test_DTW_multiscale(self, **kwargs):
+
+        X = np.sin(np.linspace(0, 10, 200))[:, None]
+        Y = np.sin(np.linspace(0, 10, 150) ** 1.1)[:, None]
+        d, path = DTW()(X, Y)
+        multiscaleDTW = DTW(multiscale=True, radius=200)
+        d_ms, path_ms = multiscaleDTW(X, Y)
+        self.assertTrue(d == d_ms and np.all(path == path_ms))
+        multiscaleDTW = DTW(multiscale=True, radius=2)
+        _, path_ms = multiscaleDTW(X, Y)
+        self.assertTrue(multiscaleDTW.cells_evaluated < X.shape[0] * Y.shape[0])
+        self.assertTrue(np.all(path_ms[-1] == [199, 149]))
+        register_metric(l1, lambda arr1, arr2: cdist(arr1, arr2, "cityblock"))
+        d, path = DTW(metric=l1, cdist_local=True)(X, Y)
+        multiscaleDTW = DTW(metric=l1, cdist_local=True, multiscale=True, radius=200)
+        d_ms, path_ms = multiscaleDTW(X, Y)
+        del PAIRWISE_METRICS[l1]
+        self.assertTrue(d == d_ms and np.all(path == path_ms))
+        d_sparse, path_sparse = DTW(multiscale=True, radius=2)(csr_matrix(X), csr_matrix(Y))
+        d_dense, path_dense = DTW(multiscale=True, radius=2)(X, Y)
+        self.assertTrue(d_sparse == d_dense and np.all(path_sparse == path_dense))
+
+    def test_DTW_band(self, **kwargs):
+
+        bandDTW = DTW(window=partial(sakoe_chiba_band, radius=2))
+        d, path = bandDTW(array1, array2)
+        self.assertTrue(np.all(result_dtw == path))
+        self.assertTrue(bandDTW.cells_evaluated < array1.shape[0] * array2.shape[0])
+        _, path = DTW(window=itakura_band)(array1, array2)
+        self.assertTrue(np.all(path[-1] == [4, 6]))
+        pitches = np.array([60, 62, 64])
+        pitch_sets = [{60}, {62, 67}, {64}]
+        d, path = DTWSL(window=partial(sakoe_chiba_band, radius=1))(pitches, pitch_sets)
+        self.assertTrue(d == 0 and np.all(path == [[0, 0], [1, 1], [2, 2]]))
+        band = sakoe_chiba_band(5, 7, 1)
+        self.assertTrue(band.index(0, 0) == 0)
+        with self.assertRaises(IndexError):
+            band.index(0, 5)
+
+    def test_DTWSL_pitch_masks(self, **kwargs):
+
+        pitches = RNG.randint(60, 72, 20)
+        pitch_sets = [set(RNG.randint(60, 72, 3)) for _ in range(15)]
+        d, path = DTWSL()(pitches, pitch_sets)
+        d_loop, path_loop = DTWSL(metric=lambda e, s: element_of_set_metric(e, s))(
+            pitches, pitch_sets)
+        self.assertTrue(d == d_loop and np.all(path == path_loop))
+        d_masks, _ = DTWSL()(pitches, pitch_set_masks(pitch_sets))
+        self.assertTrue(d == d_masks)
+
+    def test_DTW_linear_memory(self, **kwargs):
+
+        X = RNG.randint(0, 2, size=(50, 4))
+        Y = RNG.randint(0, 2, size=(40, 4))
+        d, path = DTW()(X, Y)
+        d_lm, path_lm = DTWLM(block_rows=4)(X, Y)
+        self.assertTrue(d == d_lm and np.all(path == path_lm))
+
     def test_NWDTW_align(self, **kwargs):
 
         vanillaNW_DTW = NW_DTW()
@@ -48,7 +217,71 @@ class TestAlignment(unittest.TestCase):
         vanillaNW = NW()
         _, path = vanillaNW(array1, array2)
         self.assertTrue(np.all(result_nw == path))
-        
+
+    def test_NW_cost_matrix(self, **kwargs):
+
+        d, path, nw_matrix = NW()(array1, array2, return_cost_matrix=True)
+        cost_matrix = nw_matrix.cost_matrix
+        self.assertTrue(np.shares_memory(cost_matrix, nw_matrix.values))
+        self.assertTrue(cost_matrix.shape == (6, 8) and cost_matrix[-1, -1] == d)
+        window = [(i, j) for i in range(5) for j in range(7) if abs(i - j) <= 2]
+        d_band, path_band, band_matrix = NW()(array1, array2, window=window,
+                                              return_cost_matrix=True)
+        self.assertTrue(d_band == d and np.all(path_band == path))
+        self.assertTrue(np.isinf(band_matrix.cost_matrix[1, 5]))
+
+    def test_NW_vectorized(self, **kwargs):
+
+        for matcher in (NW, NW_DTW):
+            d, path, nw_matrix = matcher()(array1, array2, return_cost_matrix=True)
+            d_loop, path_loop, loop_matrix = matcher(vectorized=False)(
+                array1, array2, return_cost_matrix=True)
+            self.assertTrue(d == d_loop and np.all(path == path_loop))
+            self.assertTrue(np.array_equal(nw_matrix.cost_matrix,
+                                           loop_matrix.cost_matrix))
+        d_str, path_str = NW(metric="euclidean")(array1, array2)
+        self.assertTrue(d_str == d and np.all(path_str == path))
+
+        class L1(object):
+            # defining __eq__ makes the metric unhashable
+            def __eq__(self, other):
+                return isinstance(other, L1)
+
+            def __call__(self, vec1, vec2):
+                return l1(vec1, vec2)
+
+        d_l1, path_l1 = NW(metric=L1())(array1, array2)
+        self.assertTrue(d_l1 == d and np.all(path_l1 == path))
+
+    def test_NW_window_bounds(self, **kwargs):
+
+        band = sakoe_chiba_band(5, 7, 2)
+        cells = [(i, j) for i in range(5) for j in range(band.lo[i], band.hi[i])]
+        d, path = NW_DTW()(array1, array2, window=cells)
+        for window in (2, band, (band.lo, band.hi), [band.lo, band.hi], 
+                       (list(band.lo), list(band.hi))):
+            for vectorized in (True, False):
+                d_w, path_w, nw_matrix = NW_DTW(vectorized=vectorized)(
+                    array1, array2, window=window, return_cost_matrix=True)
+                self.assertTrue(d_w == d and np.all(path_w == path))
+                self.assertTrue(len(nw_matrix.values) == band.size)
+        with self.assertRaises(ValueError):
+            NW_DTW()(array1[:2], array2[:2], window=[(0, 0), (1, 1)])
+
+    def test_NW_affine_gap(self, **kwargs):
+
+        d, path = NW(gamma=0.5)(array1, array2)
+        d_ag, path_ag = NW_AG(gap_open=0.5, gap_extend=0.5)(array1, array2)
+        self.assertTrue(d_ag == d and np.all(path_ag == path))
+        for double_moves in (False, True):
+            matcher = NW_AG(gap_open=0.5, gap_extend=0.1, double_moves=double_moves)
+            d, path, cost_matrix = matcher(array1, array2, return_cost_matrix=True)
+            self.assertTrue(cost_matrix.shape == (6, 8) and cost_matrix[-1, -1] == d)
+            linear = NW_AG(gap_open=0.5, gap_extend=0.1, double_moves=double_moves,
+                           linear_memory=True, block_rows=2)
+            d_lm, path_lm = linear(array1, array2)
+            self.assertTrue(d_lm == d and np.all(path_lm == path))
+
         
 if __name__ == "__main__":
     unittest.main()
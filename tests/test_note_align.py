@@ -4,8 +4,20 @@
 This module includes tests for alignment utilities.
 """
 import unittest
+from unittest import mock
 import numpy as np
-from parangonar import AutomaticNoteMatcher, fscore_alignments
+from parangonar import (AutomaticNoteMatcher, OnlineTimeWarpingMatcher, 
+                        DualDTWNoteMatcher, fscore_alignments)
+from itertools import combinations
+from parangonar.match.matchers import (SimplestGreedyMatcher, optimal_omissions, 
+                                      unique_alignments, ScoreOnsetIndex,
+                                      NoteIndex, CleanOrnamentMatcher)
+from parangonar.match.utils import TimeMap
+from parangonar.match.preprocessors import (alignment_times_from_dtw, 
+                                            note_density_tempo)
+from parangonar.match.dtw import DTW
+from scipy.interpolate import interp1d
+import pickle
 import partitura as pt
 
 RNG = np.random.RandomState(1984)
@@ -27,6 +39,188 @@ class TestNoteAlignment(unittest.TestCase):
                                         alignment, 
                                         "deletion")
         self.assertTrue(f_score == 1.0)
+
+    def test_online_time_warping(self, **kwargs):
+        
+        perf_match, alignment, score_match = pt.load_match(
+            filename=MATCH_FILES[0],
+            create_score=True,
+        ) 
+        pna_match = perf_match.note_array()
+        sna_match = score_match.note_array(include_grace_notes=True)
+        matcher = OnlineTimeWarpingMatcher(sna_match)
+        pred_alignment = matcher.offline(pna_match)
+        _, _, f_score = fscore_alignments(pred_alignment, 
+                                        alignment, 
+                                        "match")
+        self.assertTrue(f_score == 1.0)
+        # a second performance starts from a fresh alignment
+        self.assertTrue(matcher.offline(pna_match) == 
+                        OnlineTimeWarpingMatcher(sna_match).offline(pna_match))
+
+    def test_subsequence_alignment_times(self, **kwargs):
+
+        perf_match, alignment, score_match = pt.load_match(
+            filename=MATCH_FILES[0],
+            create_score=True,
+        )
+        pna_match = perf_match.note_array()
+        sna_match = score_match.note_array()
+        onset_beats = dict(zip(sna_match["id"], sna_match["onset_beat"]))
+        onset_secs = dict(zip(pna_match["id"], pna_match["onset_sec"]))
+        matches = np.array([(onset_beats[a["score_id"]], onset_secs[a["performance_id"]])
+                            for a in alignment if a["label"] == "match"])
+        for start, end in [(9.4, 16.2), (2.4, 11.6)]:
+            fragment = pna_match[(pna_match["onset_sec"] >= start) &
+                                 (pna_match["onset_sec"] < end)]
+            beats = matches[(matches[:, 1] >= start) & (matches[:, 1] < end), 0]
+            times = alignment_times_from_dtw(sna_match, fragment, subsequence=True)
+            self.assertTrue(abs(times[0, 0] - beats.min()) <= 0.5)
+            self.assertTrue(abs(times[-1, 0] - beats.max()) <= 0.5)
+            # an explicit performance time resolution is used as given
+            p_time_div = 16 * note_density_tempo(sna_match, fragment)
+            self.assertTrue(np.array_equal(times, alignment_times_from_dtw(
+                sna_match, fragment, subsequence=True, p_time_div=p_time_div)))
+        times = alignment_times_from_dtw(sna_match, fragment, subsequence=True, p_time_div=16)
+        self.assertTrue(abs(times[0, 0] - beats.min()) > 0.5)
+
+    def test_greedy_align(self, **kwargs):
+
+        fields = [('onset_sec', 'f4'), ('pitch', 'i4'), ('id', 'U4')]
+        sna = np.array([(0, 60, 's0'), (0, 64, 's1'), (1, 60, 's2'), (2, 67, 's3')], 
+                       dtype=fields)
+        pna = np.array([(0, 64, 'p0'), (0, 60, 'p1'), (1, 62, 'p2'), (1, 60, 'p3')], 
+                       dtype=fields)
+        alignment = SimplestGreedyMatcher()(sna, pna)
+        self.assertTrue(alignment == [
+            {'label': 'match', 'score_id': 's0', 'performance_id': 'p1'},
+            {'label': 'match', 'score_id': 's1', 'performance_id': 'p0'},
+            {'label': 'match', 'score_id': 's2', 'performance_id': 'p3'},
+            {'label': 'deletion', 'score_id': 's3'},
+            {'label': 'insertion', 'performance_id': 'p2'}])
+
+    def test_optimal_omissions(self, **kwargs):
+
+        # random onsets and quantized onsets (with many ties)
+        sequences = [(np.sort(RNG.rand(9) * 4), np.sort(RNG.rand(5) * 4))]
+        for _ in range(40):
+            n = RNG.randint(2, 10)
+            m = RNG.randint(1, n)
+            quantization = RNG.choice([1, 3, 4])
+            sequences.append((np.sort(RNG.randint(0, 8, n) / quantization + 0.1),
+                              np.sort(RNG.randint(0, 8, m) / quantization)))
+        for longt, shortt in sequences:
+            n, m = len(longt), len(shortt)
+            for shift in (False, True):
+                diffs = dict()
+                for omit_idx in combinations(range(n), n - m):
+                    residuals = np.delete(longt, list(omit_idx)) - shortt
+                    if shift:
+                        residuals = residuals - np.mean(residuals)
+                    diffs[np.sum(np.abs(residuals) ** 2)] = list(omit_idx)
+                best_omit_idx = diffs[np.min(list(diffs.keys()))]
+                self.assertTrue(optimal_omissions(longt, shortt, shift) == best_omit_idx)
+        with self.assertWarns(DeprecationWarning):
+            AutomaticNoteMatcher(cap_combinations=100)
+
+    def test_unique_alignments(self, **kwargs):
+
+        xs = np.array([0., 1., 2., 3.])
+        ys = np.array([0.1, 1.05, 1.2, 2.9])
+        self.assertTrue(unique_alignments(xs, ys, threshold=0.5) == [(0, 0), (1, 1), (3, 3)])
+        xs = np.array([0., 1., 1.1, 5.])
+        self.assertTrue(unique_alignments(xs, ys[[0, 1, 3]]) == [(0, 0), (1, 1), (3, 2)])
+
+        # equal lengths are aligned one to one
+        self.assertTrue(unique_alignments(xs, ys + 1.) == [(0, 0), (1, 1), (2, 2), (3, 3)])
+
+        # the band kernel gives the tuples of the DTW path on per-pitch onsets
+        def dtw_path(xs, ys):
+            return DTW()(xs.reshape((-1, 1)), ys.reshape((-1, 1)))[1]
+
+        for _ in range(200):
+            n = RNG.randint(2, 40)
+            onsets = np.cumsum(RNG.choice([0.25, 0.5, 1.0], n)) * 0.5
+            xs = onsets[RNG.rand(n) < 0.9]
+            ys = onsets[RNG.rand(n) < 0.9]
+            if len(xs) == 0 or len(ys) == 0 or len(xs) == len(ys):
+                continue
+            xs = np.sort(xs + RNG.randn(len(xs)) * 0.03)
+            ys = np.sort(ys + RNG.randn(len(ys)) * 0.01)
+            with mock.patch("parangonar.match.matchers.monotone_onset_path", dtw_path):
+                expected = unique_alignments(xs, ys)
+            self.assertTrue(unique_alignments(xs, ys) == expected)
+
+    def test_score_onset_index(self, **kwargs):
+
+        fields = [('onset_beat', 'f4'), ('pitch', 'i4'), ('id', 'U4')]
+        sna = np.array([(1, 60, 's0'), (0, 64, 's1'), (1, 64, 's2'), 
+                        (2, 60, 's3'), (0, 60, 's4')], dtype=fields)
+        score_index = ScoreOnsetIndex(sna)
+        self.assertTrue(np.all(score_index.unique_onsets == [0, 1, 2]))
+        self.assertTrue(np.all(score_index.notes(1) == [0, 2]))
+        self.assertTrue(score_index.pitches_by_onset == [{60, 64}, {60, 64}, {60}])
+        blocked, all_pitch_repeat = score_index.adjacent_blocks()
+        self.assertTrue(blocked == [set(), {60, 64}, {60}] and all_pitch_repeat == [False, True, True])
+        blocked, all_pitch_repeat = score_index.stable_blocks(backwards=True)
+        self.assertTrue(blocked == [set(), {60}, {60, 64}] and all_pitch_repeat == [False, False, True])
+
+    def test_time_map(self, **kwargs):
+
+        x = np.sort(RNG.rand(20)) * 10
+        y = np.cumsum(RNG.rand(20))
+        times = np.linspace(-5, 15, 101)
+        time_map = TimeMap(x[::-1], y[::-1])
+        self.assertTrue(np.array_equal(time_map(times), 
+                                       interp1d(x, y, fill_value="extrapolate")(times)))
+        self.assertTrue(np.allclose(time_map.inverse()(time_map(times)), times))
+        other = TimeMap([0, 4, 10], [1, 2, 9])
+        self.assertTrue(np.allclose(time_map.compose(other)(times), time_map(other(times))))
+        self.assertTrue(np.array_equal(pickle.loads(pickle.dumps(time_map))(times), time_map(times)))
+        self.assertTrue(np.all(TimeMap([1], [3])(times) == 3))
+
+    def test_note_index(self, **kwargs):
+
+        fields = [('onset_sec', 'f4'), ('pitch', 'i4'), ('id', 'U4')]
+        pna = np.array([(1.5, 60, 'p0'), (0.5, 60, 'p1'), (1, 62, 'p2'), 
+                        (1, 60, 'p3'), (2, 60, 'p4')], dtype=fields)
+        note_index = NoteIndex(pna, field="onset_sec")
+        self.assertTrue(list(note_index.within(60)["id"]) == ['p1', 'p3', 'p0', 'p4'])
+        positions = note_index.positions(60, lower_bound=1, upper_bound=1.5)
+        self.assertTrue(list(note_index.note_array["id"][positions]) == ['p3', 'p0'])
+        note_index.mark_used(positions[0])
+        self.assertTrue(list(note_index.within(60, 1, 2, unused=True)["id"]) == ['p0', 'p4'])
+        self.assertTrue(len(note_index.within(61)) == 0)
+        self.assertTrue(list(note_index.used_mask()) == [False, False, False, True, False])
+
+    def test_parallel_pitch_alignments(self, **kwargs):
+        
+        perf_match, alignment, score_match = pt.load_match(
+            filename=MATCH_FILES[0],
+            create_score=True,
+        ) 
+        pna_match = perf_match.note_array()
+        sna_match = score_match.note_array(include_grace_notes=True)
+        pred_alignment = DualDTWNoteMatcher()(sna_match.copy(), pna_match)
+        parallel_matcher = DualDTWNoteMatcher(
+            note_matcher=CleanOrnamentMatcher(n_jobs=2, chunk_size=4))
+        self.assertTrue(parallel_matcher(sna_match.copy(), pna_match) == pred_alignment)
+
+    def test_ornament_alignment(self, **kwargs):
+        
+        perf_match, alignment, score_match = pt.load_match(
+            filename=MATCH_FILES[0],
+            create_score=True,
+        ) 
+        pna_match = perf_match.note_array()
+        sna_match = score_match.note_array(include_grace_notes=True)
+        # without a score part every note is processed as an ornament
+        pred_alignment = DualDTWNoteMatcher()(sna_match, pna_match, process_ornaments=True)
+        score_ids = [al["score_id"] for al in pred_alignment if al["label"] != "insertion"]
+        self.assertTrue(len(score_ids) == len(set(score_ids)) == len(sna_match))
+        # ornaments are matched to a note of their own pitch first
+        _, _, f_score = fscore_alignments(pred_alignment, alignment, "match")
+        self.assertTrue(f_score == 1.0)
         
 
         